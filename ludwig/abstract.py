@@ -409,6 +409,13 @@ class AbstractJudge:
 	def judge(self, problem: JSONOBJ, response: JSONOBJ) -> JSONDATA:
 		raise NotImplementedError
 
+	def answer_detector(self, problem: JSONOBJ) -> Optional['AnswerDetector']:
+		"""
+		(optional) Detects when a streamed response already contains a complete answer to `problem`, so the client can
+		stop generating (or None if the judge cannot tell before the response is complete).
+		"""
+		raise OptionalMethodNotImplemented
+
 	def prepare(self, task_spec: JSONOBJ) -> None:
 		raise NotImplementedError
 
@@ -452,6 +459,10 @@ class AbstractProtocol:
 		"""(optional) Returns the number of iterations remaining in this protocol"""
 		raise OptionalMethodNotImplemented
 
+	def set_shard(self, shard: str) -> None:
+		"""(optional) Restrict the protocol to one shard of the samples (formatted as `i/N`)"""
+		raise OptionalMethodNotImplemented
+
 	@property
 	def name(self):
 		"""
@@ -478,6 +489,10 @@ class AbstractProtocol:
 		"""Called every iteration"""
 		raise NotImplementedError
 
+	def should_stop(self) -> Optional[str]:
+		"""(optional) Called at checkpoint boundaries, returns the reason to stop early (if any)"""
+		raise OptionalMethodNotImplemented
+
 	def status(self) -> JSONOBJ:
 		"""
 		(optional) Report the current status of the protocol
@@ -60,6 +60,9 @@ class JudgeBase(fig.Configurable, AbstractJudge):
 	def hint(self, ctx: JSONOBJ) -> None:
 		pass
 
+	def answer_detector(self, problem: JSONOBJ) -> Optional['AnswerDetector']:
+		return None
+
 	_ignore_case = True
 	def judge(self, problem: JSONOBJ, response: JSONOBJ) -> JSONDATA:
 		assert 'answer' in problem, 'Problem must contain an answer'
@@ -141,4 +144,7 @@ class ProtocolBase(fig.Configurable, Checkpointable, AbstractProtocol):
 	def prepare(self, root: Path = None) -> Any:
 		pass
 
+	def should_stop(self) -> Optional[str]:
+		return None
+
 
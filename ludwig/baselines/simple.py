@@ -1,4 +1,7 @@
 from .imports import *
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ..util.clients import RequestOverrides
 
 
 @fig.component('zero-shot')
@@ -59,10 +62,17 @@ class ZeroShotPrompting(ClientStrategy):
 
 @fig.modifier('mv')
 class MajorityVote(ClientStrategy):
-	def __init__(self, n_votes: int = 5, **kwargs):
+	def __init__(self, n_votes: int = 5, *, vote_workers: int = None, adaptive: bool = False, **kwargs):
+		"""
+		:param vote_workers: number of votes generated concurrently (defaults to all of them)
+		:param adaptive: stop issuing votes as soon as the leading decision can no longer be overtaken
+		"""
 		assert n_votes > 1, 'n_votes must be greater than 1'
+		assert vote_workers is None or vote_workers > 0, 'vote_workers must be a positive integer'
 		super().__init__(**kwargs)
 		self.n_votes = n_votes
+		self.vote_workers = vote_workers
+		self.adaptive = adaptive
 		self._judge = None
 
 	def name(self) -> str:
@@ -71,6 +81,7 @@ class MajorityVote(ClientStrategy):
 	def json(self) -> JSONOBJ:
 		return {
 			'n_votes': self.n_votes,
+			'adaptive': self.adaptive,
 			**super().json()
 		}
 
@@ -80,27 +91,54 @@ class MajorityVote(ClientStrategy):
 		super().prepare(task, judge)
 		self._judge = judge
 
+	def _vote(self, problem: JSONOBJ, seed: int) -> JSONOBJ:
+		with RequestOverrides(seed=seed):
+			return super().solve(problem)
+
+	def _votes_needed(self, tally: Counter, remaining: int) -> int:
+		"""Number of further votes which could settle the outcome (if they all agree with the leader)."""
+		if not self.adaptive:
+			return remaining
+		lead, second, *_ = sorted(tally.values(), reverse=True) + [0, 0]
+		return max(0, min(remaining, (second + remaining - lead) // 2 + 1))
+
 	def collect_votes(self, problem: JSONOBJ) -> List[JSONOBJ]:
 		"""
 		Collect votes from the client for the given problem.
 		This method should be overridden by subclasses to implement specific voting logic.
+
+		The votes are generated concurrently, each with its own seed (drawn from the client's seed, so the votes are
+		the same regardless of the order in which they finish).
 		"""
-		master_seed = self.client.seed
-		rng = random.Random(master_seed)
-		responses = []
-		for i in range(self.n_votes):
-			self.client.seed = rng.randint(0, 2**32 - 1)
-			response = super().solve(problem)
-			responses.append(response)
-		self.client.seed = master_seed
-
-		votes = []
-		with self._judge.collect_stats() as judge_stats:
-			for response in responses:
-				vote = self._judge.interpret(problem, response)
-				votes.append({**response, **vote})
-
-		return {'votes': votes, 'judge_stats': judge_stats}
+		rng = random.Random(getattr(self.client, 'seed', None))
+		seeds = [rng.randint(0, 2**32 - 1) for _ in range(self.n_votes)]
+		workers = min(self.vote_workers or self.n_votes, self.n_votes)
+
+		results = {}
+		tally = Counter()
+		pending = {}
+		issued = 0
+		with self._judge.collect_stats() as judge_stats, ThreadPoolExecutor(workers) as pool:
+			while True:
+				needed = self._votes_needed(tally, self.n_votes - len(results))
+				while issued < self.n_votes and len(pending) < min(needed, workers):
+					future = pool.submit(copy_context().run, self._vote, dict(problem), seeds[issued])
+					pending[future] = issued
+					issued += 1
+				if not pending:
+					break
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in sorted(done, key=pending.get):
+					i = pending.pop(future)
+					response = future.result()
+					results[i] = {**response, **self._judge.interpret(problem, response)}
+					if 'decision' in results[i]:
+						tally[results[i]['decision']] += 1
+
+		votes = {'votes': [results[i] for i in sorted(results)], 'judge_stats': judge_stats}
+		if self.adaptive:
+			votes['skipped_votes'] = self.n_votes - len(results)
+		return votes
 
 	def aggregate(self, problem: JSONOBJ, votes: List[JSONOBJ]) -> JSONOBJ:
 
@@ -110,7 +148,7 @@ class MajorityVote(ClientStrategy):
 		if len(tally) == 0:
 			raise StrategyFailure('No valid votes collected')
 
-		votes['failed_votes'] = self.n_votes - sum(tally.values())
+		votes['failed_votes'] = len(votes['votes']) - sum(tally.values())
 
 		best = max(tally.values())
 		decisions = [k for k, v in tally.items() if v == best]
@@ -168,6 +206,7 @@ class FewShotPrompting(ClientStrategy):
 		self.n_shot = n_shot
 		self._as_chat = as_chat
 		self._shots = None
+		self._prefix = None
 
 	@property
 	def name(self):
@@ -203,6 +242,23 @@ class FewShotPrompting(ClientStrategy):
 					judge.hint(shot)
 				shots.append(shot)
 			self._shots = shots
+		self._prefix = None
+
+	@property
+	def prefix(self) -> Union[Tuple[JSONOBJ, ...], str]:
+		"""
+		The few-shot examples, which are the same for every problem (messages, or the joined text if not `as_chat`), so
+		they are only rendered once and clients with prompt caching can reuse them.
+		"""
+		if self._prefix is None:
+			first, *shots = self._shots
+			chat = [{'role': 'user', 'content': self.intro_template.fill(**first)},
+					{'role': 'assistant', 'content': self.answer_template.fill(**first)},]
+			for shot in shots:
+				chat.append({'role': 'user', 'content': self.question_template.fill(**shot)})
+				chat.append({'role': 'assistant', 'content': self.answer_template.fill(**shot)})
+			self._prefix = tuple(chat) if self._as_chat else '\n\n'.join(message['content'] for message in chat)
+		return self._prefix
 
 
 	def solve(self, problem: JSONOBJ) -> JSONOBJ:
@@ -211,17 +267,10 @@ class FewShotPrompting(ClientStrategy):
 			steps = [line.replace('\n', '\n\t') for line in problem['rationale']]
 			problem['rationale'] = '\n'.join(f'{i+1}. {line}' for i, line in enumerate(steps))
 
-		first, *shots = self._shots
-		chat = [{'role': 'user', 'content': self.intro_template.fill(**first)},
-				{'role': 'assistant', 'content': self.answer_template.fill(**first)},]
-		for shot in shots:
-			chat.append({'role': 'user', 'content': self.question_template.fill(**shot)})
-			chat.append({'role': 'assistant', 'content': self.answer_template.fill(**shot)})
-
-		chat.append({'role': 'user', 'content': self.question_template.fill(**problem)})
+		question = self.question_template.fill(**problem)
 
 		if self._as_chat:
-			chat = [*self.client.begin_chat(), *chat]
+			chat = [*self.client.begin_chat(), *map(dict, self.prefix), {'role': 'user', 'content': question}]
 
 			# response = self.client.get_response(chat, **self.params)
 			resp = self.client.step(chat, **self.params)
@@ -231,7 +280,7 @@ class FewShotPrompting(ClientStrategy):
 			return {'chat': chat, 'final': response}
 
 		else:
-			prompt = '\n\n'.join(message['content'] for message in chat)
+			prompt = f'{self.prefix}\n\n{question}'
 
 			# response = self.client.get_response(prompt, **self.params)
 			resp = self.client.step(prompt, **self.params)
@@ -1,8 +1,10 @@
 import json
+from functools import partial
 
 from .imports import *
 from ..abstract import AbstractTool
 from ..util import ToolError, parse_pythonic_tool_calls, parse_json_tool_calls
+from ..util.tools import ToolExecutor
 from .simple import ZeroShotPrompting
 
 
@@ -13,8 +15,12 @@ class ToolUse(ZeroShotPrompting):
 	"""
 	_name = 'tool'
 	def __init__(self, tools: Union[Dict[str, AbstractTool], Iterable[AbstractTool]] = None, max_turns: int = None,
-				 check_work: Optional[int] = 0,
+				 check_work: Optional[int] = 0, tool_workers: int = 4, tool_timeout: Optional[float] = None,
 				 **kwargs):
+		"""
+		:param tool_workers: number of tool calls (of one turn) which run concurrently (see `ToolExecutor`)
+		:param tool_timeout: seconds after which a tool call results in an error message
+		"""
 		if tools is None:
 			tools = []
 		elif isinstance(tools, dict):
@@ -25,6 +31,7 @@ class ToolUse(ZeroShotPrompting):
 		self._tool_stats = {}
 		self._max_turns = max_turns
 		self._check_work = check_work
+		self._executor = ToolExecutor(tool_workers, timeout=tool_timeout)
 		self.judge = None
 
 	def prepare(self, task: 'AbstractTask', judge: 'AbstractJudge' = None, **kwargs):
@@ -45,6 +52,7 @@ class ToolUse(ZeroShotPrompting):
 			'tool_code': self._tool_code,
 			'tools': {name: tool.json() for name, tool in self.tools.items()},
 			'check_work': self._check_work,
+			**({} if self._executor.timeout is None else {'tool_timeout': self._executor.timeout}),
 			**super().json()
 		}
 
@@ -53,8 +61,44 @@ class ToolUse(ZeroShotPrompting):
 		if status is None:
 			return None
 		status['tools'] = self._tool_stats
+		status['tool_latency'] = self._executor.stats()
 		return status
 
+	def close(self) -> None:
+		"""Stops the threads running the tool calls."""
+		self._executor.close()
+
+	@staticmethod
+	def _call_tool(tool: AbstractTool, arguments: JSONDATA) -> str:
+		try:
+			return tool.call(arguments)
+		except ToolError as e:
+			return str(e) if type(e) == ToolError else f'{e.__class__.__name__}: {e}'
+
+	def _run_tool_calls(self, calls: List[JSONOBJ]) -> List[Optional[Tuple[JSONDATA, str]]]:
+		"""
+		Runs the tool calls of one turn (concurrently), returns the (parsed) arguments and the result of each call, in
+		the order of the calls (None for unknown tools).
+		"""
+		outcomes = [None] * len(calls)
+		jobs, slots = [], []
+		for i, tool_call in enumerate(calls):
+			info = tool_call['function']
+			if info['name'] in self.tools:
+				tool = self.tools[info['name']]
+				arguments = info['arguments']
+				try:
+					while isinstance(arguments, str):
+						arguments = json.loads(arguments)
+				except json.JSONDecodeError as e:
+					outcomes[i] = arguments, f'JSONDecodeError: {e}'
+				else:
+					jobs.append((tool, partial(self._call_tool, tool, arguments)))
+					slots.append((i, arguments))
+		for (i, arguments), result in zip(slots, self._executor.run(jobs)):
+			outcomes[i] = arguments, result
+		return outcomes
+
 	def solve(self, problem: JSONOBJ) -> JSONOBJ:
 		tool_schemas = [tool.schema() for tool in self.tools.values()]
 		prompt = self.template.fill(
@@ -71,19 +115,10 @@ class ToolUse(ZeroShotPrompting):
 		for resp in self.client.multi_turn(chat, dict(tools=tool_schemas, tool_choice='none')):
 			msg = resp['choices'][0]['message']
 			if msg.get('tool_calls'):
-				for tool_call in msg.get('tool_calls'):
+				for tool_call, outcome in zip(msg['tool_calls'], self._run_tool_calls(msg['tool_calls'])):
 					info = tool_call['function']
-					if info['name'] in self.tools:
-						tool = self.tools[info['name']]
-						arguments = info['arguments']
-						try:
-							while isinstance(arguments, str):
-								arguments = json.loads(arguments)
-							result = tool.call(arguments)
-						except ToolError as e:
-							result = str(e) if type(e) == ToolError else f'{e.__class__.__name__}: {e}'
-						except json.JSONDecodeError as e:
-							result = f'JSONDecodeError: {e}'
+					if outcome is not None:
+						arguments, result = outcome
 						chat.append({'role': 'tool', 'content': result, 'tool_call_id': tool_call['id'], })#'name': info.name})
 						tool_calls.append({'name': info['name'],
 										   'arguments': str(arguments),
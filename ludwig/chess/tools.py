@@ -110,6 +110,8 @@ class DrawBoard(ToolBase):
 
 
 class StockfishTool(ToolBase):
+	max_concurrency = 1 # one engine per tool
+
 	def __init__(self, stockfish_path: Union[str, Path], **kwargs):
 		stockfish_path = Path(stockfish_path)
 		super().__init__(**kwargs)
@@ -3,7 +3,7 @@ import textwrap
 from .imports import *
 from ..abstract import DECISION
 from ..errors import OptionalMethodNotImplemented, ParsingError
-from ..util import PromptTemplate, ClientStats, TimeStats
+from ..util import PromptTemplate, ClientStats, TimeStats, AnswerDetector
 
 
 
@@ -186,6 +186,15 @@ class FormatJudge(JudgeBase):
 		ctx['task'] = self.format_description(ctx.get('task'))
 		ctx['answer'] = self.format_answer(ctx.get('answer'))
 
+	def _answer_pattern(self, problem: JSONOBJ) -> str:
+		options = self._options
+		if isinstance(options, str):
+			options = problem[options]
+		return self._answer_regex[self._style].format(options='|'.join(map(re.escape, options)))
+
+	def answer_detector(self, problem: JSONOBJ) -> Optional[AnswerDetector]:
+		return AnswerDetector(self._answer_pattern(problem))
+
 	# _final_answer_regex = r'\bFINAL\s+ANSWER\s*:\s*(yes|no)\b'
 	# _final_answer_regex = r'(?ix)\b(?:the|my)?\s*final\s+answers?\s*(?:is|are|[:=\-])?\s*\**(yes|no)\**\b'
 	# _final_answer_regex = r'(?ix)\b(?:the|my)?\s*final\s+answers?\s*(?:is|are|[:=\-])?\s*\**({options})\**\b'
@@ -197,13 +206,7 @@ class FormatJudge(JudgeBase):
 			return {'decision': None}
 		decision = None
 
-		options = self._options
-		if isinstance(options, str):
-			options = problem[options]
-
-		pattern = self._answer_regex[self._style].format(options='|'.join(map(re.escape,options)))
-
-		match = self._find_last(pattern, final.strip())
+		match = self._find_last(self._answer_pattern(problem), final.strip())
 		if match:
 			decision = match
 			# decision = match.group(1).lower().strip()
@@ -3,8 +3,10 @@ from ..abstract import AbstractTask, AbstractStrategy, AbstractProtocol
 from ..util import AbstractBroker, DefaultBroker
 # from ..base import Task, Strategy
 from ..util.stats import get_git_commit_hash
+from .workers import StepPool, rejudge_all
+from ..jsonutils import unflatten
 import pandas as pd
-from os import symlink, environ
+from os import symlink, environ, cpu_count
 
 try:
 	import wandb
@@ -23,6 +25,30 @@ def _view_score(score, fail_rate=None):
 	raise ValueError('score must be float or dict')
 
 
+def _latest_checkpoint(out_dir: Path) -> Path:
+	ckpts = list(out_dir.glob('ckpt-*'))
+	if len(ckpts) == 0:
+		raise ValueError(f'No checkpoints found in {out_dir}')
+	return max(ckpts, key=lambda p: (p.name, p.stat().st_mtime))
+
+
+def _read_log(log_path: Path, ckptpath: Path) -> Dict[int, str]:
+	"""
+	Maps the index of each sample in the checkpoint to its (raw) line in the log.
+
+	Lines are matched by their `idx` if it was logged, otherwise the i-th line belongs to the i-th sample in the history.
+	"""
+	with ckptpath.joinpath('protocol.json').open('r') as f:
+		indices = [idx for idx, *_ in json.load(f)['state']['history']]
+	with log_path.open('r') as f:
+		raw = [line for line in f if line.strip()]
+	if len(raw) and 'idx' in json.loads(raw[0]):
+		lines = {json.loads(line)['idx']: line for line in raw}
+		return {idx: lines[idx] for idx in indices if idx in lines}
+	if len(raw) != len(indices):
+		print(f'WARNING: {log_path} has {len(raw)} entries for {len(indices)} samples')
+	return dict(zip(indices, raw))
+
 @fig.script('eval', description='Evaluate a `task` on a `strategy` (i.e. model)')
 def eval_task(cfg: fig.Configuration):
 	"""
@@ -58,17 +84,18 @@ def eval_task(cfg: fig.Configuration):
 		loadcfg = fig.create_config(cfgpath)
 		loadcfg.update(cfg)
 		# find/load checkpoint
-		ckpts = list(out_dir.glob('ckpt-*'))
-		if len(ckpts) == 0:
-			raise ValueError(f'No checkpoints found in {out_dir}')
-		ckptpath = max(ckpts, key=lambda p: (p.name, p.stat().st_mtime))
+		ckptpath = _latest_checkpoint(out_dir)
 
 	protocol: AbstractProtocol = cfg.pull('protocol')
 
+	shard = cfg.pull('shard', None) # only evaluate shard `i/N` of the samples (combine them with `merge`)
+	if shard is not None:
+		protocol.set_shard(str(shard))
+
 	if ckptpath is not None:
 		if not ckptpath.exists():
 			raise ValueError(f'Checkpoint path {ckptpath} does not exist')
-		protocol.load_checkpoint(ckptpath)
+		protocol.load_checkpoint(path=ckptpath)
 
 	pbar: bool = cfg.pull('pbar', where_am_i() != 'cluster')
 	print_freq = None
@@ -93,6 +120,10 @@ def eval_task(cfg: fig.Configuration):
 
 	ckpt_freq = cfg.pulls('ckpt-freq', 'ckpt', default=None)
 	error_ckpt = cfg.pull('err-ckpt', True)
+	journal = cfg.pull('journal', False) # incremental checkpoints (in `ckpt-journal`)
+	workers = cfg.pull('workers', 1)
+	prefetch = cfg.pull('prefetch', 0) # number of upcoming problems to prepare in the background
+	timing_freq = cfg.pull('timing-freq', 100) # how often to dump `timing.json` if the protocol is timed
 
 	protocol.prepare()
 
@@ -185,13 +216,28 @@ def eval_task(cfg: fig.Configuration):
 	if pbar is None and print_freq is None:
 		print_freq = max(n_itr//200, 1)
 	num_digits = len(str(n_itr)) + 1
-	if out_dir is not None and ckpt_freq is not None:
+	if out_dir is not None and journal:
+		ckptpath = protocol.start_journal(out_dir / 'ckpt-journal', min_compact=ckpt_freq or 100)
+		if artifacts is not None:
+			with ckptpath.joinpath('artifacts.json').open('w') as f:
+				json.dump(artifacts, f)
+	elif out_dir is not None and ckpt_freq is not None:
 		ckptpath = out_dir / f'ckpt-{0:0{num_digits}}'
 		protocol.checkpoint(ckptpath)
 		if artifacts is not None:
 			with ckptpath.joinpath('artifacts.json').open('w') as f:
 				json.dump(artifacts, f)
 
+	timer = getattr(protocol, 'timer', None)
+
+	if prefetch:
+		protocol.start_prefetch(itr, depth=prefetch)
+
+	pool = None
+	if workers > 1:
+		pool = StepPool(protocol, itr, workers=workers)
+		print(f'Running {workers} samples concurrently')
+
 	if pbar: itr = tqdm(itr, desc=f'[score]')
 	ckpted = False
 	shutdown_time = time.time()
@@ -199,8 +245,12 @@ def eval_task(cfg: fig.Configuration):
 	for i in itr:
 		ckpted = False
 		try:
-			sample = protocol.step(i)
+			sample = protocol.step(i) if pool is None else pool.step(i)
 		except:
+			if pool is not None:
+				pool.close()
+			if prefetch:
+				protocol.stop_prefetch()
 			if out_dir is not None and error_ckpt:
 				ckptpath = out_dir / f'ckpt-{i:0{num_digits}}'
 				protocol.checkpoint(path=out_dir / f'error{i}')
@@ -208,12 +258,19 @@ def eval_task(cfg: fig.Configuration):
 			raise
 		if pbar and pbar_desc is not None:
 			itr.set_description(pformat(pbar_desc, sample))
+		if pbar and pool is not None:
+			itr.set_postfix_str(pool.describe())
 		if print_freq is not None:
 			raise NotImplementedError
 		if sample_logger is not None and len(logger):
+			start = time.perf_counter()
 			log = logger.extract(sample)
 			sample_logger.write(json.dumps(log) + '\n')
 			sample_logger.flush()
+			if timer is not None:
+				timer.record('log', time.perf_counter() - start)
+		if timer is not None and out_dir is not None and timing_freq and len(protocol.history) % timing_freq == 0:
+			timer.dump(out_dir)
 		if wandb_run is not None:
 			if viewer is not None and len(viewer):
 				viz = viewer.extract(sample)
@@ -223,14 +280,40 @@ def eval_task(cfg: fig.Configuration):
 		if wandb_run is not None and (time.time() - shutdown_time) >= shutdown_period:
 			shutdown_time = time.time()
 			if check_shutdown():
-				ckptpath = out_dir / f'ckpt-{i + 1:0{num_digits}}'
-				protocol.checkpoint(ckptpath)
+				if pool is not None:
+					pool.close()
+				if prefetch:
+					protocol.stop_prefetch()
+				if journal:
+					ckptpath = protocol.compact_journal()
+					protocol.close_journal()
+				else:
+					ckptpath = out_dir / f'ckpt-{i + 1:0{num_digits}}'
+					protocol.checkpoint(ckptpath)
 				print(f'Received shutdown signal, checkpointed at: {ckptpath}')
 				return
-		if out_dir is not None and i > 0 and ckpt_freq is not None and i % ckpt_freq == 0:
+		pos = len(protocol.history) - 1
+		boundary = ckpt_freq is None or (pos > 0 and pos % ckpt_freq == 0)
+		stop_reason = protocol.should_stop() if boundary else None
+		if out_dir is not None and not journal and boundary and ckpt_freq is not None:
 			ckptpath = out_dir / f'ckpt-{i + 1:0{num_digits}}'
 			protocol.checkpoint(ckptpath)
 			ckpted = True
+		if stop_reason is not None:
+			print(f'Stopping early: {stop_reason}')
+			break
+
+	if pool is not None:
+		pool.close()
+	if prefetch:
+		protocol.stop_prefetch()
+	for owner in (protocol.strategy, getattr(protocol.strategy, 'client', None)):
+		close = getattr(owner, 'close', None) # e.g. the threads running the tool calls
+		if close is not None:
+			close()
+
+	if timer is not None and out_dir is not None:
+		timer.dump(out_dir)
 
 	summary = protocol.summary()
 	if summary is not None:
@@ -244,8 +327,12 @@ def eval_task(cfg: fig.Configuration):
 		sample_logger.close()
 
 	if out_dir is not None and not ckpted:
-		ckptpath = out_dir / f'ckpt-{i + 1:0{num_digits}}'
-		protocol.checkpoint(ckptpath)
+		if journal:
+			ckptpath = protocol.compact_journal()
+			protocol.close_journal()
+		else:
+			ckptpath = out_dir / f'ckpt-{i + 1:0{num_digits}}'
+			protocol.checkpoint(ckptpath)
 		print(f'Checkpointed final state to {ckptpath}')
 		latest_ckpt = out_dir / 'ckpt-final'
 		if latest_ckpt.exists():
@@ -268,6 +355,157 @@ def eval_task(cfg: fig.Configuration):
 
 
 
+@fig.script('merge', description='Combine the outputs of a sharded `eval` into a single run')
+def merge_shards(cfg: fig.Configuration):
+	"""
+	Combine the output directories of all shards of an `eval` run (see `shard`) into a single run directory.
+
+	The status and summary are recomputed from the combined samples, so they match an unsharded run.
+
+	:param shards: The names of the shard output directories (in `root`) or a glob pattern matching them.
+	:param name: The name of the merged run (defaults to the name of the first shard without the shard suffix).
+	:return: the final results of the merged run.
+	"""
+	out_root = Path(cfg.pull('root'))
+	shards = cfg.pull('shards')
+	if isinstance(shards, str): # glob pattern
+		shard_dirs = sorted(out_root.glob(shards))
+		if len(shard_dirs) == 0:
+			raise ValueError(f'No shards found matching {shards!r} in {out_root}')
+	else:
+		shard_dirs = [out_root / name for name in shards]
+	for shard_dir in shard_dirs:
+		assert shard_dir.exists(), f'Shard {shard_dir} does not exist'
+	ckptpaths = [_latest_checkpoint(shard_dir).resolve() for shard_dir in shard_dirs]
+
+	loadcfg = fig.create_config(shard_dirs[0] / 'config.yaml')
+	loadcfg.update(cfg)
+	protocol: AbstractProtocol = loadcfg.pull('protocol')
+	protocol.prepare()
+	protocol.merge_shards(ckptpaths)
+
+	name = cfg.pull('name', shard_dirs[0].name.rsplit('_shard', 1)[0])
+	out_dir = out_root / name
+	out_dir.mkdir(exist_ok=cfg.pull('overwrite', False))
+	with out_dir.joinpath('config.yaml').open('w') as f:
+		f.write(str(loadcfg))
+	with out_dir.joinpath('shards.json').open('w') as f:
+		json.dump({shard_dir.name: str(ckptpath) for shard_dir, ckptpath in zip(shard_dirs, ckptpaths)}, f, indent=2)
+
+	lines = {}
+	for shard_dir, ckptpath in zip(shard_dirs, ckptpaths):
+		log_path = shard_dir / 'log.jsonl'
+		if log_path.exists():
+			lines.update(_read_log(log_path, ckptpath))
+	if lines:
+		with out_dir.joinpath('log.jsonl').open('w') as f:
+			f.writelines(lines[idx] for idx in sorted(lines))
+
+	indices = sorted(idx for idx, *_ in protocol.history)
+	if indices != list(range(len(indices))):
+		print(f'WARNING: the merged samples are not contiguous, so the merged run cannot be resumed')
+
+	ckptpath = protocol.checkpoint(out_dir / 'ckpt-merged')
+	latest_ckpt = out_dir / 'ckpt-final'
+	if latest_ckpt.exists():
+		latest_ckpt.unlink()
+	latest_ckpt.symlink_to(ckptpath.name)
+
+	summary = protocol.summary()
+	if summary is not None:
+		print(summary)
+	print(f'Merged {len(shard_dirs)} shards into {out_dir}')
+	return protocol.post_loop()
+
+
+
+@fig.script('rejudge', description='Judge the stored responses of an `eval` run again (without model requests)')
+def rejudge_run(cfg: fig.Configuration):
+	"""
+	Judge the responses in the log of a finished `eval` run again, e.g. after changing the judge or its patterns.
+
+	The problems are reconstructed with `task.ask` and the responses are judged in a process pool, so no model requests
+	are needed. The new status, summary and verdicts are written to a subdirectory of the run (see `name`).
+	Note that the log must contain the responses (i.e. the `table`), and the judge status (e.g. hit rate) only
+	counts the responses judged in this process (so it is only complete with `workers: 1`).
+
+	:param root: The root directory of the runs.
+	:param run: The name of the run to judge again (any settings passed here override the run's config).
+	:param name: The name of the subdirectory for the results.
+	:param workers: The number of processes to judge with (defaults to the number of cpus).
+	:return: the final results with the new verdicts.
+	"""
+	run_dir = Path(cfg.pull('root')) / cfg.pull('run')
+	ckptpath = _latest_checkpoint(run_dir).resolve()
+	log_path = run_dir / 'log.jsonl'
+	if not log_path.exists():
+		raise FileNotFoundError(f'Run {run_dir} has no log to judge')
+	with ckptpath.joinpath('protocol.json').open('r') as f:
+		data = json.load(f)
+
+	loadcfg = fig.create_config(run_dir / 'config.yaml')
+	loadcfg.update(cfg)
+	loadcfg.push('protocol.seed', data['json']['seed'], overwrite=False, silent=True)
+	protocol: AbstractProtocol = loadcfg.pull('protocol')
+	protocol.prepare_rejudge()
+
+	out_dir = run_dir / cfg.pull('name', 'rejudged')
+	overwrite = cfg.pull('overwrite', False)
+	if out_dir.exists() and not overwrite:
+		raise FileExistsError(f'{out_dir} already exists (set `overwrite` to replace it)')
+
+	history = data['state']['history']
+	lines = _read_log(log_path, ckptpath)
+	missing = [idx for idx, *_ in history if idx not in lines]
+	if missing:
+		raise ValueError(f'The log is missing {len(missing)} samples (e.g. {missing[:5]})')
+	jobs = []
+	unmarked = 0
+	for idx, failed, _ in history:
+		sample = unflatten(json.loads(lines[idx]))
+		response = protocol.stored_response(sample)
+		if response is None:
+			raise ValueError(f'The log does not contain the responses (`table`) of the samples')
+		if not failed:
+			unmarked += 'judged' not in sample.get('log', {})
+			jobs.append((idx, response))
+	if unmarked:
+		print(f'WARNING: {unmarked} logged samples do not list the fields added by the judge (`log.judged`), '
+			  f'so fields of their old judgement may remain when they are judged again')
+
+	workers = cfg.pull('workers', cpu_count() or 1)
+	start = time.time()
+	results = rejudge_all(protocol, jobs, workers=workers)
+	verdicts = {idx: result for (idx, _), result in zip(jobs, results)}
+	print(f'Judged {len(jobs)} responses in {time.time() - start:.1f}s')
+
+	out_dir.mkdir(exist_ok=True)
+	with out_dir.joinpath('config.yaml').open('w') as f:
+		f.write(str(loadcfg))
+
+	changed = 0
+	with out_dir.joinpath('verdicts.jsonl').open('w') as f:
+		for idx, failed, old in history:
+			judgement, verdict = verdicts.get(idx, (None, None))
+			score = protocol.record_verdict(idx, failed, verdict)
+			changed += score != old
+			f.write(json.dumps({'idx': idx, 'failed': failed, 'score': score, 'previous': old,
+								'judgement': judgement}) + '\n')
+	print(f'{changed}/{len(history)} scores changed')
+
+	status = protocol.status()
+	with out_dir.joinpath('status.json').open('w') as f:
+		json.dump(status, f, indent=2, sort_keys=True)
+	summary = protocol.summary()
+	if summary is not None:
+		with out_dir.joinpath('summary.txt').open('w') as f:
+			f.write(summary)
+		print(summary)
+	print(f'Results saved to {out_dir}')
+	return protocol.post_loop()
+
+
+
 @fig.script('validate', description='Check what a `task` is missing and what it implements')
 def validate_task(cfg: fig.Configuration):
 	"""
@@ -1,5 +1,41 @@
 from .imports import *
-from ..util import StubTask
+from ..util import StubTask, RunningStat, PhaseTimer
+from ..util.clients import StopAtAnswer
+from ..errors import OptionalMethodNotImplemented
+from .workers import Prefetcher
+from contextlib import nullcontext
+from statistics import NormalDist
+import math
+
+
+
+_unmergeable = object()
+def _merge_status(statuses: List[JSONDATA], weights: List[float], key: Optional[str] = None) -> JSONDATA:
+	"""
+	Combines the status of the same component in several shards: numbers are added (as counts), except that `min` and
+	`max` are the extremes and means (`mean` and rates like `hit_rate`) are weighted by the number of samples in each
+	shard. Other values are kept if they are the same in all shards and dropped otherwise.
+	"""
+	if all(isinstance(status, dict) for status in statuses):
+		merged = {}
+		for k in dict.fromkeys(k for status in statuses for k in status):
+			present = [(status[k], weight) for status, weight in zip(statuses, weights) if k in status]
+			value = _merge_status([v for v, _ in present], [w for _, w in present], k)
+			if value is not _unmergeable:
+				merged[k] = value
+		return merged
+	if all(isinstance(status, (int, float)) and not isinstance(status, bool) for status in statuses):
+		if key == 'min':
+			return min(statuses)
+		if key == 'max':
+			return max(statuses)
+		if key == 'mean' or (key or '').endswith('rate'):
+			total = sum(weights)
+			return sum(s * w for s, w in zip(statuses, weights)) / total if total else _unmergeable
+		return sum(statuses)
+	if all(status == statuses[0] for status in statuses):
+		return statuses[0]
+	return _unmergeable
 
 
 @fig.component('default-protocol')
@@ -9,7 +45,13 @@ class DefaultProtocol(ProtocolBase):
 				 seed: Optional[int] = random.randint(0, 2**31 - 1),
 				 # name: str = '{task.name}_{strategy.name}_{now:%y%m%d-%H%M%S}',
 				 name: str = '{task.name}_{strategy.name}_{now.strftime("%y%m%d-%H%M%S")}',
-				 include_gt_info: bool = False, **kwargs):
+				 include_gt_info: bool = False, timing: bool = False,
+				 stop_width: Optional[float] = None, stop_thresholds: Optional[Tuple[float, float]] = None,
+				 stop_error: float = 0.05, stop_min: int = 30, stop_at_answer: bool = False, **kwargs):
+		"""
+		:param stop_at_answer: stream the responses and stop generating as soon as the judge detects a complete answer
+		(only for judges with an `answer_detector`, like the `FormatJudge`)
+		"""
 		if isinstance(task, int):
 			task = self._default_task_type(task, seed=seed)
 		super().__init__(**kwargs)
@@ -22,13 +64,35 @@ class DefaultProtocol(ProtocolBase):
 		self._include_gt_info = include_gt_info
 		self._fail_rate = None
 		self._use_generate = None
+		self._shard = None
+		self._shard_status = None # status of the task, strategy and judge combined over all shards (see `merge_shards`)
 
 		self.metrics = None
 		self.history = None
 		self.scores = None
 		self.fails = None
+		self._score_stat = None # running summary of the (main) score, see `_default_stats`
+		self._score_key = None
+
+		self._journal = None
+		self._journal_path = None
+		self._journal_entries = 0
+		self._journal_min_compact = None
 
 		self._answer_type = None
+		self._ask_lock = threading.Lock()
+		self._prefetcher = None
+		self.timer = PhaseTimer() if timing else None # durations of the phases of each step
+
+		if stop_thresholds is not None:
+			low, high = stop_thresholds
+			assert 0 < low < high < 1, f'stop_thresholds must be two scores between 0 and 1, got {stop_thresholds}'
+		self._stop_width = stop_width
+		self._stop_thresholds = stop_thresholds
+		self._stop_error = stop_error
+		self._stop_min = stop_min
+		self._stop_reason = None
+		self._stop_at_answer = stop_at_answer
 
 		self._task = task
 		self._judge = judge
@@ -121,6 +185,8 @@ class DefaultProtocol(ProtocolBase):
 		if self._name is None:
 			self._name = pformat(self._name_template, protocol=self, task=self.task, strategy=self.strategy,
 								 judge=self.judge, now=self._now, seed=self._master_seed, unique=urandom(16).hex())
+			if self._shard is not None:
+				self._name = f'{self._name}_shard{self._shard[0]}-{self._shard[1]}'
 
 		# if root is not None:
 		# 	if path is None:
@@ -137,17 +203,36 @@ class DefaultProtocol(ProtocolBase):
 		# 	return path
 
 
+	def set_shard(self, shard: Union[str, Tuple[int, int]]) -> None:
+		"""
+		Restricts this protocol to shard `i` of `N` (formatted as `i/N`), i.e. the samples where `idx % N == i`.
+
+		The shards of a run can be combined afterwards using `merge_shards`.
+		"""
+		if isinstance(shard, str):
+			shard = shard.split('/')
+		index, count = map(int, shard)
+		if not 0 <= index < count:
+			raise ValueError(f'Invalid shard {index}/{count}, expected i/N with 0 <= i < N')
+		self._shard = (index, count)
+
 	def remaining_iterations(self, limit: Optional[int] = None) -> range:
-		"""(optional) Returns the number of iterations remaining in this protocol"""
+		"""
+		(optional) Returns the number of iterations remaining in this protocol
+
+		For a shard, the `limit` applies to the whole run (the shard only gets its part of the first `limit` samples),
+		so the merged shards match an unsharded run with the same limit.
+		"""
 		n = self.task.total_questions
-		if limit is None:
-			if n is None:
-				raise RuntimeError('Task has no total_questions and no limit was provided.')
-			return range(len(self.history), n)
-		past = len(self.history)
-		if n is None:
-			return range(past, past + limit)
-		return range(past, min(past + limit, n))
+		if limit is None and n is None:
+			raise RuntimeError('Task has no total_questions and no limit was provided.')
+		if self._shard is None:
+			start = len(self.history)
+			stop = n if limit is None else start + limit
+			return range(start, stop if n is None else min(stop, n))
+		index, count = self._shard
+		stop = n if limit is None else limit if n is None else min(limit, n)
+		return range(index + len(self.history) * count, stop, count)
 
 	def describe(self) -> str:
 		tbl = [
@@ -158,6 +243,8 @@ class DefaultProtocol(ProtocolBase):
 			('Judge', self.judge.name if self.judge is not None else 'None'),
 			('Random seed', self._master_seed),
 		]
+		if self._shard is not None:
+			tbl.append(('Shard', '{}/{}'.format(*self._shard)))
 		return tabulate(tbl)
 
 	def pre_loop(self) -> Optional[JSONOBJ]:
@@ -181,28 +268,48 @@ class DefaultProtocol(ProtocolBase):
 			artifacts['stats'] = stats
 
 		self._answer_type = spec.get('answer')
-		metrics = []
+		if not self.history: # otherwise the metrics were restored from a checkpoint
+			self.metrics = self._initial_metrics()
+		return artifacts
+
+	def _initial_metrics(self) -> Optional[Dict[str, RunningStat]]:
 		if isinstance(self._answer_type, list):
-			metrics = {key: [] for key in spec['answer']}
+			return {key: RunningStat() for key in self._answer_type}
 		elif self._answer_type == 'yes/no':
-			metrics = None
+			return None
 		elif self._answer_type is None:
-			metrics = None
+			return None
 		elif self._answer_type == 'option':
-			metrics = None
+			return None
 		elif self._answer_type == 'free-response':
 			raise NotImplementedError
 		else:
-			raise ValueError(f'Unknown answer type: {spec["answer"]}')
-
-		self.metrics = metrics
-		return artifacts
+			raise ValueError(f'Unknown answer type: {self._answer_type}')
 
 	def step(self, idx: int) -> JSONOBJ:
+		return self.record_step(idx, self.solve_step(idx))
+
+	def _answer_detector(self, problem: JSONOBJ) -> Optional['AnswerDetector']:
+		if self.judge is None:
+			return None
+		try:
+			return self.judge.answer_detector(problem)
+		except (OptionalMethodNotImplemented, AttributeError):
+			return None
+
+	def solve_step(self, idx: int) -> JSONOBJ:
+		"""
+		Runs the task, strategy and judge for sample `idx` without updating the protocol state.
+
+		This may be called for several indices at once (from different threads), as long as the results are passed to
+		`record_step` in index order.
+		"""
 		log = {}
 		proc = {}
+		durations = {}
 
-		problem = self.task.ask(idx)
+		with self._measure('ask', durations):
+			problem = self._ask(idx) if self._prefetcher is None else self._prefetcher.get(idx)
 		proc.update({key: problem.get(key) for key in self.task.store_keys()})
 		try:
 			public = {key: problem.get(key) for key in self.task.show_keys()}
@@ -212,8 +319,10 @@ class DefaultProtocol(ProtocolBase):
 		if self.judge is not None:
 			self.judge.hint(public)
 
+		detector = self._answer_detector(problem) if self._stop_at_answer else None
 		failed = False
-		with self.strategy.collect_stats() as stats:
+		with self.strategy.collect_stats() as stats, self._measure('solve', durations), \
+				(nullcontext() if detector is None else StopAtAnswer(detector)):
 			try:
 				response = self.strategy.solve(public)
 			except StrategyFailure as e:
@@ -231,33 +340,65 @@ class DefaultProtocol(ProtocolBase):
 			judgement = None
 		else:
 			with judge.collect_stats() as judge_stats:
-				judgement = judge.interpret(problem, response)
+				with self._measure('interpret', durations):
+					judgement = judge.interpret(problem, response)
 				if judgement is not None:
 					response.update(judgement)
-				verdict = judge.judge(problem, response)
+				with self._measure('judge', durations):
+					verdict = judge.judge(problem, response)
 			if len(judge_stats):
 				log['judge'] = judge_stats
 
 		proc.update(response)
 
-		result = self.task.resolve(problem, response)
+		with self._measure('resolve', durations):
+			result = self.task.resolve(problem, response)
 		if result is not None:
 			proc.update(result)
-
-		score = self._aggregate_verdict(idx, verdict)
+		judged = set(judgement or ()) | set(result or ())
+		if judged: # so `stored_response` can drop them before judging the response again
+			log['judged'] = sorted(judged)
+
+		return {'log': log, 'table': proc, 'failed': failed, 'verdict': verdict, 'durations': durations}
+
+	def _ask(self, idx: int) -> JSONOBJ:
+		with self._ask_lock:
+			return self.task.ask(idx)
+
+	def start_prefetch(self, indices: Iterable[int], *, depth: int = 1) -> None:
+		"""
+		Asks the task for the problems of the upcoming `indices` in the background (up to `depth` ahead), so that
+		preparing the next problems overlaps with solving the current ones.
+		"""
+		self.stop_prefetch()
+		self._prefetcher = Prefetcher(self._ask, indices, depth=depth)
+
+	def stop_prefetch(self) -> None:
+		if self._prefetcher is not None:
+			self._prefetcher.close()
+			self._prefetcher = None
+
+	def _measure(self, phase: str, durations: Dict[str, float]) -> ContextManager:
+		if self.timer is None:
+			return nullcontext()
+		return self.timer.measure(phase, durations)
+
+	def record_step(self, idx: int, outcome: JSONOBJ) -> JSONOBJ:
+		"""Updates the protocol state with the `outcome` of `solve_step` for sample `idx` and returns the sample."""
+		log, proc, failed = outcome['log'], outcome['table'], outcome['failed']
+		score = self._aggregate_verdict(idx, outcome['verdict'])
 		sample = {}
 		if len(log):
 			sample['log'] = log
 		if len(proc):
 			sample['table'] = proc
 		if self.metrics:
-			sample['metrics'] = self.metrics
+			sample['metrics'] = {key: stat.mean for key, stat in self.metrics.items() if stat.count}
+		if self.timer is not None and outcome.get('durations'):
+			self.timer.record_all(outcome['durations'])
+			sample['timing'] = outcome['durations']
 
-		self.history.append([idx, failed, score])
-		if failed:
-			self.fails.append(idx)
-		if score is not None:
-			self.scores.append(score)
+		self._record(idx, failed, score)
 		sample['idx'] = idx
 		sample['failed'] = failed
 		sample.update(self._default_stats())
@@ -265,16 +406,116 @@ class DefaultProtocol(ProtocolBase):
 			sample['score'] = 0
 		return sample
 
+	def _record(self, idx: int, failed: bool, score: JSONDATA) -> None:
+		self.history.append([idx, failed, score])
+		if failed:
+			self.fails.append(idx)
+		if score is not None:
+			self.scores.append(score)
+			self._track_score(score)
+		if self._journal is not None:
+			self._append_journal(idx, failed, score)
+
+	def _reset_state(self) -> None:
+		self.metrics = self._initial_metrics()
+		self.history, self.scores, self.fails = [], [], []
+		self._score_stat, self._score_key = None, None
+
+	def prepare_rejudge(self) -> None:
+		"""Prepares only the task and judge, to judge stored responses again (see `rejudge`)."""
+		self.task.prepare(self._master_seed)
+		if self.judge is not None:
+			self.judge.prepare(self.task)
+		self._answer_type = self.task.specification().get('answer')
+		self._reset_state()
+
+	@staticmethod
+	def stored_response(sample: JSONOBJ) -> Optional[JSONOBJ]:
+		"""
+		The response in a logged `sample` without the fields added by the judge and `task.resolve` (listed in
+		`log.judged`), so a new judgement can't mix with the old one.
+		"""
+		table = sample.get('table')
+		if table is None:
+			return None
+		judged = set(sample.get('log', {}).get('judged', ()))
+		return {key: value for key, value in table.items() if key not in judged}
+
+	def rejudge(self, idx: int, response: JSONOBJ) -> Tuple[Optional[JSONOBJ], JSONDATA]:
+		"""
+		Judges a stored `response` to problem `idx` again (the problem is reconstructed with `task.ask`), without any
+		model requests.
+
+		Returns the judgement (output of `judge.interpret`) and the verdict.
+		"""
+		judge = self.judge
+		if judge is None:
+			return None, None
+		problem = self._ask(idx)
+		response = response.copy()
+		judgement = judge.interpret(problem, response)
+		if judgement is not None:
+			response.update(judgement)
+		return judgement, judge.judge(problem, response)
+
+	def record_verdict(self, idx: int, failed: bool, verdict: JSONDATA) -> JSONDATA:
+		"""Updates the protocol state with a (new) `verdict` for sample `idx` and returns its score."""
+		score = self._aggregate_verdict(idx, verdict)
+		self._record(idx, failed, score)
+		return score
+
+	def _track_score(self, score: JSONDATA) -> None:
+		"""
+		Updates the running summary of the scores (in constant time). For dict scores, the main score is the first key
+		of the first score.
+		"""
+		if self._score_stat is None:
+			if isinstance(score, dict):
+				self._score_key = next(iter(score))
+			elif not isinstance(score, (int, float, bool)):
+				return
+			self._score_stat = RunningStat()
+		if self._score_key is None:
+			self._score_stat.add(score)
+		elif self._score_key in score:
+			self._score_stat.add(score[self._score_key])
+
+	def should_stop(self) -> Optional[str]:
+		"""
+		Checks whether the main score is known precisely enough to stop early (see `stop_width` and `stop_thresholds`),
+		and if so returns (and remembers) the reason.
+
+		With `stop_width`, the run stops once the (1-`stop_error`) confidence interval of the score is at most that wide.
+		With `stop_thresholds` (low, high), a sequential probability ratio test with error rates `stop_error` decides
+		whether the score is at most `low` or at least `high` (scores must be in [0, 1]).
+		"""
+		stat = self._score_stat
+		if stat is None or stat.count < self._stop_min:
+			return None
+		reason = None
+		if self._stop_width is not None:
+			low, high = stat.interval(z=NormalDist().inv_cdf(1 - self._stop_error / 2))
+			if high - low <= self._stop_width:
+				reason = f'interval width {high - low:.3f} <= {self._stop_width} after {stat.count} scores'
+		if reason is None and self._stop_thresholds is not None and 0 <= stat.min and stat.max <= 1:
+			low, high = self._stop_thresholds
+			# log likelihood ratio of `high` vs `low`, where each score is treated as a (fractional) success
+			llr = stat.total * math.log(high / low) + (stat.count - stat.total) * math.log((1 - high) / (1 - low))
+			bound = math.log((1 - self._stop_error) / self._stop_error)
+			if llr >= bound:
+				reason = f'score >= {high} (sequential test after {stat.count} scores)'
+			elif llr <= -bound:
+				reason = f'score <= {low} (sequential test after {stat.count} scores)'
+		if reason is not None:
+			self._stop_reason = reason
+		return reason
+
 	def _default_stats(self) -> JSONFLAT:
 		stats = {}
-		if len(self.scores) and isinstance(self.scores[0], (int, float, bool)):
-			stats['score'] = sum(self.scores) / len(self.scores)
-			stats['correct'] = sum(self.scores) / len(self.history)
-		elif len(self.scores) and isinstance(self.scores[0], dict):
-			key = next(iter(self.scores[0]))
-			vals = [score[key] for score in self.scores if key in score]
-			stats['score'] = sum(vals) / len(vals) if len(vals) else 0
-			stats['correct'] = sum(vals) / len(self.history) if len(vals) else 0
+		stat = self._score_stat
+		if stat is not None:
+			stats['score'] = stat.mean if stat.count else 0
+			stats['correct'] = stat.total / len(self.history) if stat.count else 0
 		stats['iterations'] = len(self.history)
 		stats['fails'] = len(self.fails)
 		stats['invalid'] = len(self.history) - len(self.scores)
@@ -288,9 +529,8 @@ class DefaultProtocol(ProtocolBase):
 		elif isinstance(self._answer_type, list):
 			for key, val in verdict.items():
 				if val is not None:
-					self.metrics.setdefault(key, []).append(val)
+					self.metrics.setdefault(key, RunningStat()).add(val)
 			return verdict
-			return {key: sum(vals) / len(vals) for key, vals in self.metrics.items() if len(vals)}
 		elif isinstance(verdict, (int, float)):
 			return verdict
 		elif self._answer_type is None:
@@ -319,15 +559,28 @@ class DefaultProtocol(ProtocolBase):
 			judge_status = self.judge.status()
 			if judge_status is not None:
 				info['judge'] = judge_status
+		if self._shard_status is not None:
+			info.update(self._shard_status)
 
+		intervals = {}
+		if self._score_stat is not None and self._score_stat.count:
+			intervals['score'] = dict(zip(('low', 'high'), self._score_stat.interval()))
 		if isinstance(self._answer_type, list):
-			info.update({key: sum(vals) / len(vals) for key, vals in self.metrics.items() if len(vals)})
+			info.update({key: stat.mean for key, stat in self.metrics.items() if stat.count})
+			intervals.update({key: dict(zip(('low', 'high'), stat.interval()))
+							  for key, stat in self.metrics.items() if stat.count})
 		elif self._answer_type is None:
 			pass
 		elif self._answer_type == 'yes/no' or self._answer_type == 'option':
 			pass
 		else:
 			raise ValueError(f'Unknown answer type: {self._answer_type}')
+		if intervals:
+			info['intervals'] = intervals
+		if self.timer is not None and self.timer.phases:
+			info['timing'] = self.timer.summary()
+		if self._stop_reason is not None:
+			info['stopped'] = self._stop_reason
 		return info
 
 	def summary(self) -> str:
@@ -360,6 +613,8 @@ class DefaultProtocol(ProtocolBase):
 			'model': self.strategy.model_name,
 			'judge': judge_json,
 			'seed': self._master_seed,
+			**({} if self._shard is None else {'shard': '{}/{}'.format(*self._shard)}),
+			**({'stop_at_answer': True} if self._stop_at_answer else {}),
 			'entra': self._extra_info,
 		**super().json()}
 
@@ -377,8 +632,10 @@ class DefaultProtocol(ProtocolBase):
 		strat_path = self.strategy.checkpoint(path.joinpath('strategy')).relative_to(path)
 
 		data = self._checkpoint_data(str(task_path), str(strat_path))
-		with path.joinpath('protocol.json').open('w') as f:
+		tmp = path.joinpath('protocol.json.tmp')
+		with tmp.open('w') as f:
 			json.dump(data, f, indent=2, sort_keys=True)
+		tmp.replace(path.joinpath('protocol.json'))
 
 		summary = self.summary()
 		if summary is not None:
@@ -400,8 +657,15 @@ class DefaultProtocol(ProtocolBase):
 			'scores': self.scores,
 			'fails': self.fails,
 			'history': self.history,
-			'metrics': self.metrics,
+			'metrics': None if self.metrics is None else {key: stat.json() for key, stat in self.metrics.items()},
+			'score_stat': None if self._score_stat is None else self._score_stat.json(),
+			'score_key': self._score_key,
+			'stop_reason': self._stop_reason,
 		}
+		if self._shard is not None:
+			data['state']['shard'] = list(self._shard)
+		if self._shard_status is not None:
+			data['state']['shard_status'] = self._shard_status
 		return data
 
 	def load_checkpoint(self, *, path: Path = None, data: Any = None, unsafe: bool = True) -> Optional[Path]:
@@ -414,8 +678,114 @@ class DefaultProtocol(ProtocolBase):
 		with path.joinpath('protocol.json').open('r') as f:
 			data = json.load(f)
 		self._load_checkpoint_data(data, skip_subs=True, unsafe=unsafe)
+		self._replay_journal(path)
 		return path
 
+	def _replay_journal(self, path: Path) -> None:
+		journal = path.joinpath(self._journal_name)
+		if journal.exists():
+			with journal.open('r') as f:
+				for line in f:
+					try:
+						pos, idx, failed, score = json.loads(line)
+					except json.JSONDecodeError: # the last write was interrupted
+						break
+					# entries which were already folded into the snapshot are skipped
+					if pos == len(self.history):
+						self._replay_entry(idx, failed, score)
+
+	def merge_shards(self, paths: Iterable[Path]) -> None:
+		"""
+		Combines the checkpoints (directories) of all shards of a run into this protocol, so that the state (and thereby
+		`status` and `summary`) is the same as if all samples had been evaluated by a single process.
+
+		The task and strategy are restored from the checkpoint of the first shard, while their status (and that of the
+		judge) is combined over all shards (see `_merge_status`).
+		"""
+		shards = {}
+		for path in paths:
+			with path.joinpath('protocol.json').open('r') as f:
+				data = json.load(f)
+			self._load_checkpoint_data(data, skip_subs=True)
+			self._replay_journal(path)
+			if 'shard' not in data.get('state', {}):
+				raise ValueError(f'Checkpoint {path} is not from a sharded run')
+			index, count = data['state']['shard']
+			if index in shards:
+				raise ValueError(f'Shard {index}/{count} was provided more than once ({shards[index][0]} and {path})')
+			shards[index] = path, count, self.history, data.get('status', {})
+		counts = {count for _, count, _, _ in shards.values()}
+		if len(counts) != 1:
+			raise ValueError(f'Shards come from runs with a different number of shards: {sorted(counts)}')
+		count = counts.pop()
+		missing = [index for index in range(count) if index not in shards]
+		if missing:
+			raise ValueError(f'Missing shards (of {count}): {missing}')
+
+		first = shards[0][0]
+		self.task.load_checkpoint(path=first / 'task')
+		self.strategy.load_checkpoint(path=first / 'strategy')
+
+		self._shard = None
+		self._answer_type = self.task.specification().get('answer')
+		self._reset_state()
+		for idx, failed, score in sorted((entry for _, _, history, _ in shards.values() for entry in history),
+										 key=lambda entry: entry[0]):
+			self._replay_entry(idx, failed, score)
+		parts = [shards[index] for index in range(count)]
+		self._shard_status = {}
+		for key in ['task', 'strategy', 'judge']:
+			present = [(status[key], len(history)) for _, _, history, status in parts if key in status]
+			if present:
+				self._shard_status[key] = _merge_status(*map(list, zip(*present)))
+
+	_journal_name = 'journal.jsonl'
+	def start_journal(self, path: Path, *, min_compact: int = 100) -> Path:
+		"""
+		Switches to incremental checkpoints in the directory `path`.
+
+		Every recorded step is appended to a journal, and the journal is folded into a full snapshot (see `checkpoint`)
+		once it is at least as long as the snapshot, so checkpointing takes constant time per step (amortized).
+		`load_checkpoint(path=path)` restores the state from the snapshot and the journal.
+		"""
+		self._journal_path = path
+		self._journal_min_compact = min_compact
+		return self.compact_journal()
+
+	def compact_journal(self) -> Path:
+		"""Writes a snapshot of the current state and starts a new (empty) journal."""
+		assert self._journal_path is not None, 'No journal has been started'
+		self.close_journal()
+		self.checkpoint(self._journal_path)
+		self._journal = self._journal_path.joinpath(self._journal_name).open('w')
+		self._journal_entries = 0
+		return self._journal_path
+
+	def close_journal(self) -> None:
+		if self._journal is not None:
+			self._journal.close()
+			self._journal = None
+
+	def _append_journal(self, idx: int, failed: bool, score: JSONDATA) -> None:
+		pos = len(self.history) - 1
+		self._journal.write(json.dumps([pos, idx, failed, score], separators=(',', ':')) + '\n')
+		self._journal.flush()
+		self._journal_entries += 1
+		if self._journal_entries >= max(self._journal_min_compact, pos + 1 - self._journal_entries):
+			self.compact_journal()
+
+	def _replay_entry(self, idx: int, failed: bool, score: JSONDATA) -> None:
+		self.history.append([idx, failed, score])
+		if failed:
+			self.fails.append(idx)
+		if score is not None:
+			self.scores.append(score)
+			self._track_score(score)
+			if isinstance(score, dict) and self.metrics is not None:
+				for key, val in score.items():
+					if val is not None:
+						self.metrics.setdefault(key, RunningStat()).add(val)
+
 	def _load_checkpoint_data(self, data: JSONOBJ, *, skip_subs: bool = False, unsafe: bool = True) -> None:
 		super()._load_checkpoint_data(data)
 		if not skip_subs:
@@ -427,7 +797,22 @@ class DefaultProtocol(ProtocolBase):
 		self.scores = state.get('scores', [])
 		self.fails = state.get('fails', [])
 		self.history = state.get('history', [])
-		self.metrics = state.get('metrics', {})
+		metrics = state.get('metrics', {})
+		self.metrics = None if metrics is None else {
+			# older checkpoints contain all the values
+			key: RunningStat.from_values(vals) if isinstance(vals, list) else RunningStat.from_json(vals)
+			for key, vals in metrics.items()}
+		self._score_key = state.get('score_key')
+		self._stop_reason = state.get('stop_reason')
+		if 'score_stat' in state:
+			self._score_stat = None if state['score_stat'] is None else RunningStat.from_json(state['score_stat'])
+		else:
+			self._score_stat = None
+			for score in self.scores:
+				self._track_score(score)
+		if 'shard' in state:
+			self._shard = tuple(state['shard'])
+		self._shard_status = state.get('shard_status')
 
 
 
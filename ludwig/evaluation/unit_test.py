@@ -0,0 +1,348 @@
+import os
+import time
+import random
+
+from .imports import *
+from .protocol import DefaultProtocol
+from .workers import StepPool, Prefetcher, rejudge_all
+from ..util.blanks import StubTask
+from ..util.clients import MockEndpoint, OpenaiClientBase
+from ..baselines.simple import ZeroShotPrompting, SimpleMajorityVote
+from ..util.stats import EmptyStats
+
+
+class _SlowMock(MockEndpoint):
+	def _send(self, data: JSONOBJ) -> JSONOBJ:
+		time.sleep(random.random() * 0.02)
+		return super()._send(data)
+
+
+class _FakeOpenai(OpenaiClientBase):
+	"""Pretends to be an openai endpoint, where the number of output tokens is the length of the prompt."""
+	def __init__(self, **kwargs):
+		super().__init__(endpoint='http://localhost:0/v1', max_tokens=16, **kwargs)
+		self._model_name = 'fake'
+
+	def prepare(self) -> 'Self':
+		self.history = []
+		self._tokenizer = None
+		return self
+
+	def _send(self, data: JSONOBJ) -> JSONOBJ:
+		time.sleep(random.random() * 0.02)
+		content = data['messages'][-1]['content']
+		return {'choices': [{'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+				'usage': {'prompt_tokens': 1, 'completion_tokens': len(content)}}
+
+
+def _make_protocol(client, n: int = 12) -> DefaultProtocol:
+	protocol = DefaultProtocol(StubTask(n), ZeroShotPrompting(client=client, template='q{index}'), seed=11)
+	protocol.prepare()
+	protocol.pre_loop()
+	return protocol
+
+
+def _strip_times(sample: JSONOBJ) -> JSONOBJ:
+	sample = json.loads(json.dumps(sample))
+	sample.get('log', {}).pop('time', None)
+	sample.get('log', {}).pop('tok_per_sec', None)
+	return sample
+
+
+def test_step_pool_matches_sequential():
+	sequential = _make_protocol(_SlowMock())
+	expected = [sequential.step(i) for i in sequential.remaining_iterations()]
+
+	protocol = _make_protocol(_SlowMock())
+	with StepPool(protocol, protocol.remaining_iterations(), workers=4) as pool:
+		samples = [pool.step(i) for i in protocol.remaining_iterations()]
+		assert pool.completed == len(samples)
+
+	assert [_strip_times(s) for s in samples] == [_strip_times(s) for s in expected]
+	assert protocol.history == sequential.history
+	assert protocol.fails == sequential.fails
+
+
+def test_concurrent_client_stats():
+	client = _FakeOpenai()
+	protocol = _make_protocol(client, n=20)
+
+	with StepPool(protocol, protocol.remaining_iterations(), workers=6) as pool:
+		samples = [pool.step(i) for i in protocol.remaining_iterations()]
+
+	for sample in samples:
+		assert sample['log']['requests'] == 1
+		assert sample['log']['output_tokens'] == len(f'q{sample["idx"]}')
+	assert client.stats()['requests'] == 20
+
+
+def test_journal_checkpoint(tmp_path):
+	path = tmp_path / 'ckpt-journal'
+
+	protocol = _make_protocol(MockEndpoint(), n=40)
+	protocol.start_journal(path, min_compact=4)
+	for i in range(27):
+		protocol.step(i)
+	# simulate a crash, so the last steps are only in the journal
+	protocol._journal.close()
+	assert len(path.joinpath('journal.jsonl').read_text().splitlines()) > 0
+
+	resumed = _make_protocol(MockEndpoint(), n=40)
+	resumed.load_checkpoint(path=path)
+	assert resumed.history == protocol.history
+	assert resumed.remaining_iterations() == range(27, 40)
+	assert resumed.status() == protocol.status()
+
+	# an interrupted write of the last entry is ignored
+	with path.joinpath('journal.jsonl').open('a') as f:
+		f.write('[27, 27, fal')
+	resumed = _make_protocol(MockEndpoint(), n=40)
+	resumed.load_checkpoint(path=path)
+	assert resumed.history == protocol.history
+
+
+class _CountingMock(MockEndpoint):
+	def stats(self, starting_from=0, scope=None):
+		tokens = [h['output_tokens'] for h in self.history[starting_from:]]
+		if not tokens:
+			return {'requests': 0, 'model': self.ident}
+		return {'requests': len(tokens), 'model': self.ident,
+				'tokens': {'mean': sum(tokens) / len(tokens), 'min': min(tokens), 'max': max(tokens)}}
+
+
+def test_merge_shards(tmp_path):
+	full = _make_protocol(MockEndpoint(), n=10)
+	for i in full.remaining_iterations():
+		full.step(i)
+
+	paths = []
+	for index in range(3):
+		protocol = DefaultProtocol(StubTask(10), ZeroShotPrompting(client=MockEndpoint(), template='q{index}'), seed=11)
+		protocol.set_shard(f'{index}/3')
+		protocol.prepare()
+		protocol.pre_loop()
+		itr = protocol.remaining_iterations()
+		assert list(itr) == list(range(index, 10, 3))
+		for i in itr:
+			protocol.step(i)
+		paths.append(protocol.checkpoint(tmp_path / f'shard{index}'))
+
+	merged = _make_protocol(MockEndpoint(), n=10)
+	merged.merge_shards(reversed(paths))
+	assert merged.history == full.history
+	assert merged.summary() == full.summary()
+	assert not merged.remaining_iterations()
+
+	# with a limit, the shards together cover the same samples as an unsharded run
+	limited = _make_protocol(MockEndpoint(), n=10)
+	for i in limited.remaining_iterations(limit=5):
+		limited.step(i)
+	paths = []
+	for index in range(3):
+		protocol = DefaultProtocol(StubTask(10), ZeroShotPrompting(client=MockEndpoint(), template='q{index}'), seed=11)
+		protocol.set_shard(f'{index}/3')
+		protocol.prepare()
+		protocol.pre_loop()
+		for i in protocol.remaining_iterations(limit=5):
+			protocol.step(i)
+		assert protocol.remaining_iterations(limit=5) == range(index + 3 * len(protocol.history), 5, 3)
+		paths.append(protocol.checkpoint(tmp_path / f'limited{index}'))
+	merged = _make_protocol(MockEndpoint(), n=10)
+	merged.merge_shards(paths)
+	assert merged.history == limited.history and len(merged.history) == 5
+	assert merged.summary() == limited.summary()
+
+	# the client usage of the strategy is combined over all shards, not taken from the first one
+	full = DefaultProtocol(StubTask(10), ZeroShotPrompting(client=_CountingMock(), template='q{index}'), seed=11)
+	full.prepare()
+	full.pre_loop()
+	for i in full.remaining_iterations():
+		full.step(i)
+	paths = []
+	for index in range(3):
+		protocol = DefaultProtocol(StubTask(10), ZeroShotPrompting(client=_CountingMock(), template='q{index}'), seed=11)
+		protocol.set_shard(f'{index}/3')
+		protocol.prepare()
+		protocol.pre_loop()
+		for i in protocol.remaining_iterations():
+			protocol.step(i)
+		paths.append(protocol.checkpoint(tmp_path / f'counted{index}'))
+	merged = DefaultProtocol(StubTask(10), ZeroShotPrompting(client=_CountingMock(), template='q{index}'), seed=11)
+	merged.prepare()
+	merged.merge_shards(paths)
+	expected, client = full.status()['strategy']['client'], merged.status()['strategy']['client']
+	assert client['requests'] == expected['requests'] == 10 and client['model'] == expected['model']
+	assert (client['tokens']['min'], client['tokens']['max']) == (expected['tokens']['min'], expected['tokens']['max'])
+	assert abs(client['tokens']['mean'] - expected['tokens']['mean']) < 1e-9
+	restored = DefaultProtocol(StubTask(10), ZeroShotPrompting(client=_CountingMock(), template='q{index}'), seed=11)
+	restored.load_checkpoint(path=merged.checkpoint(tmp_path / 'merged'))
+	assert restored.status()['strategy'] == merged.status()['strategy']
+
+
+def test_early_stopping():
+	def protocol_with(scores, **kwargs):
+		protocol = DefaultProtocol(StubTask(1000), ZeroShotPrompting(client=MockEndpoint(), template='q{index}'),
+								   seed=11, **kwargs)
+		protocol.prepare()
+		for idx, score in enumerate(scores):
+			protocol._replay_entry(idx, False, score)
+		return protocol
+
+	scores = [i % 10 == 0 for i in range(400)]
+	assert protocol_with(scores[:20], stop_width=0.1).should_stop() is None # too few samples
+	assert protocol_with(scores[:100], stop_width=0.1).should_stop() is None
+	protocol = protocol_with(scores, stop_width=0.1)
+	assert protocol.should_stop() is not None and 'stopped' in protocol.status()
+
+	assert 'score <= 0.3' in protocol_with(scores[:60], stop_thresholds=(0.3, 0.5)).should_stop()
+	assert protocol_with([True, False] * 40, stop_thresholds=(0.3, 0.7)).should_stop() is None
+
+
+def test_prefetch():
+	def ask(idx):
+		if idx == 3:
+			raise ValueError(idx)
+		return idx * 10
+
+	prefetcher = Prefetcher(ask, range(6), depth=2)
+	assert prefetcher.get(0) == 0 and prefetcher.get(2) == 20
+	try:
+		prefetcher.get(3)
+	except ValueError as e:
+		assert e.args == (3,)
+	else:
+		assert False, 'exception was not propagated'
+	assert prefetcher.get(5) == 50 and prefetcher.get(9) == 90
+	prefetcher.close()
+
+	sequential = _make_protocol(_SlowMock())
+	expected = [sequential.step(i) for i in sequential.remaining_iterations()]
+	protocol = _make_protocol(_SlowMock())
+	protocol.start_prefetch(protocol.remaining_iterations(), depth=3)
+	with StepPool(protocol, protocol.remaining_iterations(), workers=2) as pool:
+		samples = [pool.step(i) for i in protocol.remaining_iterations()]
+	protocol.stop_prefetch()
+	assert [_strip_times(s) for s in samples] == [_strip_times(s) for s in expected]
+
+
+class _ParityJudge:
+	def rejudge(self, idx, response):
+		if response.get('fail'):
+			raise ValueError(idx)
+		if response.get('crash'):
+			os._exit(1)
+		return {'decision': response['final']}, (idx + len(response['final'])) % 2 == 0
+
+
+def test_rejudge_all():
+	jobs = [(idx, {'final': 'x' * (idx % 3)}) for idx in range(23)]
+	expected = [_ParityJudge().rejudge(*job) for job in jobs]
+	assert rejudge_all(_ParityJudge(), jobs, workers=4) == expected
+
+	try:
+		rejudge_all(_ParityJudge(), jobs + [(23, {'fail': True})], workers=3)
+	except RuntimeError as e:
+		assert 'ValueError: 23' in str(e)
+	else:
+		assert False, 'exception was not propagated'
+
+	try:
+		rejudge_all(_ParityJudge(), jobs + [(23, {'crash': True})], workers=3, poll_interval=0.05)
+	except RuntimeError as e:
+		assert 'worker 2 died' in str(e)
+	else:
+		assert False, 'a dead worker must not block'
+
+
+class _SeededMock(MockEndpoint):
+	"""Answers depend only on the seed of the request."""
+	seed = 7
+
+	def wrap_chat(self, chat, params=None):
+		return {'chat': chat, 'seed': (params or {}).get('seed')}
+
+	def _send(self, data):
+		time.sleep(random.random() * 0.02)
+		seed = data['seed']
+		answer = 'invalid' if seed % 5 == 0 else 'B' if seed % 3 == 0 else 'A'
+		return {'choices': [{'message': {'role': 'assistant', 'content': answer}}]}
+
+
+class _LengthJudge:
+	"""Accepts answers of the given length, and flags (and rejects) long answers if `strict`."""
+	def __init__(self, length, strict=False):
+		self.length = length
+		self.strict = strict
+
+	def prepare(self, task):
+		pass
+
+	def format_description(self, description):
+		return description
+
+	def hint(self, public):
+		pass
+
+	def collect_stats(self):
+		return EmptyStats()
+
+	def status(self):
+		return {}
+
+	def interpret(self, problem, response):
+		judgement = {'decision': len(response['final'])}
+		if self.strict and len(response['final']) > self.length:
+			judgement['too_long'] = True
+		return judgement
+
+	def judge(self, problem, response):
+		return response['decision'] == self.length and not response.get('too_long')
+
+
+def test_rejudge_with_another_judge():
+	protocol = DefaultProtocol(StubTask(6), ZeroShotPrompting(client=MockEndpoint(), template='q{index}'),
+							   _LengthJudge(2, strict=True), seed=11)
+	protocol.prepare()
+	protocol.pre_loop()
+	samples = [json.loads(json.dumps(protocol.step(i))) for i in protocol.remaining_iterations()]
+	assert all(sample['table'].get('too_long') and not sample['score'] for sample in samples)
+
+	lenient = _LengthJudge(len(samples[0]['table']['final']))
+	for sample in samples:
+		response = DefaultProtocol.stored_response(sample)
+		assert 'decision' not in response and 'too_long' not in response
+	rejudger = DefaultProtocol(StubTask(6), ZeroShotPrompting(client=MockEndpoint(), template='q{index}'), lenient,
+							   seed=11)
+	rejudger.prepare_rejudge()
+	verdicts = rejudge_all(rejudger, [(idx, DefaultProtocol.stored_response(s)) for idx, s in enumerate(samples)])
+	assert all(judgement == {'decision': lenient.length} for judgement, _ in verdicts)
+	assert all(verdict for _, verdict in verdicts) # the old `too_long` flags are gone
+
+
+class _VoteJudge:
+	def interpret(self, problem, response):
+		return {} if response['final'] == 'invalid' else {'decision': response['final']}
+
+	def format_answer(self, decision):
+		return decision
+
+	def collect_stats(self):
+		return EmptyStats()
+
+
+def test_majority_vote():
+	def vote(**kwargs):
+		strategy = SimpleMajorityVote(client=_SeededMock(), template='q{index}', n_votes=15, **kwargs)
+		strategy._judge = _VoteJudge()
+		return strategy.solve({'index': 0})
+
+	sequential = vote(vote_workers=1)
+	parallel = vote()
+	assert parallel['tally'] == sequential['tally'] and parallel['failed_votes'] == sequential['failed_votes']
+	assert [v['final'] for v in parallel['votes']] == [v['final'] for v in sequential['votes']]
+	assert sequential['final'] == 'A' and sequential['failed_votes'] > 0
+
+	adaptive = vote(adaptive=True, vote_workers=4)
+	assert adaptive['final'] == 'A' and adaptive['skipped_votes'] > 0
+	assert len(adaptive['votes']) + adaptive['skipped_votes'] == 15
+	assert adaptive['failed_votes'] == sum('decision' not in v for v in adaptive['votes'])
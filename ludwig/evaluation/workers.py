@@ -0,0 +1,155 @@
+from .imports import *
+from concurrent.futures import ThreadPoolExecutor, Future
+import multiprocessing
+from queue import Empty
+from ..abstract import AbstractProtocol
+
+
+
+class StepPool:
+	"""
+	Runs `protocol.solve_step` for upcoming indices on a bounded thread pool, while `step` still returns the samples
+	(and updates the protocol state) strictly in index order.
+	"""
+	def __init__(self, protocol: AbstractProtocol, indices: Iterable[int], *, workers: int = 1):
+		assert workers > 0, f'workers must be a positive integer, got {workers}'
+		self.protocol = protocol
+		self.workers = workers
+		self._indices = iter(indices)
+		self._pending: Dict[int, Future] = {}
+		self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='eval-worker')
+		self.completed = 0
+
+	@property
+	def in_flight(self) -> int:
+		"""Number of samples that have been submitted but not yet recorded."""
+		return len(self._pending)
+
+	def describe(self) -> str:
+		return f'{self.in_flight} in flight, {self.completed} done'
+
+	def _fill(self) -> None:
+		while len(self._pending) < self.workers:
+			idx = next(self._indices, None)
+			if idx is None:
+				break
+			self._pending[idx] = self._executor.submit(self.protocol.solve_step, idx)
+
+	def step(self, idx: int) -> JSONOBJ:
+		"""Waits for sample `idx` (submitting it if necessary) and records it in the protocol."""
+		self._fill()
+		if idx not in self._pending:
+			self._pending[idx] = self._executor.submit(self.protocol.solve_step, idx)
+		future = self._pending.pop(idx)
+		self._fill()
+		outcome = future.result()
+		sample = self.protocol.record_step(idx, outcome)
+		self.completed += 1
+		return sample
+
+	def close(self) -> None:
+		"""Cancels all samples that have not started yet and waits for the running ones to finish."""
+		for future in self._pending.values():
+			future.cancel()
+		self._pending.clear()
+		self._executor.shutdown(wait=True, cancel_futures=True)
+
+	def __enter__(self) -> 'StepPool':
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+
+class Prefetcher:
+	"""
+	Computes `fn(idx)` for the upcoming `indices` (in order) on a single background thread, keeping at most `depth`
+	results ahead of the consumer.
+
+	`get(idx)` returns the result for `idx` or raises the exception `fn(idx)` raised.
+	"""
+	def __init__(self, fn: Callable[[int], Any], indices: Iterable[int], *, depth: int = 1):
+		assert depth > 0, f'depth must be a positive integer, got {depth}'
+		self.fn = fn
+		self.depth = depth
+		self._indices = iter(indices)
+		self._last = None
+		self._pending: Dict[int, Future] = {}
+		self._lock = threading.Lock()
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+
+	def _fill(self, upto: Optional[int] = None) -> None:
+		while len(self._pending) < self.depth or (upto is not None and (self._last is None or self._last < upto)):
+			idx = next(self._indices, None)
+			if idx is None:
+				break
+			self._pending[idx] = self._executor.submit(self.fn, idx)
+			self._last = idx
+
+	def get(self, idx: int) -> Any:
+		with self._lock:
+			self._fill(upto=idx)
+			future = self._pending.pop(idx, None)
+			self._fill()
+		if future is None: # not one of the upcoming indices
+			return self.fn(idx)
+		return future.result()
+
+	def close(self) -> None:
+		with self._lock:
+			for future in self._pending.values():
+				future.cancel()
+			self._pending.clear()
+		self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+
+def _rejudge_chunk(protocol: AbstractProtocol, chunk: int, jobs: Sequence[Tuple[int, JSONOBJ]], queue) -> None:
+	try:
+		queue.put((chunk, [protocol.rejudge(*job) for job in jobs], None))
+	except Exception:
+		queue.put((chunk, None, traceback.format_exc()))
+
+
+def rejudge_all(protocol: AbstractProtocol, jobs: Sequence[Tuple[int, JSONOBJ]], *, workers: int = 1,
+				poll_interval: float = 1.) -> List[Tuple[Optional[JSONOBJ], JSONDATA]]:
+	"""
+	Runs `protocol.rejudge(idx, response)` for all `jobs` using `workers` processes. The responses should not contain
+	the fields of their old judgement anymore (see `DefaultProtocol.stored_response`).
+
+	The processes are forked, so they share the prepared task and judge of the `protocol` (and only the results have to
+	be sent back). A worker that dies without sending its results (e.g. killed for running out of memory) raises an
+	error instead of blocking forever.
+	"""
+	workers = min(workers, len(jobs))
+	if workers <= 1:
+		return [protocol.rejudge(*job) for job in jobs]
+	ctx = multiprocessing.get_context('fork')
+	queue = ctx.Queue()
+	size = -(-len(jobs) // workers)
+	procs = [ctx.Process(target=_rejudge_chunk, args=(protocol, chunk, jobs[chunk * size:(chunk + 1) * size], queue),
+						 daemon=True) for chunk in range(workers)]
+	for proc in procs:
+		proc.start()
+	results = {}
+	try:
+		while len(results) < len(procs):
+			# results are sent before a worker exits, so any from workers that were already gone must be in the queue
+			dead = [chunk for chunk, proc in enumerate(procs) if chunk not in results and proc.exitcode is not None]
+			try:
+				chunk, outputs, error = queue.get(timeout=poll_interval)
+			except Empty:
+				if dead:
+					raise RuntimeError(f'Rejudging worker {dead[0]} died without sending its results '
+									   f'(exit code {procs[dead[0]].exitcode})')
+				continue
+			if error is not None:
+				raise RuntimeError(f'Rejudging failed in a worker:\n{error}')
+			results[chunk] = outputs
+	finally:
+		for proc in procs:
+			if proc.is_alive():
+				proc.terminate()
+			proc.join()
+	return [output for chunk in range(workers) for output in results[chunk]]
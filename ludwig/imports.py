@@ -1,11 +1,12 @@
 # Shared imports
-from typing import Any, Tuple, ContextManager, Generator, Callable, TypeVar, Sequence, Type, Union, Dict, List, Optional, Iterator, Iterable
+from typing import Any, Tuple, ContextManager, Generator, Callable, TypeVar, Sequence, Type, Union, Dict, List, Optional, Iterator, Iterable, AsyncIterator
 from pathlib import Path
 from omnibelt import where_am_i, pformat, colorize
 import random
 import json
 import yaml
 import time
+import threading
 from os import urandom
 import traceback
 import re
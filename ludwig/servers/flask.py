@@ -10,7 +10,7 @@ from pprint import pprint  # Added for pretty printing
 # In your actual project, these would be imported.
 from ..abstract import AbstractStrategy, AbstractJudge, AbstractTask, JSONDATA, JSONOBJ
 from ..errors import StrategyFailure
-from ..util import vllm_Client, AbstractClient, PromptTemplate
+from ..util import vllm_Client, MultiVllm_Client, AbstractClient, PromptTemplate
 
 
 class GameBase(fig.Configurable):
@@ -388,6 +388,8 @@ def launch_backend(cfg: fig.Configuration):
 	for client in raw_clients:
 		if isinstance(client, (str, int)):
 			client = vllm_Client(addr=client)
+		elif isinstance(client, (list, tuple)): # replicas of the same model
+			client = MultiVllm_Client(addrs=client)
 		else:
 			assert isinstance(client, AbstractClient)
 		client.prepare()
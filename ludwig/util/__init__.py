@@ -1,10 +1,10 @@
 from .files import repo_root, Checkpointable, hash_str
 from .formatting import flatten, wrap_text, AbstractBroker, DefaultBroker
 from .prompts import PromptTemplate, AbstractFormalizer
-from .clients import AbstractClient, vllm_Client, SAIA_Client
+from .clients import AbstractClient, vllm_Client, MultiVllm_Client, SAIA_Client
 from .coding import PythonParser, AbstractCoder
-from .stats import AbstractStats, ClientStats, TimeStats, EmptyStats
+from .stats import AbstractStats, ClientStats, TimeStats, EmptyStats, RunningStat, PhaseTimer
 from .search import AbstractSearch
 from .tools import ToolBase, ToolError
-from .parsers import MessageParser, parse_json_tool_calls, parse_pythonic_tool_calls, extract_code_blocks
+from .parsers import MessageParser, AnswerDetector, parse_json_tool_calls, parse_pythonic_tool_calls, extract_code_blocks
 from .blanks import StubTask
\ No newline at end of file
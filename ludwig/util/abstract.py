@@ -15,7 +15,7 @@ class AbstractClient:
 	def json(self) -> JSONOBJ:
 		raise NotImplementedError
 
-	def stats(self, starting_from: int = 0) -> JSONOBJ:
+	def stats(self, starting_from: int = 0, scope: Any = None) -> JSONOBJ:
 		raise NotImplementedError
 
 	def past_requests(self) -> int:
@@ -46,6 +46,16 @@ class AbstractClient:
 	def step(self, chat: Union[str, List[Dict[str, str]]], *, auto_resolve_tools: bool = True, **params) -> JSONOBJ:
 		raise NotImplementedError
 
+	async def asend(self, data: JSONOBJ) -> JSONOBJ:
+		raise NotImplementedError
+
+	async def astep(self, chat: Union[str, List[Dict[str, str]]], **params) -> JSONOBJ:
+		raise NotImplementedError
+
+	def amulti_turn(self, chat: List[Dict[str, str]], params: JSONOBJ = {},
+					*, max_retries: int = None) -> AsyncIterator[JSONOBJ]:
+		raise NotImplementedError
+
 	def last_response(self) -> Optional[str]:
 		raise NotImplementedError
 
@@ -55,7 +65,8 @@ class AbstractClient:
 	def extract_response(self, data: JSONOBJ) -> str:
 		raise NotImplementedError
 
-	def count_tokens(self, message: str) -> int:
+	def count_tokens(self, message: Union[str, List[JSONOBJ]], *, tools: List[JSONOBJ] = None) -> int:
+		"""Number of tokens of a text or the prompt for a chat (including the chat template and tools)."""
 		raise NotImplementedError
 
 
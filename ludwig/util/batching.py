@@ -0,0 +1,60 @@
+from .imports import *
+from concurrent.futures import Future
+
+
+
+class _Batch:
+	def __init__(self):
+		self.items = []
+		self.futures = []
+
+
+
+class MicroBatcher:
+	"""
+	Collects the items submitted concurrently (from different threads) with the same key for up to `window` seconds
+	(or until `max_size` items are collected) and processes them together with `fn(items) -> results`.
+
+	The first caller of a batch waits for the window and then calls `fn`, while all other callers just wait for their
+	result. Exceptions raised by `fn` are raised for every item of the batch.
+	"""
+	def __init__(self, fn: Callable[[List[Any]], List[Any]], *, window: float = 0.005, max_size: int = 16):
+		assert max_size > 0, f'max_size must be a positive integer, got {max_size}'
+		self.fn = fn
+		self.window = window
+		self.max_size = max_size
+		self._open: Dict[Any, _Batch] = {}
+		self._cond = threading.Condition()
+
+	def submit(self, key: Any, item: Any) -> Any:
+		future = Future()
+		with self._cond:
+			batch = self._open.get(key)
+			leader = batch is None
+			if leader:
+				batch = self._open[key] = _Batch()
+			batch.items.append(item)
+			batch.futures.append(future)
+			if len(batch.items) >= self.max_size:
+				del self._open[key] # no more room, so the next item starts a new batch
+				self._cond.notify_all()
+			if leader:
+				deadline = time.monotonic() + self.window
+				while self._open.get(key) is batch and (remaining := deadline - time.monotonic()) > 0:
+					self._cond.wait(remaining)
+				if self._open.get(key) is batch:
+					del self._open[key]
+		if leader:
+			self._run(batch)
+		return future.result()
+
+	def _run(self, batch: _Batch) -> None:
+		try:
+			results = self.fn(batch.items)
+			assert len(results) == len(batch.items), f'Expected {len(batch.items)} results, got {len(results)}'
+		except BaseException as e:
+			for future in batch.futures:
+				future.set_exception(e)
+		else:
+			for future, result in zip(batch.futures, results):
+				future.set_result(result)
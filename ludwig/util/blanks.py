@@ -56,6 +56,9 @@ class StubTask(AbstractTask):
 	def checkpoint(self, path: Optional[Path] = None) -> Optional[JSONOBJ]:
 		pass
 
+	def load_checkpoint(self, *, path: Optional[Path] = None, data: Optional[JSONOBJ] = None) -> None:
+		pass
+
 	@property
 	def total_questions(self) -> Optional[int]:
 		return self.n
@@ -1,4 +1,13 @@
+import copy
 import uuid
+import asyncio
+import weakref
+from contextvars import ContextVar, copy_context
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import urlparse
 
 import openai
 from openai.types.chat import ChatCompletion
@@ -6,8 +15,14 @@ from openai.types.chat import ChatCompletion
 from .imports import *
 from .abstract import AbstractClient
 from .files import repo_root, hash_str
+from .storage import ResponseCache, RequestLog
+from .batching import MicroBatcher
+from .rendering import RenderCache, message_chain
+from .scheduling import PrefixScheduler, RateLimiter, HedgePolicy
+from .history import RequestHistory
+from .tools import ToolExecutor
 # from ..util.tools import parse_pythonic_tool_calls, parse_json_tool_calls
-from ..util.parsers import AbstractParser, MessageParser
+from ..util.parsers import AbstractParser, MessageParser, AnswerDetector
 
 # from openai.types.chat import ChatCompletionMessage
 
@@ -17,16 +32,119 @@ REQUEST = JSONOBJ
 RESPONSE = JSONOBJ
 # RESPONSE = openai.ChatCompletion
 
+
+class RequestScope:
+	"""
+	Tags every request that is sent from the current thread (or task) while the scope is active.
+
+	This way the stats of one sample can be separated from those of other samples running concurrently on the same
+	client (see `ClientStats`).
+	"""
+	_active: ContextVar[Tuple['RequestScope', ...]] = ContextVar('request_scopes', default=())
+
+	@classmethod
+	def current(cls) -> Tuple['RequestScope', ...]:
+		return cls._active.get()
+
+	def __enter__(self) -> 'RequestScope':
+		self._token = self._active.set(self._active.get() + (self,))
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self._active.reset(self._token)
+
+
+
+class StopAtAnswer:
+	"""
+	While active, `step` streams the responses to requests from the current thread (or task) and stops generating as
+	soon as `detector` finds a complete answer (the response then has `finish_reason='answer_detected'`).
+	"""
+	_active: ContextVar[Optional['StopAtAnswer']] = ContextVar('stop_at_answer', default=None)
+
+	def __init__(self, detector: AnswerDetector):
+		self.detector = detector
+
+	@classmethod
+	def current(cls) -> Optional['StopAtAnswer']:
+		return cls._active.get()
+
+	def __enter__(self) -> 'StopAtAnswer':
+		self._token = self._active.set(self)
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self._active.reset(self._token)
+
+
+
+class RequestOverrides:
+	"""
+	While active, the given request parameters (e.g. `seed`) are added to every `step` from the current thread (or
+	task), so concurrent callers can use different settings without changing the (shared) client.
+	"""
+	_active: ContextVar[REQUEST_PARAMS] = ContextVar('request_overrides', default={})
+
+	def __init__(self, **params: JSONDATA):
+		self.params = params
+
+	@classmethod
+	def current(cls) -> REQUEST_PARAMS:
+		return cls._active.get()
+
+	def __enter__(self) -> 'RequestOverrides':
+		self._token = self._active.set({**self._active.get(), **self.params})
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self._active.reset(self._token)
+
+
+def _loop_local(name: str) -> Dict[Any, Any]:
+	"""
+	Dict stored on the running event loop, for objects bound to it (semaphores, async connection pools), so each
+	`asyncio.run` gets its own and they go away with the loop.
+	"""
+	loop = asyncio.get_running_loop()
+	attr = f'_ludwig_{name}'
+	store = getattr(loop, attr, None)
+	if store is None:
+		store = {}
+		setattr(loop, attr, store)
+	return store
+
+
 class ClientBase(fig.Configurable, AbstractClient):
 	def __init__(self, raise_length_limit: bool = True, system_message: str = None,
-				 message_parser: AbstractParser = None, debug_log: bool = False, **kwargs):
+				 message_parser: AbstractParser = None, debug_log: bool = False, max_in_flight: int = None,
+				 prefix_scheduling: bool = False, history_limit: int = None, coalesce: str = None, **kwargs):
+		"""
+		:param max_in_flight: cap on the concurrent async requests to the same endpoint
+		:param prefix_scheduling: also cap concurrent (sync or async) requests at `max_in_flight`, and dispatch waiting
+		requests which share the longest prompt prefix with the recent requests first (see `PrefixScheduler`)
+		:param history_limit: number of request records kept in memory, older ones are moved to a temporary file (the
+		stats are not affected, see `RequestHistory`)
+		:param coalesce: identical requests which are sent while the first one is still in flight wait for its response
+		(and get a copy) instead of being sent again: 'deterministic' only for requests with temperature 0 or a seed,
+		'all' for every request (e.g. for judges where the sampling noise doesn't matter)
+		"""
 		if message_parser is None:
 			message_parser = MessageParser()
+		assert not prefix_scheduling or max_in_flight, f'prefix_scheduling requires max_in_flight'
+		assert coalesce in (None, 'deterministic', 'all'), f'Unknown coalesce mode: {coalesce!r}'
 		super().__init__(**kwargs)
 		self.system_message = system_message
+		self.max_in_flight = max_in_flight
+		self.prefix_scheduling = prefix_scheduling
+		self.history_limit = history_limit
+		self.coalesce = coalesce
+		self._flights: Dict[str, Future] = {}
+		self._flights_lock = threading.Lock()
 		self._raise_length_limit = raise_length_limit
 		self._model_name = None
 		self.history = None
+		self._active_entry = ContextVar(f'active_entry_{id(self)}', default=None)
+		self._stop_detector = ContextVar(f'stop_detector_{id(self)}', default=None)
 		self._last_response = None
 		self._message_parser = message_parser
 		self._debug_log = debug_log
@@ -38,6 +156,15 @@ class ClientBase(fig.Configurable, AbstractClient):
 	def model_name(self) -> str: # fallback
 		return self.ident
 
+	@property
+	def history(self) -> Optional[RequestHistory]:
+		return self._history
+	@history.setter
+	def history(self, entries: Optional[Iterable[JSONOBJ]]):
+		if entries is not None and not isinstance(entries, RequestHistory):
+			entries = RequestHistory(entries, max_entries=self.history_limit)
+		self._history = entries
+
 	def begin_chat(self, prompt: str = None, *, role: str = 'user') -> CHAT:
 		chat = [] if self.system_message is None else [{'role': 'system', 'content': self.system_message}]
 		if prompt is not None:
@@ -72,16 +199,63 @@ class ClientBase(fig.Configurable, AbstractClient):
 			assert chat[-1]['role'] != role, f'Chat must be updated with a new message from the user'
 			i += 1
 
+	async def amulti_turn(self, chat: CHAT, params: REQUEST_PARAMS = {},
+						  *, max_retries: int = None) -> AsyncIterator[RESPONSE]:
+		"""Async version of `multi_turn`"""
+		assert isinstance(chat, list), f'Expected a list of messages, got {type(chat)}'
+
+		i = 0
+		while max_retries is None or i <= max_retries:
+			resp = await self.astep(chat, **params)
+			yield resp
+			role = resp['choices'][0]['message']['role']
+			assert chat[-1]['role'] != role, f'Chat must be updated with a new message from the user'
+			i += 1
+
 	def step(self, chat: CHAT, **params) -> RESPONSE:
 		"""sends a single request"""
 		if isinstance(chat, str):
 			chat = self.begin_chat(chat)
+		data = self._wrap_step(chat, params)
+		with self._stopping_at_answer(data):
+			resp = self.send(data)
+		return self._update_chat(chat, resp)
+
+	async def astep(self, chat: CHAT, **params) -> RESPONSE:
+		"""Async version of `step`"""
+		if isinstance(chat, str):
+			chat = self.begin_chat(chat)
+		data = self._wrap_step(chat, params)
+		with self._stopping_at_answer(data):
+			resp = await self.asend(data)
+		return self._update_chat(chat, resp)
 
+	@contextmanager
+	def _stopping_at_answer(self, data: JSONOBJ) -> Iterator[None]:
+		"""
+		With an active `StopAtAnswer`, the request is streamed (see `_deliver`), but otherwise goes through the same
+		hooks as any other request (cache, coalescing, scheduling, hedging).
+		"""
+		watch = StopAtAnswer.current()
+		if watch is None or not self._can_stop_at_answer(data):
+			yield
+			return
+		token = self._stop_detector.set(watch.detector)
+		try:
+			yield
+		finally:
+			self._stop_detector.reset(token)
+
+	def _wrap_step(self, chat: CHAT, params: REQUEST_PARAMS) -> REQUEST:
+		overrides = RequestOverrides.current()
+		if overrides:
+			params = {**params, **overrides}
 		data = self.wrap_chat(chat, params)
 		if data.get('n', 1) > 1:
 			print(f'WARNING: Multiple responses is unsupported: {data["n"]} responses requested')
+		return data
 
-		resp = self.send(data)
+	def _update_chat(self, chat: CHAT, resp: RESPONSE) -> RESPONSE:
 		# assert len(resp.choices) > 1, f'Expected one response, got {len(resp.choices)} choices'
 
 		if self._raise_length_limit and resp['choices'][0].get('finish_reason') == 'length':
@@ -114,6 +288,27 @@ class ClientBase(fig.Configurable, AbstractClient):
 		for resp in self.send_no_wait(prompt):
 			yield self.extract_response(resp)
 
+	def _new_entry(self, **info: JSONDATA) -> JSONOBJ:
+		"""Adds the record of a new request to the history, which all later hooks in this context will update."""
+		entry = dict(info)
+		scopes = RequestScope.current()
+		if scopes:
+			entry['scopes'] = scopes
+		entry = self.history.append(entry)
+		self._active_entry.set(entry)
+		return entry
+
+	def _current_entry(self) -> JSONOBJ:
+		"""
+		The history record of the request currently being processed in this thread (or task). Outside of a request, a
+		throwaway record is returned, since with concurrent requests the last record may belong to another request.
+		"""
+		entry = self._active_entry.get()
+		return {} if entry is None else entry
+
+	def _history_window(self, starting_from: int = 0, scope: RequestScope = None) -> List[JSONOBJ]:
+		return self.history.entries(starting_from, scope=scope)
+
 	def _record_send(self, data: JSONOBJ):
 		pass
 
@@ -127,17 +322,185 @@ class ClientBase(fig.Configurable, AbstractClient):
 		pass
 
 	def json(self) -> JSONOBJ:
-		return {
+		data = {
 			'system_message': self.system_message,
 		}
+		if self.coalesce is not None:
+			data['coalesce'] = self.coalesce
+		return data
+
+	def _can_coalesce(self, data: JSONOBJ) -> bool:
+		if self.coalesce is None or data.get('stream'):
+			return False
+		return self.coalesce == 'all' or data.get('temperature') == 0 or data.get('seed') is not None
+
+	def _request_identity(self, data: JSONOBJ) -> JSONOBJ:
+		"""
+		Everything that determines the response to the request `data`: a request that stops at the answer gets a
+		different (truncated) response than the same request without.
+		"""
+		detector = self._stop_detector.get()
+		if detector is None:
+			return data
+		return {**data, 'stop_at_answer': detector.pattern.pattern}
+
+	def _coalesce_key(self, data: JSONOBJ) -> str:
+		return hash_str(json.dumps(self._request_identity(data), sort_keys=True, ensure_ascii=False, default=str))
+
+	def _join_flight(self, data: JSONOBJ) -> Tuple[Optional[str], Optional[Future]]:
+		"""
+		Returns the key and future of the flight for this request: the future is None if there is no identical request
+		in flight, so this caller should send it (and `_land` the flight afterwards).
+		"""
+		if not self._can_coalesce(data):
+			return None, None
+		key = self._coalesce_key(data)
+		with self._flights_lock:
+			flight = self._flights.get(key)
+			if flight is None:
+				self._flights[key] = Future()
+			return key, flight
+
+	def _land(self, key: Optional[str], resp: Optional[RESPONSE] = None, error: BaseException = None) -> None:
+		if key is not None:
+			with self._flights_lock:
+				flight = self._flights.pop(key)
+			if error is None:
+				flight.set_result(copy.deepcopy(resp)) # the caller may modify its response right away
+			else:
+				flight.set_exception(error)
+
+	def _record_coalesced(self, data: JSONOBJ) -> None:
+		self._record_send(data)
+		self._current_entry()['coalesced'] = 1
 
 	def send(self, data: JSONOBJ) -> JSONOBJ:
+		key, flight = self._join_flight(data)
+		if flight is not None:
+			self._record_coalesced(data)
+			resp = copy.deepcopy(flight.result())
+			self._record_response(data, resp)
+			return resp
+		try:
+			resp = self._send_upstream(data)
+		except BaseException as e:
+			self._land(key, error=e)
+			raise
+		self._land(key, resp)
+		return resp
+
+	def _send_upstream(self, data: JSONOBJ) -> JSONOBJ:
 		self._record_send(data)
-		resp = self._send(data)
+		scheduler = self._scheduler()
+		if scheduler is None:
+			resp = self._transmit(data)
+		else:
+			key = self._schedule_key(data)
+			with scheduler.slot(key) as shared:
+				self._record_schedule(shared, len(key))
+				resp = self._transmit(data)
+		resp = self._post_response_fixes(data, resp)
+		self._record_response(data, resp)
+		return resp
+
+	_schedulers: Dict[str, PrefixScheduler] = {}
+	_schedulers_lock = threading.Lock()
+	def _scheduler(self) -> Optional[PrefixScheduler]:
+		"""Shared by all clients with the same `_in_flight_key` (if `prefix_scheduling` is enabled)."""
+		if not self.prefix_scheduling:
+			return None
+		key = self._in_flight_key()
+		with self._schedulers_lock:
+			if key not in self._schedulers:
+				self._schedulers[key] = PrefixScheduler(self.max_in_flight)
+			return self._schedulers[key]
+
+	def _schedule_key(self, data: JSONOBJ) -> str:
+		"""Stand-in for the rendered prompt of the request, which is only used to order requests by shared prefix."""
+		if isinstance(data.get('prompt'), str):
+			return data['prompt']
+		messages = data.get('messages', data.get('chat', []))
+		return ''.join(json.dumps(m, ensure_ascii=False, default=str) for m in messages)
+
+	def _record_schedule(self, shared: int, length: int):
+		pass
+
+	def _in_flight_key(self) -> str:
+		"""Clients with the same key share the cap on concurrent async requests (see `max_in_flight`)."""
+		return self.ident
+
+	def _in_flight_limit(self) -> Optional[asyncio.Semaphore]:
+		if self.max_in_flight is None:
+			return None
+		limits = _loop_local('in_flight_limits')
+		key = self._in_flight_key()
+		if key not in limits:
+			limits[key] = asyncio.Semaphore(self.max_in_flight)
+		return limits[key]
+
+	async def asend(self, data: JSONOBJ) -> JSONOBJ:
+		"""Async version of `send` (at most `max_in_flight` requests to the same endpoint run at once)"""
+		key, flight = self._join_flight(data)
+		if flight is not None:
+			self._record_coalesced(data)
+			resp = copy.deepcopy(await asyncio.shield(asyncio.wrap_future(flight)))
+			self._record_response(data, resp)
+			return resp
+		try:
+			resp = await self._asend_upstream(data)
+		except BaseException as e:
+			self._land(key, error=e)
+			raise
+		self._land(key, resp)
+		return resp
+
+	async def _asend_upstream(self, data: JSONOBJ) -> JSONOBJ:
+		scheduler = self._scheduler()
+		limit = None if scheduler is not None else self._in_flight_limit()
+		if limit is not None:
+			await limit.acquire()
+		try:
+			self._record_send(data)
+			if scheduler is not None:
+				key = self._schedule_key(data)
+				self._record_schedule(await scheduler.aacquire(key), len(key))
+				try:
+					resp = await self._atransmit(data)
+				finally:
+					scheduler.release()
+			else:
+				resp = await self._atransmit(data)
+		finally:
+			if limit is not None:
+				limit.release()
 		resp = self._post_response_fixes(data, resp)
 		self._record_response(data, resp)
 		return resp
 
+	def _transmit(self, data: JSONOBJ) -> RESPONSE:
+		"""Sends the request with `_deliver` (override to wrap every request, e.g. to hedge slow ones)."""
+		return self._deliver(data)
+
+	async def _atransmit(self, data: JSONOBJ) -> RESPONSE:
+		return await self._adeliver(data)
+
+	def _deliver(self, data: JSONOBJ) -> RESPONSE:
+		"""Sends the request with `_send`, or streams it with `_send_until_answer` during a `StopAtAnswer`."""
+		detector = self._stop_detector.get()
+		if detector is None:
+			return self._send(data)
+		return self._send_until_answer(data, detector.fresh())
+
+	async def _adeliver(self, data: JSONOBJ) -> RESPONSE:
+		detector = self._stop_detector.get()
+		if detector is None:
+			return await self._asend(data)
+		return await asyncio.to_thread(self._send_until_answer, data, detector.fresh())
+
+	async def _asend(self, data: JSONOBJ) -> RESPONSE:
+		"""Fallback for clients without a native async transport: send the request from a worker thread."""
+		return await asyncio.to_thread(self._send, data)
+
 	def _post_response_fixes(self, data: REQUEST_PARAMS, resp: RESPONSE) -> JSONOBJ:
 		"""
 		Override this method to apply any post-processing fixes to the response.
@@ -198,6 +561,14 @@ class ClientBase(fig.Configurable, AbstractClient):
 	def _send_no_wait(self, data: JSONOBJ) -> Iterator[JSONOBJ]:
 		raise NotImplementedError
 
+	def _can_stop_at_answer(self, data: JSONOBJ) -> bool:
+		"""Whether the request can be streamed with `_send_until_answer`."""
+		return False
+
+	def _send_until_answer(self, data: JSONOBJ, detector: AnswerDetector) -> RESPONSE:
+		"""Like `_send`, but streams the response and stops generating as soon as `detector` finds a complete answer."""
+		raise NotImplementedError
+
 
 
 @fig.component('mock')
@@ -225,7 +596,7 @@ class MockEndpoint(ClientBase):
 	def past_requests(self) -> int:
 		return len(self.history)
 
-	def stats(self, starting_from: int = 0) -> JSONOBJ:
+	def stats(self, starting_from: int = 0, scope: RequestScope = None) -> JSONOBJ:
 		return {
 			# 'input_tokens': sum(h['input_tokens'] for h in self.history[starting_from:]),
 			# 'output_tokens': sum(h['output_tokens'] for h in self.history[starting_from:]),
@@ -233,27 +604,28 @@ class MockEndpoint(ClientBase):
 		}
 
 	def _record_send(self, data: JSONOBJ):
-		self.history.append({'input_tokens': self.count_tokens(data['chat']), 'start_time': time.time()})
+		self._new_entry(input_tokens=self.count_tokens(data['chat']), start_time=time.time())
 		self._last_response = []
 
 	def _record_response(self, data: JSONOBJ, resp: JSONOBJ):
-		self.history[-1].update({
+		self._current_entry().update({
 			'output_tokens': self.count_tokens(resp['choices'][0]['message']['content']),
 			'end_time': time.time(),
 		})
 		self._last_response = [resp['choices'][0]['message']['content']]
 
 	def _record_step(self, data: JSONOBJ, step: JSONOBJ):
-		if 'output_tokens' not in self.history[-1]:
-			self.history[-1]['output_tokens'] = 0
-		self.history[-1]['output_tokens'] += 1
+		entry = self._current_entry()
+		if 'output_tokens' not in entry:
+			entry['output_tokens'] = 0
+		entry['output_tokens'] += 1
 		self._last_response.append(step['choices'][0]['message']['content'])
 
 	def last_response(self) -> str:
 		if self._last_response is not None:
 			return ' '.join(self._last_response)
 
-	def count_tokens(self, message: Union[str, List[Dict[str, str]]]) -> int:
+	def count_tokens(self, message: Union[str, List[Dict[str, str]]], *, tools: List[JSONOBJ] = None) -> int:
 		if isinstance(message, str):
 			return len(message.split())
 		return sum(self.count_tokens(m['content']) for m in message)
@@ -304,11 +676,34 @@ class LiveClient(ClientBase):
 class OpenaiClientBase(ClientBase):
 	def __init__(self, endpoint: Union[openai.OpenAI, str], *, max_tokens: int = None, seed: int = None,
 				 temperature: float = None, top_p: float = None, grammar: Union[str, JSONOBJ] = None,
-				 **kwargs):
-		if isinstance(endpoint, str):
-			endpoint = openai.OpenAI(api_key='EMPTY', base_url=endpoint)
+				 timeout: float = None, retries: int = 2, retry_backoff: float = 0.5, retry_max_backoff: float = 30.,
+				 share_connections: bool = True, rpm: float = None, tpm: float = None, hedge: float = None,
+				 hedge_quantile: float = 0.95, **kwargs):
+		"""
+		:param timeout: per request (in seconds)
+		:param retries: how often to retry requests that failed with a transient error (e.g. 429/503 or a timeout)
+		:param retry_backoff: delay before the first retry (in seconds), doubled for every further retry (with jitter)
+		:param share_connections: use one keep-alive connection pool for all clients sending requests to the same host
+		:param rpm: limit on the requests per minute (shared by all clients using the same account)
+		:param tpm: limit on the (prompt and completion) tokens per minute (shared like `rpm`)
+		:param hedge: fraction of the requests that may be hedged: a request still running after the `hedge_quantile` of
+		the recent latencies is sent again (to another replica, if there are several) and the first response is used
+		"""
+		endpoint = self._connect(endpoint, timeout=timeout, share_connections=share_connections)
 		super().__init__(**kwargs)
+		self.rpm = rpm
+		self.tpm = tpm
+		self._rate_limiter = None if rpm is None and tpm is None \
+			else self._shared_rate_limiter(endpoint, rpm=rpm, tpm=tpm)
+		self.hedge = hedge
+		self._hedge_policy = None if hedge is None else HedgePolicy(hedge, quantile=hedge_quantile)
 		self.endpoint = endpoint
+		self._async_endpoints = weakref.WeakKeyDictionary() # event loop -> async twin of the endpoint
+		self.timeout = timeout
+		self.retries = retries
+		self.retry_backoff = retry_backoff
+		self.retry_max_backoff = retry_max_backoff
+		self._share_connections = share_connections
 
 		self.max_tokens = max_tokens
 		self.temperature = temperature
@@ -317,6 +712,8 @@ class OpenaiClientBase(ClientBase):
 		self.grammar = grammar
 
 		self._tokenizer = None
+		self._token_counts = OrderedDict()
+		self._token_counts_lock = threading.Lock()
 		# self._chat_template = chat_template
 
 	@property
@@ -335,8 +732,12 @@ class OpenaiClientBase(ClientBase):
 		except ImportError:
 			tokenizer = None
 		else:
-			tokenizer = tiktoken.get_encoding("cl100k_base")
+			try:
+				tokenizer = tiktoken.encoding_for_model(self._model_name)
+			except (KeyError, TypeError):
+				tokenizer = tiktoken.get_encoding("cl100k_base")
 		self._tokenizer = tokenizer
+		self._token_counts.clear()
 		self._last_response = None
 
 	def json(self) -> JSONOBJ:
@@ -347,42 +748,236 @@ class OpenaiClientBase(ClientBase):
 			'temperature': self.temperature,
 			'top_p': self.top_p,
 			'seed': self.seed,
+			'timeout': self.timeout,
+			'retries': self.retries,
 			**super().json()
 		}
 		if self.grammar is not None:
 			info['grammar'] = self.grammar
+		if self._rate_limiter is not None:
+			info['rpm'] = self.rpm
+			info['tpm'] = self.tpm
+		if self._hedge_policy is not None:
+			info['hedge'] = self.hedge
+			info['hedge_quantile'] = self._hedge_policy.quantile
 		return info
 
 	def past_requests(self) -> int:
 		return len(self.history)
 
-	def stats(self, starting_from: int = 0) -> JSONOBJ:
-		def _metrics(seq: Sequence[float]):
-			if len(seq) == 1:
-				return seq[0]
-			return {'mean': sum(seq) / len(seq), 'min': min(seq), 'max': max(seq),}
+	@classmethod
+	def _connect(cls, endpoint: Union[openai.OpenAI, str], *, timeout: float = None,
+				 share_connections: bool = True) -> openai.OpenAI:
+		if isinstance(endpoint, str):
+			endpoint = openai.OpenAI(api_key='EMPTY', base_url=endpoint,
+									 http_client=cls._shared_http_client(endpoint) if share_connections else None)
+		# retries are handled by `_call` (so they can be counted)
+		return endpoint.with_options(max_retries=0, **({} if timeout is None else {'timeout': timeout}))
+
+	_http_clients: Dict[Tuple[str, bool], Any] = {}
+	_http_clients_lock = threading.Lock()
+	@classmethod
+	def _shared_http_client(cls, base_url: str, *, asynchronous: bool = False):
+		"""
+		Keep-alive connection pool shared by all clients sending requests to the same host (async pools can only be
+		used from the event loop they were created in, so those are shared per loop).
+		"""
+		url = urlparse(str(base_url))
+		key = (f'{url.scheme}://{url.netloc}', asynchronous)
+		if asynchronous:
+			pools = _loop_local('http_clients')
+			if key not in pools:
+				pools[key] = openai.DefaultAsyncHttpxClient()
+			return pools[key]
+		with cls._http_clients_lock:
+			if key not in cls._http_clients:
+				cls._http_clients[key] = openai.DefaultHttpxClient()
+			return cls._http_clients[key]
+
+	_rate_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+	@classmethod
+	def _shared_rate_limiter(cls, endpoint: openai.OpenAI, *, rpm: float = None, tpm: float = None) -> RateLimiter:
+		"""Rate limits are per account, so all clients with the same base url and api key share one limiter."""
+		key = (str(endpoint.base_url), hash_str(str(endpoint.api_key)))
+		with cls._http_clients_lock:
+			limiter = cls._rate_limiters.get(key)
+			if limiter is None:
+				limiter = cls._rate_limiters[key] = RateLimiter(rpm=rpm, tpm=tpm)
+			elif (limiter.rpm, limiter.tpm) != (rpm, tpm):
+				print(f'WARNING: {endpoint.base_url} is already limited to rpm={limiter.rpm}, tpm={limiter.tpm} '
+					  f'(ignoring rpm={rpm}, tpm={tpm})')
+			return limiter
+
+	def _estimate_cost(self, data: JSONOBJ) -> int:
+		"""Tokens a request will (at most) use: the prompt and `max_tokens` for each completion."""
+		prompt = data.get('messages') or data.get('prompt') or data.get('input') or ''
+		prompts = prompt if isinstance(prompt, list) and prompt and isinstance(prompt[0], str) else [prompt]
+		if self._tokenizer is not None:
+			tokens = sum(self.count_tokens(p, tools=data.get('tools')) for p in prompts)
+		else:
+			tokens = sum(len(json.dumps(p, default=str)) for p in prompts) // 4
+		max_tokens = data.get('max_tokens') or data.get('max_output_tokens') or 0
+		return tokens + max_tokens * len(prompts) * data.get('n', 1)
+
+	def _count_rate_wait(self, waited: float) -> None:
+		if waited > 0:
+			entry = self._current_entry()
+			entry['rate_wait'] = entry.get('rate_wait', 0.) + waited
+			entry['throttled'] = entry.get('throttled', 0) + 1
+
+	def _failed_attempt(self, cost: int, attempt: int, error: openai.APIError) -> Optional[float]:
+		"""Returns the delay before the next attempt (or None to give up)."""
+		delay = self._retry_delay(attempt, error)
+		if self._rate_limiter is not None:
+			self._rate_limiter.reconcile(cost, 0)
+			if delay is not None and isinstance(error, openai.APIStatusError) and error.status_code == 429:
+				self._rate_limiter.pause(delay) # also hold back the other requests to this account
+		return delay
+
+	def _reconcile_usage(self, cost: int, resp: Any) -> None:
+		usage = resp.get('usage') if isinstance(resp, dict) else getattr(resp, 'usage', None)
+		if usage is not None and not isinstance(usage, dict):
+			usage = usage.model_dump()
+		if usage: # streams only report the usage at the end, so they keep the estimate
+			actual = usage.get('total_tokens') \
+				or (usage.get('prompt_tokens') or 0) + (usage.get('completion_tokens') or 0)
+			self._rate_limiter.reconcile(cost, actual)
+
+	_retry_status_codes = {408, 409, 429, 500, 502, 503, 504}
+	_jitter = random.Random()
+	def _retry_delay(self, attempt: int, error: openai.APIError) -> Optional[float]:
+		"""Seconds to wait before retrying a request which failed with `error` (None if it should not be retried)."""
+		if attempt >= self.retries:
+			return None
+		if isinstance(error, openai.APIStatusError):
+			if error.status_code not in self._retry_status_codes:
+				return None
+			try:
+				return min(float(error.response.headers.get('retry-after')), self.retry_max_backoff)
+			except (TypeError, ValueError):
+				pass
+		elif not isinstance(error, openai.APIConnectionError): # includes timeouts
+			return None
+		delay = min(self.retry_backoff * 2 ** attempt, self.retry_max_backoff)
+		return self._jitter.uniform(delay / 2, delay)
+
+	def _count_retry(self) -> None:
+		entry = self._current_entry()
+		entry['retries'] = entry.get('retries', 0) + 1
+
+	def _call(self, fn: Callable, **data):
+		"""
+		Calls the endpoint (`fn(**data)`), retrying transient errors with exponential backoff (and waiting for the
+		rate limits, if there are any).
+		"""
+		cost = 0 if self._rate_limiter is None else self._estimate_cost(data)
+		attempt = 0
+		while True:
+			if self._rate_limiter is not None:
+				self._count_rate_wait(self._rate_limiter.acquire(cost))
+			try:
+				resp = fn(**data)
+			except openai.APIError as e:
+				delay = self._failed_attempt(cost, attempt, e)
+				if delay is None:
+					raise
+			else:
+				if self._rate_limiter is not None:
+					self._reconcile_usage(cost, resp)
+				return resp
+			self._count_retry()
+			time.sleep(delay)
+			attempt += 1
+
+	async def _acall(self, fn: Callable, **data):
+		cost = 0 if self._rate_limiter is None else self._estimate_cost(data)
+		attempt = 0
+		while True:
+			if self._rate_limiter is not None:
+				self._count_rate_wait(await self._rate_limiter.aacquire(cost))
+			try:
+				resp = await fn(**data)
+			except openai.APIError as e:
+				delay = self._failed_attempt(cost, attempt, e)
+				if delay is None:
+					raise
+			else:
+				if self._rate_limiter is not None:
+					self._reconcile_usage(cost, resp)
+				return resp
+			self._count_retry()
+			await asyncio.sleep(delay)
+			attempt += 1
+
+	def stats(self, starting_from: int = 0, scope: RequestScope = None) -> JSONOBJ:
+		window = self.history.window(starting_from, scope=scope)
 		data = {}
-		times = [h.get('end_time',0) - h.get('start_time',0) for h in self.history[starting_from:] if 'end_time' in h]
-		if times:
-			tps = [h['output_tokens']/(h['end_time'] - h['start_time'])
-				   for h in self.history[starting_from:] if 'end_time' in h]
-			data['time'] = _metrics(times)
-			data['tok_per_sec'] = _metrics(tps)
+		if window.count('time'):
+			data['time'] = window.metrics('time')
+			if window.count('tok_per_sec'):
+				data['tok_per_sec'] = window.metrics('tok_per_sec')
 		summary = {
-			'input_tokens': sum(h.get('input_tokens',0) for h in self.history[starting_from:]),
-			'output_tokens': sum(h.get('output_tokens',0) for h in self.history[starting_from:]),
+			'input_tokens': window.total('input_tokens'),
+			'output_tokens': window.total('output_tokens'),
 			**data,
-			'requests': len(self.history[starting_from:]),
+			'requests': len(window) - window.total('cache_hits'), # cached responses were not sent
+			'retries': window.total('retries'),
 		}
+		if window.count('estimated_input_tokens'):
+			summary['estimated_input_tokens'] = window.total('estimated_input_tokens')
+		if self._rate_limiter is not None:
+			summary['rate_limit'] = {'throttled': window.total('throttled'), 'wait': window.total('rate_wait')}
+		if window.count('prefix_length'):
+			total = window.total('prefix_length')
+			summary['prefix_sharing'] = window.total('prefix_shared') / total if total else 0.
+			summary['schedule_wait'] = window.metrics('schedule_wait')
+		if self._hedge_policy is not None:
+			summary['hedging'] = {'hedged': window.total('hedged'), 'won': window.total('hedge_won')}
+		if self.coalesce is not None:
+			summary['coalesced'] = window.total('coalesced')
 		return summary
 
-	def count_tokens(self, message: Union[str, List[Dict[str, str]]]) -> int:
-		return 0 # because of mistral
+	def count_tokens(self, message: Union[str, CHAT], *, tools: Optional[List[JSONOBJ]] = None) -> int:
+		"""
+		Number of tokens of a text or the prompt for a chat (including the overhead of the chat template and tools).
+
+		Returns 0 if no tokenizer is available.
+		"""
 		if self._tokenizer is None:
 			return 0
 		if isinstance(message, str):
-			return len(self._tokenizer.encode(message))
-		return sum(len(self._tokenizer.encode(m['content'])) for m in message if 'content' in m)
+			return self._cached_text_tokens(message)
+		return sum(self._cached_text_tokens(m['content']) for m in message if isinstance(m.get('content'), str)) \
+			+ self._template_overhead(message, tools)
+
+	_token_cache_size = 4096
+	def _cached_count(self, key: str, count: Callable[[], int]) -> int:
+		"""LRU cache of token counts, so repeated system prompts or few-shot examples are only tokenized once."""
+		with self._token_counts_lock:
+			n = self._token_counts.get(key)
+			if n is not None:
+				self._token_counts.move_to_end(key)
+				return n
+		n = count()
+		with self._token_counts_lock:
+			self._token_counts[key] = n
+			while len(self._token_counts) > self._token_cache_size:
+				self._token_counts.popitem(last=False)
+		return n
+
+	def _cached_text_tokens(self, text: str) -> int:
+		return self._cached_count(hash_str(text), lambda: self._count_text_tokens(text))
+
+	def _count_text_tokens(self, text: str) -> int:
+		return len(self._tokenizer.encode(text, disallowed_special=()))
+
+	def _template_overhead(self, chat: CHAT, tools: Optional[List[JSONOBJ]]) -> int:
+		"""Tokens of the prompt besides the message contents (estimated like the openai cookbook)."""
+		n = 3 + sum(3 + ('name' in m) for m in chat)
+		extras = [m['tool_calls'] for m in chat if m.get('tool_calls')]
+		if tools:
+			extras.append(tools)
+		return n + sum(self._cached_text_tokens(json.dumps(extra, sort_keys=True, default=str)) for extra in extras)
 
 	@staticmethod
 	def _include_grammar(args: JSONOBJ):
@@ -419,12 +1014,221 @@ class OpenaiClientBase(ClientBase):
 		return None
 
 	def _send(self, data: JSONOBJ) -> RESPONSE:
-		return self.endpoint.chat.completions.create(**data).model_dump()
+		return self._call(self.endpoint.chat.completions.create, **data).model_dump()
+
+	_hedge_pool = None
+	_hedge_pool_lock = threading.Lock()
+	@classmethod
+	def _hedge_executor(cls) -> ThreadPoolExecutor:
+		"""Worker threads for hedged requests (shared by all clients, threads are only started when needed)."""
+		with cls._hedge_pool_lock:
+			if OpenaiClientBase._hedge_pool is None:
+				OpenaiClientBase._hedge_pool = ThreadPoolExecutor(max_workers=256, thread_name_prefix='hedge')
+			return OpenaiClientBase._hedge_pool
+
+	def _send_hedge(self, data: JSONOBJ) -> RESPONSE:
+		"""Sends the duplicate of a slow request (override to send it to a different endpoint)."""
+		return self._deliver(data)
+
+	async def _asend_hedge(self, data: JSONOBJ) -> RESPONSE:
+		return await self._adeliver(data)
+
+	def _hedge_won(self) -> None:
+		self._current_entry()['hedge_won'] = 1
+		self._hedge_policy.hedge_won()
+
+	@staticmethod
+	def _attempt_record(source: JSONOBJ) -> JSONOBJ:
+		"""Scratch record for one attempt of a hedged request (starting from a copy of `source`)."""
+		return {key: copy.deepcopy(value) for key, value in dict(source).items() if key != 'scopes'}
+
+	def _run_attempt(self, record: JSONOBJ, fn: Callable[[JSONOBJ], RESPONSE], data: JSONOBJ) -> RESPONSE:
+		self._active_entry.set(record) # only in the context of this attempt
+		return fn(data)
+
+	async def _arun_attempt(self, record: JSONOBJ, fn: Callable[[JSONOBJ], Any], data: JSONOBJ) -> RESPONSE:
+		self._active_entry.set(record)
+		return await fn(data)
+
+	@staticmethod
+	def _merge_attempt(entry: JSONOBJ, record: JSONOBJ) -> None:
+		"""Copies what the winning attempt recorded (e.g. retries) into the record of the request."""
+		entry.update({key: value for key, value in record.items() if key not in entry or entry[key] != value})
+
+	def _transmit(self, data: JSONOBJ) -> RESPONSE:
+		"""
+		With hedging, a request that takes longer than usual is sent a second time (both from worker threads, each with
+		its own copy of `data`) and the first successful response is used. Blocking requests can't be interrupted, so
+		the slower one runs to completion in the background, but only the winner is recorded in the history: each
+		attempt records into its own scratch record (the hedge starts from a snapshot of the primary's, e.g. to know
+		which replicas to avoid), and only the winner's is merged into the record of the request.
+		"""
+		policy = self._hedge_policy
+		delay = None if policy is None else policy.delay()
+		start = time.monotonic()
+		if delay is None:
+			resp = self._deliver(data)
+		else:
+			pool = self._hedge_executor()
+			entry = self._current_entry()
+			records = {}
+			primary = pool.submit(copy_context().run, self._run_attempt,
+								  records.setdefault('primary', self._attempt_record(entry)), self._deliver, dict(data))
+			if wait([primary], timeout=delay).done or not policy.allow():
+				resp = primary.result()
+				self._merge_attempt(entry, records['primary'])
+			else:
+				entry['hedged'] = 1
+				records['hedge'] = self._attempt_record(records['primary'])
+				hedge = pool.submit(copy_context().run, self._run_attempt, records['hedge'], self._send_hedge,
+									dict(data))
+				pending, errors = {primary, hedge}, {}
+				while pending:
+					done, pending = wait(pending, return_when=FIRST_COMPLETED)
+					for future in sorted(done, key=lambda f: f is not primary):
+						if future.exception() is None:
+							break
+						errors[future] = future.exception()
+					else:
+						continue
+					for loser in pending:
+						loser.cancel() # only helps if it has not started yet
+					if future is hedge:
+						self._hedge_won()
+					self._merge_attempt(entry, records['primary' if future is primary else 'hedge'])
+					resp = future.result()
+					break
+				else:
+					self._merge_attempt(entry, records['primary'])
+					raise errors[primary]
+		if policy is not None:
+			policy.record(time.monotonic() - start)
+		return resp
+
+	async def _atransmit(self, data: JSONOBJ) -> RESPONSE:
+		"""Async version of `_transmit`, where the slower request is cancelled (which closes its connection)."""
+		policy = self._hedge_policy
+		delay = None if policy is None else policy.delay()
+		start = time.monotonic()
+		if delay is None:
+			resp = await self._adeliver(data)
+		else:
+			entry = self._current_entry()
+			records = {'primary': self._attempt_record(entry)}
+			primary = asyncio.ensure_future(self._arun_attempt(records['primary'], self._adeliver, dict(data)))
+			tasks = [primary]
+			try:
+				done, _ = await asyncio.wait(tasks, timeout=delay)
+				if done or not policy.allow():
+					try:
+						resp = await primary
+					finally:
+						self._merge_attempt(entry, records['primary'])
+				else:
+					entry['hedged'] = 1
+					records['hedge'] = self._attempt_record(records['primary'])
+					hedge = asyncio.ensure_future(self._arun_attempt(records['hedge'], self._asend_hedge, dict(data)))
+					tasks.append(hedge)
+					pending, errors = set(tasks), {}
+					while pending:
+						done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+						for task in sorted(done, key=lambda t: t is not primary):
+							if task.exception() is None:
+								break
+							errors[task] = task.exception()
+						else:
+							continue
+						if task is hedge:
+							self._hedge_won()
+						self._merge_attempt(entry, records['primary' if task is primary else 'hedge'])
+						resp = task.result()
+						break
+					else:
+						self._merge_attempt(entry, records['primary'])
+						raise errors[primary]
+			finally:
+				for task in tasks:
+					if not task.done():
+						task.cancel()
+		if policy is not None:
+			policy.record(time.monotonic() - start)
+		return resp
+
+	def _in_flight_key(self) -> str:
+		return str(self.endpoint.base_url)
+
+	def _build_async_endpoint(self) -> Optional[openai.AsyncOpenAI]:
+		"""Async twin of `self.endpoint` (or None to send async requests from worker threads instead)"""
+		if type(self.endpoint) is not openai.OpenAI:
+			return None
+		http_client = self._shared_http_client(self.endpoint.base_url, asynchronous=True) \
+			if self._share_connections else None
+		return openai.AsyncOpenAI(api_key=self.endpoint.api_key, base_url=self.endpoint.base_url,
+								  http_client=http_client, timeout=self.endpoint.timeout, max_retries=0)
+
+	@property
+	def async_endpoint(self) -> Optional[openai.AsyncOpenAI]:
+		"""Async twin of `self.endpoint` for the running event loop"""
+		loop = asyncio.get_running_loop()
+		if loop not in self._async_endpoints:
+			self._async_endpoints[loop] = self._build_async_endpoint()
+		return self._async_endpoints[loop]
+
+	async def _asend(self, data: JSONOBJ) -> RESPONSE:
+		if self.async_endpoint is None:
+			return await super()._asend(data)
+		return (await self._acall(self.async_endpoint.chat.completions.create, **data)).model_dump()
 
 	def _send_no_wait(self, data):
-		for chunk in self.endpoint.chat.completions.create(
-				**data, stream=True, stream_options={"include_usage": True}):
-			yield chunk.model_dump()
+		stream = self._call(self.endpoint.chat.completions.create,
+							**data, stream=True, stream_options={"include_usage": True})
+		try:
+			for chunk in stream:
+				yield chunk.model_dump()
+		finally:
+			stream.close() # if the caller stops early, the server stops generating
+
+	@staticmethod
+	def _chunk_text(choice: JSONOBJ) -> str:
+		"""New text in a streamed chunk (of a chat or text completion)."""
+		delta = choice.get('delta')
+		return (choice.get('text') if delta is None else delta.get('content')) or ''
+
+	def _can_stop_at_answer(self, data: JSONOBJ) -> bool:
+		return not data.get('tools') and data.get('n', 1) == 1
+
+	def _send_until_answer(self, data: JSONOBJ, detector: AnswerDetector) -> RESPONSE:
+		parts = []
+		finish, usage, is_chat = None, None, True
+		stream = self._send_no_wait(data)
+		try:
+			for chunk in stream:
+				if chunk.get('usage'):
+					usage = chunk['usage']
+				if not chunk['choices']:
+					continue
+				choice = chunk['choices'][0]
+				is_chat = 'delta' in choice
+				text = self._chunk_text(choice)
+				parts.append(text)
+				finish = choice.get('finish_reason') or finish
+				if text and detector.feed(text):
+					finish = 'answer_detected'
+					break
+		finally:
+			stream.close()
+
+		text = ''.join(parts)
+		if usage is None: # the server only reports the usage at the end of the stream
+			usage = {'prompt_tokens': self._current_entry().get('estimated_input_tokens', 0),
+					 'completion_tokens': self.count_tokens(text) if self._tokenizer is not None
+					 else sum(1 for part in parts if part)}
+		choice = {'index': 0, 'finish_reason': finish}
+		if is_chat:
+			choice['message'] = {'role': 'assistant', 'content': text}
+		else:
+			choice['text'] = text
+		return {'choices': [choice], 'usage': usage, 'model': data.get('model')}
 
 	def stream_response(self, prompt: Union[str, List[Dict[str, str]]], **params) -> Iterator[str]:
 		if isinstance(prompt, str):
@@ -437,10 +1241,18 @@ class OpenaiClientBase(ClientBase):
 
 	def _record_send(self, data: JSONOBJ):
 		self._last_response = ''
-		self.history.append({})
-		if self._tokenizer is not None:
-			self.history[-1]['estimated_input_tokens'] = self.count_tokens(data['messages'])
-		self.history[-1]['start_time'] = time.time()
+		entry = self._new_entry()
+		if self._tokenizer is not None and 'messages' in data:
+			entry['estimated_input_tokens'] = self.count_tokens(data['messages'], tools=data.get('tools'))
+		entry['start_time'] = time.time()
+
+	def _record_schedule(self, shared: int, length: int):
+		entry = self._current_entry()
+		now = time.time()
+		entry['schedule_wait'] = now - entry['start_time']
+		entry['start_time'] = now # the latency should not include the wait for a free slot
+		entry['prefix_shared'] = shared
+		entry['prefix_length'] = length
 
 	def _record_response(self, data: JSONOBJ, resp: RESPONSE):
 		N_inp = resp['usage'].get('prompt_tokens', 0)
@@ -451,15 +1263,16 @@ class OpenaiClientBase(ClientBase):
 			'end_time': time.time(),
 		}
 		self._last_response = resp['choices'][0]['message'].get('content', '')
-		self.history[-1].update(stats)
+		self._current_entry().update(stats)
 
 	def _record_step(self, data: JSONOBJ, step: RESPONSE):
 		if len(step['choices']):
-			self._last_response += step['choices'][0]['delta'].get('content', '')
-		if step['usage'] is not None:
-			self.history[-1]['input_tokens'] = step['usage']['prompt_tokens']
-			self.history[-1]['output_tokens'] = step['usage']['completion_tokens']
-			self.history[-1]['end_time'] = time.time()
+			self._last_response += self._chunk_text(step['choices'][0])
+		if step.get('usage') is not None:
+			entry = self._current_entry()
+			entry['input_tokens'] = step['usage']['prompt_tokens']
+			entry['output_tokens'] = step['usage']['completion_tokens']
+			entry['end_time'] = time.time()
 
 	def ping(self) -> bool:
 		return True # TODO: implement a ping method for OpenAI endpoints
@@ -473,8 +1286,19 @@ class OSSClient(OpenaiClientBase):
 	def __init__(self, *, use_chat_completion: bool = False, tool_style: str = 'pythonic',
 				 chat_template_path: Optional[str] = None, chat_template: Optional[str] = None,
 				 enable_thinking: bool = False,
-				 add_generation_prompt: bool = True, continue_final_message: bool = False, **kwargs):
+				 add_generation_prompt: bool = True, continue_final_message: bool = False,
+				 batch_window: Optional[float] = None, batch_size: int = 16,
+				 render_cache: Optional[str] = None, **kwargs):
+		"""
+		:param batch_window: if set, concurrent completion requests (with the same parameters) which arrive within this
+		many seconds of each other are sent as a single multi-prompt request (of up to `batch_size` prompts)
+		:param render_cache: caching of the locally rendered chat templates (see `RenderCache`), one of
+		None, 'exact' (only identical chats), 'incremental' (only render new messages where the template allows it)
+		or 'check' (like incremental, but always compare to the full rendering). Off by default, since templates which
+		depend on the date (e.g. `strftime_now`) would reuse stale renderings
+		"""
 		assert tool_style in (None, 'pythonic', 'json')
+		assert render_cache in (None, 'exact', 'incremental', 'check'), f'Unknown render_cache: {render_cache}'
 		assert chat_template_path is None or chat_template is None, \
 			f'Cannot specify both chat_template_path and chat_template'
 		if use_chat_completion:
@@ -488,10 +1312,18 @@ class OSSClient(OpenaiClientBase):
 		self._tool_style = tool_style
 		self._enable_thinking = enable_thinking
 		self._model_root = None
+		self._batcher = None if not batch_window else MicroBatcher(self._send_batch, window=batch_window,
+																	max_size=batch_size)
+		self._render_cache = None if render_cache is None else RenderCache(
+			incremental=render_cache == 'incremental', check=render_cache == 'check')
+		self._template_hash = None
 
 	def json(self) -> JSONOBJ:
 		info = super().json()
 		info['add_generation_prompt'] = self._add_generation_prompt
+		if self._batcher is not None:
+			info['batch_window'] = self._batcher.window
+			info['batch_size'] = self._batcher.max_size
 		info['continue_final_message'] = self._continue_final_message
 		info['chat_template_path'] = None if self._chat_template_path is None else str(self._chat_template_path)
 		if self._chat_template_path is None and self._chat_template is not None:
@@ -600,67 +1432,53 @@ class OSSClient(OpenaiClientBase):
 							  'completion_tokens': resp['usage'].get('output_tokens', 0)})
 		return resp
 
-	def _send(self, data: JSONOBJ) -> RESPONSE:
-		if 'gpt' in self.model_name.lower() and data.get('extra_body') is None:
-			if not self._enable_thinking:
-				data['reasoning'] = {'effort':'low'}
-			if 'tools' in data:
-				data['tools'] = [self._to_response_API_tool(tool) for tool in data['tools']]
-				data['tool_choice'] = 'auto'
+	def _use_response_API(self, data: JSONOBJ) -> bool:
+		return 'gpt' in self.model_name.lower() and data.get('extra_body') is None
 
-			data['input'] = [inp for i, msg in enumerate(data.pop('messages', []))
-							 for inp in self._to_response_API_message(msg, index=i)]
+	def _to_response_API_request(self, data: JSONOBJ) -> JSONOBJ:
+		if not self._enable_thinking:
+			data['reasoning'] = {'effort':'low'}
+		if 'tools' in data:
+			data['tools'] = [self._to_response_API_tool(tool) for tool in data['tools']]
+			data['tool_choice'] = 'auto'
 
-			if 'max_tokens' in data:
-				data['max_output_tokens'] = data.pop('max_tokens')
-			if 'seed' in data:
-				data.pop('seed')
+		data['input'] = [inp for i, msg in enumerate(data.pop('messages', []))
+						 for inp in self._to_response_API_message(msg, index=i)]
 
-			errs = []
-			resp = None
-			for _ in range(3):
-				try:
-					resp = self.endpoint.responses.create(**data).model_dump()
-				except openai.BadRequestError as e:
-					errs.append(e)
-				else:
-					break
-			if resp is None:
-				print(f'Multiple errors when sending request to {self.ident} with data:')
-				print(json.dumps(data, indent=2, ensure_ascii=False))
+		if 'max_tokens' in data:
+			data['max_output_tokens'] = data.pop('max_tokens')
+		if 'seed' in data:
+			data.pop('seed')
+		return data
 
-				print(f'Errors:')
-				for e in errs:
-					print(f'- {e}')
+	def _report_response_API_errors(self, data: JSONOBJ, errs: List[Exception]):
+		print(f'Multiple errors when sending request to {self.ident} with data:')
+		print(json.dumps(data, indent=2, ensure_ascii=False))
 
-				raise errs[-1]
-			return self._from_response_API_response(resp)
-		if self._tokenizer is None:
-			return super()._send(data)
+		print(f'Errors:')
+		for e in errs:
+			print(f'- {e}')
+
+		raise errs[-1]
 
+	def _render_prompt(self, data: JSONOBJ) -> JSONOBJ:
+		"""
+		Replaces the messages (and tools/documents) in `data` with the prompt rendered using the local chat template.
+
+		:return: the removed entries, which should be put back with `_restore_request` once the request is sent.
+		"""
 		tools, docs = data.pop('tools', None), data.pop('documents', None)
-		data.pop('tool_choice', None)
+		tool_choice = data.pop('tool_choice', None)
 		chat = data.pop('messages', None)
+		removed = {'tools': tools, 'documents': docs, 'tool_choice': tool_choice, 'messages': chat}
 		if chat is not None:
-			tok_args = {
-				'tokenize': False,
-				'tools': tools,
-				'documents': docs,
-				'add_generation_prompt': self._add_generation_prompt,
-				'continue_final_message': self._continue_final_message,
-				'chat_template': self._chat_template,
-			}
-			if 'qwen' in self.model_name.lower():
-				tok_args['enable_thinking'] = self._enable_thinking
-
-
 			try:
 				if 'mistral' in self.model_name.lower():
 					from mistral_common.protocol.instruct.request import ChatCompletionRequest
 					tokenized = self._tokenizer.encode_chat_completion(ChatCompletionRequest(messages=chat, tools=tools))
 					prompt = tokenized.text
 				else:
-					prompt = self._tokenizer.apply_chat_template(chat, **tok_args)
+					prompt = self._apply_chat_template(chat, tools=tools, documents=docs)
 
 			except Exception:
 				# pretty print
@@ -669,20 +1487,172 @@ class OSSClient(OpenaiClientBase):
 
 				print(f'Using Chat template: {self._chat_template_path}')
 				print(self._chat_template)
+				self._restore_request(data, removed)
 				raise
 
 			data['prompt'] = prompt
+		return removed
+
+	def _apply_chat_template(self, chat: CHAT, *, tools: Optional[List[JSONOBJ]] = None,
+							 documents: Optional[List[JSONOBJ]] = None) -> str:
+		tok_args = {
+			'tokenize': False,
+			'tools': tools,
+			'documents': documents,
+			'add_generation_prompt': self._add_generation_prompt,
+			'continue_final_message': self._continue_final_message,
+			'chat_template': self._chat_template,
+		}
+		if 'qwen' in self.model_name.lower():
+			tok_args['enable_thinking'] = self._enable_thinking
+		if self._render_cache is None:
+			return self._tokenizer.apply_chat_template(chat, **tok_args)
+		return self._render_cache.render(
+			self._render_context(tok_args), chat,
+			lambda msgs, gen: self._tokenizer.apply_chat_template(msgs, **{**tok_args, 'add_generation_prompt': gen}),
+			add_generation_prompt=self._add_generation_prompt, incremental=not self._continue_final_message)
+
+	def _schedule_key(self, data: JSONOBJ) -> str:
+		# with the render cache, the prompt rendered here is reused when the request is sent
+		if self._tokenizer is not None and self._render_cache is not None and 'messages' in data \
+				and 'mistral' not in self.model_name.lower():
+			return self._apply_chat_template(data['messages'], tools=data.get('tools'), documents=data.get('documents'))
+		return super()._schedule_key(data)
+
+	def _template_overhead(self, chat: CHAT, tools: Optional[List[JSONOBJ]]) -> int:
+		"""Tokens of the rendered chat with all message contents removed."""
+		skeleton = [{**m, 'content': ''} if isinstance(m.get('content'), str) else m for m in chat]
+		key = 'template:' + hash_str(json.dumps([skeleton, tools], sort_keys=True, default=str))
+		try:
+			return self._cached_count(key, lambda: self._count_text_tokens(
+				self._apply_chat_template(skeleton, tools=tools)))
+		except Exception: # e.g. templates that reject empty messages
+			return super()._template_overhead(chat, tools)
+
+	def _render_context(self, tok_args: JSONOBJ) -> str:
+		"""Identifies everything besides the messages which affects the rendered prompt."""
+		if self._template_hash is None:
+			self._template_hash = hash_str(str(self._chat_template))
+		settings = {key: value for key, value in tok_args.items() if key != 'chat_template'}
+		return hash_str(json.dumps({'model': self.ident, 'template': self._template_hash, **settings},
+								   sort_keys=True, default=str))
+
+	@staticmethod
+	def _restore_request(data: JSONOBJ, removed: JSONOBJ):
+		for key, value in removed.items():
+			if value is not None:
+				data[key] = value
 
+	def _send(self, data: JSONOBJ) -> RESPONSE:
+		if self._use_response_API(data):
+			data = self._to_response_API_request(data)
+			errs = []
+			resp = None
+			for _ in range(3):
+				try:
+					resp = self._call(self.endpoint.responses.create, **data).model_dump()
+				except openai.BadRequestError as e:
+					errs.append(e)
+				else:
+					break
+			if resp is None:
+				self._report_response_API_errors(data, errs)
+			return self._from_response_API_response(resp)
+		if self._tokenizer is None:
+			return super()._send(data)
+
+		removed = self._render_prompt(data)
 		# print(data)
-		resp = self.endpoint.completions.create(**data).model_dump()
+		try:
+			if self._batcher is not None and data.get('n', 1) == 1 and not data.get('stream'):
+				return self._batcher.submit(json.dumps({k: v for k, v in data.items() if k != 'prompt'},
+													   sort_keys=True, default=str), (data, self._current_entry()))
+			return self._call(self.endpoint.completions.create, **data).model_dump()
+		finally:
+			self._restore_request(data, removed)
 
-		if tools is not None:
-			data['tools'] = tools
-		if docs is not None:
-			data['documents'] = docs
-		if chat is not None:
-			data['messages'] = chat
-		return resp
+	def _send_no_wait(self, data: JSONOBJ) -> Iterator[JSONOBJ]:
+		if self._tokenizer is None:
+			yield from super()._send_no_wait(data)
+			return
+		removed = self._render_prompt(data)
+		try:
+			stream = self._call(self.endpoint.completions.create, **data,
+								stream=True, stream_options={"include_usage": True})
+		finally:
+			self._restore_request(data, removed)
+		try:
+			for chunk in stream:
+				yield chunk.model_dump()
+		finally:
+			stream.close()
+
+	def _can_stop_at_answer(self, data: JSONOBJ) -> bool:
+		return super()._can_stop_at_answer(data) and not self._use_response_API(data)
+
+	_batch_shared_fields = ('retries', 'throttled', 'rate_wait')
+	def _send_batch(self, batch: List[Tuple[JSONOBJ, JSONOBJ]]) -> List[RESPONSE]:
+		"""
+		Sends the completion requests in `batch` (pairs of the request and its history record, which only differ in the
+		prompt) as one request and splits the response, so each request gets its own choice and token usage.
+
+		The retries and rate limit waits of the batch are counted for every request in it (they all waited for them),
+		not just for the one which sent the batch.
+		"""
+		leader = self._current_entry()
+		before = {key: leader.get(key, 0) for key in self._batch_shared_fields}
+		try:
+			return self._send_batch_request([data for data, _ in batch])
+		finally:
+			for key in self._batch_shared_fields:
+				delta = leader.get(key, 0) - before[key]
+				if delta:
+					for _, entry in batch:
+						if entry is not leader:
+							entry[key] = entry.get(key, 0) + delta
+
+	def _send_batch_request(self, batch: List[JSONOBJ]) -> List[RESPONSE]:
+		if len(batch) == 1:
+			return [self._call(self.endpoint.completions.create, **batch[0]).model_dump()]
+		params = {key: value for key, value in batch[0].items() if key != 'prompt'}
+		resp = self._call(self.endpoint.completions.create, prompt=[data['prompt'] for data in batch],
+						  **params).model_dump()
+		choices = sorted(resp['choices'], key=lambda choice: choice['index'])
+		assert len(choices) == len(batch), f'Expected {len(batch)} choices, got {len(choices)}'
+		# the usage is only reported for the whole batch
+		return [{**resp, 'choices': [{**choice, 'index': 0}],
+				 'usage': {'prompt_tokens': self._count_text_tokens(data['prompt']),
+						   'completion_tokens': self._count_text_tokens(choice.get('text') or '')}}
+				for data, choice in zip(batch, choices)]
+
+	def _count_text_tokens(self, text: str) -> int:
+		return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+	async def _asend(self, data: JSONOBJ) -> RESPONSE:
+		if self.async_endpoint is None:
+			return await ClientBase._asend(self, data)
+		if self._use_response_API(data):
+			data = self._to_response_API_request(data)
+			errs = []
+			resp = None
+			for _ in range(3):
+				try:
+					resp = (await self._acall(self.async_endpoint.responses.create, **data)).model_dump()
+				except openai.BadRequestError as e:
+					errs.append(e)
+				else:
+					break
+			if resp is None:
+				self._report_response_API_errors(data, errs)
+			return self._from_response_API_response(resp)
+		if self._tokenizer is None:
+			return await super()._asend(data)
+
+		removed = self._render_prompt(data)
+		try:
+			return (await self._acall(self.async_endpoint.completions.create, **data)).model_dump()
+		finally:
+			self._restore_request(data, removed)
 
 	_model_tokenizer_key = {
 		'openai-gpt-oss-120b': 'openai/gpt-oss-120b',
@@ -721,6 +1691,7 @@ class OSSClient(OpenaiClientBase):
 	_default_chat_template = '{root}/tools-{tool_style}/{model_name}.jinja'
 	def prepare(self) -> 'Self':
 		super().prepare()
+		self._template_hash = None
 		# self._max_model_len = info['data'][0].get('max_model_len', None)
 		# if self.max_tokens is None:
 		# 	self.max_tokens = self._max_model_len
@@ -845,6 +1816,281 @@ class vllm_Client(OSSClient):
 			return False
 
 
+class _Replica:
+	def __init__(self, addr: str, endpoint: openai.OpenAI):
+		self.addr = addr
+		self.endpoint = endpoint
+		self.async_endpoints = weakref.WeakKeyDictionary() # event loop -> async twin of the endpoint
+		self.outstanding = 0
+		self.outstanding_tokens = 0
+		self.healthy = True
+		self.retry_at = 0.
+		self.failures = 0
+
+	def load(self, balance: str) -> int:
+		return self.outstanding_tokens if balance == 'tokens' else self.outstanding
+
+
+@fig.component('multi-vllm')
+class MultiVllm_Client(vllm_Client):
+	"""
+	Balances the requests over several identical vllm replicas.
+
+	Each request goes to the healthy replica with the fewest outstanding requests (or tokens), except that with
+	`affinity` a chat continuing an earlier request stays on the same replica (for prefix cache hits). Replicas that
+	fail (after the usual retries) are skipped for `health_interval` seconds and the request is sent to the next one.
+	"""
+	def __init__(self, addrs: List[Union[str, int]], *, balance: str = 'requests', affinity: bool = True,
+				 health_interval: float = 30., max_sessions: int = 4096, **kwargs):
+		assert len(addrs), f'No replica addresses given'
+		assert balance in ('requests', 'tokens'), f'Unknown balance: {balance}'
+		addrs = [self._to_full_addr(addr) for addr in addrs]
+		super().__init__(addr=addrs[0], **kwargs)
+		self._active_replica = ContextVar(f'active_replica_{id(self)}', default=None)
+		self._excluded = ContextVar(f'excluded_replicas_{id(self)}', default=())
+		self.replicas = [_Replica(addr, self._connect(addr, timeout=self.timeout,
+													  share_connections=self._share_connections)) for addr in addrs]
+		self.balance = balance
+		self.affinity = affinity
+		self.health_interval = health_interval
+		self._max_sessions = max_sessions
+		self._sessions = OrderedDict()
+		self._replica_lock = threading.Lock()
+
+	@property
+	def endpoint(self) -> openai.OpenAI:
+		replica = self._active_replica.get()
+		return self._endpoint if replica is None else replica.endpoint
+
+	@endpoint.setter
+	def endpoint(self, endpoint: openai.OpenAI):
+		self._endpoint = endpoint
+
+	@property
+	def async_endpoint(self) -> Optional[openai.AsyncOpenAI]:
+		replica = self._active_replica.get()
+		if replica is None:
+			return super().async_endpoint
+		loop = asyncio.get_running_loop()
+		if loop not in replica.async_endpoints:
+			replica.async_endpoints[loop] = self._build_async_endpoint()
+		return replica.async_endpoints[loop]
+
+	def json(self) -> JSONOBJ:
+		info = super().json()
+		info['addr'] = [replica.addr for replica in self.replicas]
+		info['balance'] = self.balance
+		info['affinity'] = self.affinity
+		return info
+
+	def _in_flight_key(self) -> str:
+		return ','.join(replica.addr for replica in self.replicas)
+
+	@contextmanager
+	def _using(self, replica: _Replica):
+		token = self._active_replica.set(replica)
+		try:
+			yield replica
+		finally:
+			self._active_replica.reset(token)
+
+	def check_health(self) -> List[str]:
+		"""Pings all replicas, returns the addresses of the healthy ones."""
+		for replica in self.replicas:
+			with self._using(replica):
+				replica.healthy = self.ping()
+			if not replica.healthy:
+				replica.retry_at = time.time() + self.health_interval
+		return [replica.addr for replica in self.replicas if replica.healthy]
+
+	def prepare(self) -> 'Self':
+		healthy = self.check_health()
+		if not healthy:
+			raise ConnectionError(f'None of the {len(self.replicas)} replicas are reachable')
+		replica = next(replica for replica in self.replicas if replica.healthy)
+		with self._using(replica):
+			super().prepare()
+		for replica in self.replicas:
+			if replica.healthy:
+				with self._using(replica):
+					model = self._server_model_info().get('data', [{}])[0].get('id')
+				if model != self._model_name:
+					print(f'WARNING: replica {replica.addr} serves {model!r} instead of {self._model_name!r}')
+		self._sessions.clear()
+		return self
+
+	def _session_replica(self, chat: Optional[CHAT]) -> Optional[_Replica]:
+		"""The replica which served an earlier request that this chat continues (if any)."""
+		if not self.affinity or not chat:
+			return None
+		for key in reversed(message_chain(chat)):
+			replica = self._sessions.get(key)
+			if replica is not None:
+				self._sessions.move_to_end(key)
+				return replica
+
+	def _remember_session(self, chat: Optional[CHAT], replica: _Replica) -> None:
+		if self.affinity and chat:
+			with self._replica_lock:
+				self._sessions[message_chain(chat)[-1]] = replica
+				while len(self._sessions) > self._max_sessions:
+					self._sessions.popitem(last=False)
+
+	def _pick(self, data: JSONOBJ, tried: List[_Replica]) -> Optional[_Replica]:
+		now = time.time()
+		with self._replica_lock:
+			options = [r for r in self.replicas if r not in tried and (r.healthy or r.retry_at <= now)]
+			if not options: # maybe the unhealthy replicas are back
+				options = [r for r in self.replicas if r not in tried]
+			if not options:
+				return None
+			replica = self._session_replica(data.get('messages'))
+			if replica not in options:
+				replica = min(options, key=lambda r: r.load(self.balance))
+			return replica
+
+	def _request_cost(self, data: JSONOBJ) -> int:
+		if self.balance != 'tokens':
+			return 1
+		prompt = data.get('messages', data.get('prompt', ''))
+		return self.count_tokens(prompt, tools=data.get('tools')) + (data.get('max_tokens') or 0)
+
+	@staticmethod
+	def _is_failover_error(error: Exception) -> bool:
+		return isinstance(error, openai.APIConnectionError) \
+			or (isinstance(error, openai.APIStatusError) and error.status_code >= 500)
+
+	def _begin(self, replica: _Replica, cost: int) -> None:
+		with self._replica_lock:
+			replica.outstanding += 1
+			replica.outstanding_tokens += cost
+		entry = self._current_entry()
+		entry.setdefault('replicas', []).append(replica.addr)
+
+	def _end(self, replica: _Replica, cost: int, error: Optional[Exception]) -> None:
+		with self._replica_lock:
+			replica.outstanding -= 1
+			replica.outstanding_tokens -= cost
+			if error is None:
+				replica.healthy = True
+			else:
+				replica.failures += 1
+				replica.healthy = False
+				replica.retry_at = time.time() + self.health_interval
+		if error is not None:
+			print(f'WARNING: replica {replica.addr} failed ({type(error).__name__}: {error}), failing over')
+
+	def _send(self, data: JSONOBJ) -> RESPONSE:
+		if self._active_replica.get() is not None: # already routed (e.g. async requests sent from a thread)
+			return super()._send(data)
+		cost = self._request_cost(data)
+		tried = list(self._excluded.get())
+		while True:
+			replica = self._pick(data, tried)
+			original = dict(data)
+			self._begin(replica, cost)
+			try:
+				with self._using(replica):
+					resp = super()._send(data)
+			except Exception as e:
+				self._end(replica, cost, e)
+				tried.append(replica)
+				if not self._is_failover_error(e) or len(tried) == len(self.replicas):
+					raise
+				data.clear()
+				data.update(original)
+			else:
+				self._end(replica, cost, None)
+				self._remember_session(data.get('messages'), replica)
+				return resp
+
+	async def _asend(self, data: JSONOBJ) -> RESPONSE:
+		if self._active_replica.get() is not None:
+			return await super()._asend(data)
+		cost = self._request_cost(data)
+		tried = list(self._excluded.get())
+		while True:
+			replica = self._pick(data, tried)
+			original = dict(data)
+			self._begin(replica, cost)
+			try:
+				with self._using(replica):
+					resp = await super()._asend(data)
+			except asyncio.CancelledError: # e.g. a hedge that lost
+				self._end(replica, cost, None)
+				raise
+			except Exception as e:
+				self._end(replica, cost, e)
+				tried.append(replica)
+				if not self._is_failover_error(e) or len(tried) == len(self.replicas):
+					raise
+				data.clear()
+				data.update(original)
+			else:
+				self._end(replica, cost, None)
+				self._remember_session(data.get('messages'), replica)
+				return resp
+
+	@contextmanager
+	def _excluding_primary(self):
+		"""Keeps the hedge of a request away from the replicas the request was sent to (unless there is no other one)."""
+		busy = set(self._current_entry().get('replicas', ()))
+		excluded = tuple(replica for replica in self.replicas if replica.addr in busy)
+		token = self._excluded.set(() if len(excluded) == len(self.replicas) else excluded)
+		try:
+			yield
+		finally:
+			self._excluded.reset(token)
+
+	def _send_hedge(self, data: JSONOBJ) -> RESPONSE:
+		with self._excluding_primary():
+			return self._deliver(data)
+
+	async def _asend_hedge(self, data: JSONOBJ) -> RESPONSE:
+		with self._excluding_primary():
+			return await self._adeliver(data)
+
+	def _send_no_wait(self, data: JSONOBJ) -> Iterator[JSONOBJ]:
+		if self._active_replica.get() is not None:
+			yield from super()._send_no_wait(data)
+			return
+		cost = self._request_cost(data)
+		replica = self._pick(data, [])
+		self._begin(replica, cost)
+		error = None
+		try:
+			with self._using(replica): # the stream is opened with the first chunk
+				chunks = super()._send_no_wait(data)
+				first = next(chunks, None)
+			if first is not None:
+				yield first
+				yield from chunks
+		except Exception as e:
+			error = e
+			raise
+		finally: # also when the caller stops the stream early
+			self._end(replica, cost, error if error is not None and self._is_failover_error(error) else None)
+			if error is None:
+				self._remember_session(data.get('messages'), replica)
+
+	def stats(self, starting_from: int = 0, scope: RequestScope = None) -> JSONOBJ:
+		summary = super().stats(starting_from=starting_from, scope=scope)
+		history = self._history_window(starting_from, scope)
+		replicas = {}
+		for replica in self.replicas:
+			served = [h for h in history if h.get('replicas', [None])[-1] == replica.addr and 'end_time' in h]
+			times = [h['end_time'] - h['start_time'] for h in served]
+			replicas[replica.addr] = {
+				'requests': len(served),
+				'latency': sum(times) / len(times) if times else None,
+				'outstanding': replica.outstanding,
+				'failures': replica.failures,
+				'healthy': replica.healthy,
+			}
+		summary['replicas'] = replicas
+		return summary
+
+
 @fig.component('saia')
 class SAIA_Client(OSSClient, LiveClient):
 	@fig.silent_config_args('api_key')
@@ -962,10 +2208,17 @@ class Logged(ClientBase):
 				 log_dir: str = '{"azure" if "azure" in client.__class__.__name__.lower() else '
 								'"vllm" if "vllm" in client.__class__.__name__.lower() else "openai"}'
 								'_{now.strftime("%y%m%d-%H%M%S")}_{unique[:4]}', log_root: Path = _default_request_log_root,
-				 no_log: bool = False, **kwargs):
+				 no_log: bool = False, log_format: str = 'files', **kwargs):
+		"""
+		:param log_format: 'files' (one json file per request and response) or 'compact' (all requests and responses are
+		appended to a few compressed segments by a background thread, see `RequestLog`)
+		"""
+		assert log_format in ('files', 'compact'), f'Unknown log format: {log_format!r}'
 		log_root = Path(log_root)
 		super().__init__(**kwargs)
 		self._active = not no_log
+		self._log_format = log_format
+		self._request_log = None
 		self._log_request_fmt = log_request
 		self._log_response_fmt = log_response
 		self._log_root = log_root
@@ -973,6 +2226,7 @@ class Logged(ClientBase):
 		self._log_dir = None
 		self._codes = {}
 		self._num_requests = 0
+		self._log_lock = threading.Lock()
 		now = datetime.now()
 		self._timestamp = now.strftime('%y%m%d-%H%M%S')
 
@@ -983,36 +2237,46 @@ class Logged(ClientBase):
 													 unique=urandom(16).hex())
 			self._log_dir.mkdir(parents=False, exist_ok=False)
 			json.dump(self.json(), self._log_dir.joinpath('client.json').open('w'), indent=2)
+			if self._log_format == 'compact':
+				self._request_log = RequestLog(self._log_dir)
 		return out
 
 	def json(self) -> JSONOBJ:
 		data = super().json()
 		if self._active:
 			data['log-dir'] = str(self._log_dir)
+			if self._log_format != 'files':
+				data['log-format'] = self._log_format
 		return data
 
-	def _log_request(self, payload: str):
-		n = self._num_requests
+	def _log_request(self, data: JSONOBJ):
+		with self._log_lock:
+			n = self._num_requests
+			self._num_requests += 1
+			self._codes[id(data)] = n # the same request object is passed on to `_record_response`
+		if self._request_log is not None:
+			self._request_log.append(n, 'request', data)
+			return
 		path = self._log_dir / pformat(self._log_request_fmt, client=self, now=datetime.now(), n=n, str=str)
 		# path = self._log_dir / self._log_request_fmt.format(client=self, now=datetime.now(), n=n, str=str)
 		if path.suffix != '.json':
 			path = path.with_suffix('.json')
-		path.write_text(payload, encoding='utf-8')
-		self._codes[hash(payload)] = self._num_requests
-		self._num_requests += 1
+		path.write_text(json.dumps(data, indent=2), encoding='utf-8')
 
 	def _record_send(self, data: JSONOBJ):
 		if self._active:
-			payload = json.dumps(data, indent=2)
-			self._log_request(payload)
+			self._log_request(data)
 		return super()._record_send(data)
 
 	def _record_response(self, data: JSONOBJ, resp: JSONOBJ):
 		if self._active:
-			payload = json.dumps(data, indent=2)
-			if hash(payload) not in self._codes:
-				self._log_request(payload)
-			n = self._codes.pop(hash(payload))
+			if id(data) not in self._codes:
+				self._log_request(data)
+			with self._log_lock:
+				n = self._codes.pop(id(data))
+			if self._request_log is not None:
+				self._request_log.append(n, 'response', resp)
+				return super()._record_response(data, resp)
 			path = self._log_dir / pformat(self._log_response_fmt, client=self, now=datetime.now(), n=n, str=str)
 			if path.suffix != '.json':
 				path = path.with_suffix('.json')
@@ -1023,19 +2287,122 @@ class Logged(ClientBase):
 
 
 
+@fig.modifier('cached')
+class Cached(ClientBase):
+	"""
+	Reuses responses to identical requests (from an on-disk store shared across runs).
+
+	Responses are keyed by a hash of the full request payload (messages, model, seed, temperature, grammar, tools,
+	etc.), so a cached response is only used if the exact same request was sent before.
+
+	Modes:
+		- `read-write`: use cached responses and store new ones
+		- `read-only`: use cached responses, but don't store new ones
+		- `refresh`: always send the request and overwrite the cached response
+	"""
+	_default_cache_path = repo_root().joinpath('requests', 'cache.db')
+	_cache_modes = ('read-write', 'read-only', 'refresh')
+	def __init__(self, cache_path: Union[str, Path] = _default_cache_path, cache_mode: str = 'read-write',
+				 cache_max_size: Optional[int] = 2**30, no_cache: bool = False, **kwargs):
+		assert cache_mode in self._cache_modes, f'Unknown cache mode: {cache_mode!r} (options: {self._cache_modes})'
+		super().__init__(**kwargs)
+		self._cache_active = not no_cache
+		self._cache_path = Path(cache_path)
+		self._cache_mode = cache_mode
+		self._cache_max_size = cache_max_size
+		self._cache = None
+		self._replaying = ContextVar(f'replaying_{id(self)}', default=False)
+
+	def prepare(self) -> 'Self':
+		out = super().prepare()
+		if self._cache_active and self._cache is None:
+			self._cache = ResponseCache(self._cache_path, max_size=self._cache_max_size)
+		return out
+
+	def json(self) -> JSONOBJ:
+		data = super().json()
+		if self._cache_active:
+			data['cache'] = {'path': str(self._cache_path), 'mode': self._cache_mode}
+		return data
+
+	def _cache_key(self, data: JSONOBJ) -> str:
+		return hash_str(json.dumps({'client': self.ident, 'request': self._request_identity(data)}, sort_keys=True,
+								   ensure_ascii=False, default=str))
+
+	def _lookup(self, data: JSONOBJ) -> Tuple[Optional[str], Optional[RESPONSE]]:
+		if self._cache is None:
+			return None, None
+		key = self._cache_key(data)
+		if self._cache_mode == 'refresh':
+			return key, None
+		return key, self._cache.get(key)
+
+	def _new_entry(self, **info: JSONDATA) -> JSONOBJ:
+		if self._replaying.get(): # marked first, so the history keeps it out of the usage and latency totals
+			info = {'cache': 'hit', **info}
+		return super()._new_entry(**info)
+
+	def _replay(self, data: JSONOBJ, resp: RESPONSE) -> RESPONSE:
+		token = self._replaying.set(True)
+		try:
+			self._record_send(data)
+		finally:
+			self._replaying.reset(token)
+		self._record_response(data, resp)
+		return resp
+
+	def _store(self, key: Optional[str], resp: RESPONSE) -> None:
+		if key is None:
+			return
+		self._current_entry()['cache'] = 'miss'
+		if self._cache_mode != 'read-only':
+			self._cache.put(key, resp)
+
+	def send(self, data: JSONOBJ) -> JSONOBJ:
+		key, resp = self._lookup(data)
+		if resp is not None:
+			return self._replay(data, resp)
+		resp = super().send(data)
+		self._store(key, resp)
+		return resp
+
+	async def asend(self, data: JSONOBJ) -> JSONOBJ:
+		key, resp = self._lookup(data)
+		if resp is not None:
+			return self._replay(data, resp)
+		resp = await super().asend(data)
+		self._store(key, resp)
+		return resp
+
+	def stats(self, starting_from: int = 0, scope: RequestScope = None) -> JSONOBJ:
+		summary = super().stats(starting_from=starting_from, scope=scope)
+		if self._cache is not None:
+			window = self.history.window(starting_from, scope=scope)
+			summary['cache'] = {
+				'hits': window.total('cache_hits'),
+				'misses': window.total('cache_misses'),
+				'saved_input_tokens': window.total('cached_input_tokens'),
+				'saved_output_tokens': window.total('cached_output_tokens'),
+			}
+		return summary
+
+
+
 class Tool_Client(ClientBase):
-	def __init__(self, tools: Union[Dict[str, AbstractTool], Iterable[AbstractTool]] = None, **kwargs):
+	def __init__(self, tools: Union[Dict[str, AbstractTool], Iterable[AbstractTool]] = None, *,
+				 tool_workers: int = 4, tool_timeout: Optional[float] = None, **kwargs):
 		if tools is None:
 			tools = []
 		elif isinstance(tools, dict):
 			tools = tools.values()
 		super().__init__(**kwargs)
 		self.tools = {t.name: t for t in tools}
+		self._tool_executor = ToolExecutor(tool_workers, timeout=tool_timeout)
 
 	def _record_response(self, data: JSONOBJ, resp: RESPONSE):
 		super()._record_response(data, resp)
 		if resp['choices'][0]['message'].get('tool_calls'):
-			self.history[-1]['tool_calls'] = dict(Counter(call['function']['name'] for call in resp['choices'][0]['message']['tool_calls']))
+			self._current_entry()['tool_calls'] = dict(Counter(call['function']['name'] for call in resp['choices'][0]['message']['tool_calls']))
 
 	def stream_response(self, prompt: Union[str, List[Dict[str, str]]], **params) -> Iterator[str]:
 		if self.tools:
@@ -1049,14 +2416,18 @@ class Tool_Client(ClientBase):
 			args['tools'] = [tool.schema() for tool in self.tools.values()]
 		return args
 
-	def stats(self, starting_from: int = 0) -> JSONOBJ:
-		summary = super().stats(starting_from=starting_from)
-		if any('tool_calls' in h for h in self.history[starting_from:]):
+	def stats(self, starting_from: int = 0, scope: RequestScope = None) -> JSONOBJ:
+		summary = super().stats(starting_from=starting_from, scope=scope)
+		history = self._history_window(starting_from, scope)
+		if any('tool_calls' in h for h in history):
 			tool_calls = Counter()
-			for h in self.history[starting_from:]:
+			for h in history:
 				if 'tool_calls' in h:
 					tool_calls.update(h['tool_calls'])
 			summary['tool_calls'] = dict(tool_calls)
+		latency = self._tool_executor.stats()
+		if latency:
+			summary['tool_latency'] = latency
 		return summary
 
 	def json(self) -> JSONOBJ:
@@ -1065,6 +2436,10 @@ class Tool_Client(ClientBase):
 			data['tools'] = [tool.json() for tool in self.tools.values()]
 		return data
 
+	def close(self) -> None:
+		"""Stops the threads running the tool calls."""
+		self._tool_executor.close()
+
 	def register_tools(self, *tools: AbstractTool) -> 'Self':
 		for tool in tools:
 			self.tools[tool.name] = tool
@@ -1076,28 +2451,32 @@ class Tool_Client(ClientBase):
 			info['tools'] = [tool.json() for tool in self.tools.values()]
 		return info
 
+	@staticmethod
+	def _call_tool(tool: AbstractTool, arguments: JSONDATA) -> str:
+		try:
+			return tool.call(arguments)
+		except ToolError as e:
+			return str(e) if type(e) == ToolError else f'{e.__class__.__name__}: {e}'
+
 	def resolve_tool_calls(self, chat: CHAT) -> List[Dict[str, str]]:
-		tool_results = []
-		for item in reversed(chat):
-			if 'tool_calls' in item:
-				for tool_call in item['tool_calls']:
-					info = tool_call['function']
-					assert info['name'] in self.tools, f'Tool {info["name"]} not registered'
-					tool = self.tools[info['name']]
-					arguments = info['arguments']
-					if isinstance(arguments, str):
-						arguments = json.loads(arguments)
-					try:
-						result = tool.call(arguments)
-					except ToolError as e:
-						result = str(e) if type(e) == ToolError else f'{e.__class__.__name__}: {e}'
-					tool_results.append({'role': 'tool',
-										 'content': result,
-										 'tool_call_id': tool_call['id'],
-										 'name': info['name']})
-			else:
-				break
-		tool_results = list(reversed(tool_results))
+		"""Runs all calls of the trailing tool-call messages (concurrently), adds the results in the order of the calls."""
+		start = len(chat)
+		while start > 0 and 'tool_calls' in chat[start - 1]:
+			start -= 1
+		calls, jobs = [], []
+		for item in chat[start:]:
+			for tool_call in item['tool_calls']:
+				info = tool_call['function']
+				assert info['name'] in self.tools, f'Tool {info["name"]} not registered'
+				tool = self.tools[info['name']]
+				arguments = info['arguments']
+				if isinstance(arguments, str):
+					arguments = json.loads(arguments)
+				calls.append(tool_call)
+				jobs.append((tool, partial(self._call_tool, tool, arguments)))
+		tool_results = [{'role': 'tool', 'content': result, 'tool_call_id': tool_call['id'],
+						 'name': tool_call['function']['name']}
+						for tool_call, result in zip(calls, self._tool_executor.run(jobs))]
 		chat.extend(tool_results)
 		return tool_results
 
@@ -1109,6 +2488,14 @@ class Tool_Client(ClientBase):
 			return self.step(chat, auto_tool_rounds=None if auto_tool_rounds is None else auto_tool_rounds-1, **params)
 		return resp
 
+	async def astep(self, chat: CHAT, auto_tool_rounds: Optional[int] = None, **params) -> RESPONSE:
+		resp = await super().astep(chat, **params)
+		self.resolve_tool_calls(chat)
+		if (auto_tool_rounds is None or auto_tool_rounds >= 0) and chat[-1].get('role') == 'tool':
+			return await self.astep(chat, auto_tool_rounds=None if auto_tool_rounds is None else auto_tool_rounds-1,
+									**params)
+		return resp
+
 
 class Local_vllm_Client(ClientBase):
 	def __init__(self, model_name: str, *, max_tokens: int = None, seed: int = None,
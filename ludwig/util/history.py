@@ -0,0 +1,377 @@
+from .imports import *
+import math
+import tempfile
+import weakref
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+
+
+class _Entry(dict):
+	"""Record of one request, which mirrors its numeric fields into the columns of the `RequestHistory`."""
+	__slots__ = ('_history', '_index')
+
+	def __setitem__(self, key, value):
+		super().__setitem__(key, value)
+		self._history._changed(self._index, self, key)
+
+	def update(self, *args, **kwargs):
+		for key, value in dict(*args, **kwargs).items():
+			self[key] = value
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return super().__getitem__(key)
+
+	def __reduce__(self): # copies are plain dicts
+		return dict, (dict(self),)
+
+
+
+class _FenwickTree:
+	"""Prefix sums of a growing sequence (starting at 0), where appends, updates and queries take O(log n)."""
+	__slots__ = ('_tree',)
+
+	def __init__(self, typecode: str, size: int = 0):
+		self._tree = array(typecode, [0]) * (size + 1) # 1-based
+
+	def __len__(self) -> int:
+		return len(self._tree) - 1
+
+	def append(self) -> None:
+		"""Adds a 0 at the end."""
+		i = len(self._tree)
+		self._tree.append(self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+	def add(self, index: int, delta: Union[int, float]) -> None:
+		tree = self._tree
+		i = index + 1
+		while i < len(tree):
+			tree[i] += delta
+			i += i & -i
+
+	def prefix(self, stop: int) -> Union[int, float]:
+		"""Sum of the first `stop` values."""
+		tree = self._tree
+		total = 0
+		while stop > 0:
+			total += tree[stop]
+			stop -= stop & -stop
+		return total
+
+
+
+class _PrefixSums:
+	"""
+	Prefix sums of a growing sequence (starting at 0). Appends, changes of the last value and queries take O(1) until an
+	earlier value changes (e.g. a request finishing after later ones were sent), from then on those changes are kept in
+	a Fenwick tree, so all operations take O(log n).
+	"""
+	__slots__ = ('_prefix', '_late')
+
+	def __init__(self, typecode: str):
+		self._prefix = array(typecode, [0])
+		self._late = None
+
+	def append(self) -> None:
+		"""Adds a 0 at the end."""
+		self._prefix.append(self._prefix[-1])
+		if self._late is not None:
+			self._late.append()
+
+	def add(self, index: int, delta: Union[int, float]) -> None:
+		if index == len(self._prefix) - 2:
+			self._prefix[-1] += delta
+			return
+		if self._late is None:
+			self._late = _FenwickTree(self._prefix.typecode, len(self._prefix) - 1)
+		self._late.add(index, delta)
+
+	def prefix(self, stop: int) -> Union[int, float]:
+		"""Sum of the first `stop` values."""
+		total = self._prefix[stop]
+		if self._late is not None:
+			total += self._late.prefix(stop)
+		return total
+
+
+
+class _RangeExtremes:
+	"""Segment trees of the min and max of a growing sequence (of which values may be missing), queried in O(log n)."""
+	__slots__ = ('_size', '_length', '_min', '_max')
+
+	def __init__(self):
+		self._size = 1 # leaves, doubled when full
+		self._length = 0
+		self._min = array('d', [math.inf]) * 2
+		self._max = array('d', [-math.inf]) * 2
+
+	def append(self) -> None:
+		"""Adds a missing value at the end."""
+		if self._length == self._size:
+			size = 2 * self._size
+			mins, maxs = array('d', [math.inf]) * (2 * size), array('d', [-math.inf]) * (2 * size)
+			mins[size:size + self._size] = self._min[self._size:]
+			maxs[size:size + self._size] = self._max[self._size:]
+			for i in range(size - 1, 0, -1):
+				mins[i] = min(mins[2 * i], mins[2 * i + 1])
+				maxs[i] = max(maxs[2 * i], maxs[2 * i + 1])
+			self._size, self._min, self._max = size, mins, maxs
+		self._length += 1
+
+	def set(self, index: int, value: float) -> None:
+		mins, maxs = self._min, self._max
+		i = index + self._size
+		mins[i] = maxs[i] = value
+		i //= 2
+		while i:
+			lo, hi = min(mins[2 * i], mins[2 * i + 1]), max(maxs[2 * i], maxs[2 * i + 1])
+			if lo == mins[i] and hi == maxs[i]: # the nodes above don't change either
+				break
+			mins[i], maxs[i] = lo, hi
+			i //= 2
+
+	def query(self, start: int, stop: int) -> Tuple[float, float]:
+		"""Min and max of the values in `[start, stop)` (inf and -inf if there are none)."""
+		lo, hi = math.inf, -math.inf
+		start, stop = start + self._size, stop + self._size
+		while start < stop:
+			if start & 1:
+				lo, hi = min(lo, self._min[start]), max(hi, self._max[start])
+				start += 1
+			if stop & 1:
+				stop -= 1
+				lo, hi = min(lo, self._min[stop]), max(hi, self._max[stop])
+			start //= 2
+			stop //= 2
+		return lo, hi
+
+
+
+class RequestHistory:
+	"""
+	Records of all requests sent by a client (a sequence of dicts, which are updated while the request is processed).
+
+	The numeric fields (see `columns`, including the derived latency `time` and `tok_per_sec`) are also stored in
+	arrays together with prefix sums of their values and counts (see `_PrefixSums`), and segment trees of the min and
+	max of the measured (non-integer) columns, so the aggregates of any window of requests (see `window`) take at most
+	O(log n) instead of a pass over the records. Updating a field takes at most O(log n) as well, no matter how many
+	requests were added since (e.g. when a long request finishes late).
+
+	Records of cached responses (`cache='hit'`, which must be set first) don't count as traffic: their tokens go to the
+	`cached_*` columns instead, and they have no latency.
+
+	With `max_entries`, only the most recent records are kept in memory and older ones are moved to a temporary file
+	(from which they are read again when accessed), while the columns stay in memory. Records of requests that are
+	still running are rewritten in place when they are updated: each has a slot of twice its size, which is only
+	replaced by a larger one once it is full, so the file stays within a few times the size of the records.
+	"""
+	columns = ('input_tokens', 'output_tokens', 'estimated_input_tokens', 'retries', 'throttled', 'rate_wait',
+			   'prefix_shared', 'prefix_length', 'schedule_wait', 'hedged', 'hedge_won', 'coalesced', 'time', 'tok_per_sec',
+			   'cache_hits', 'cache_misses', 'cached_input_tokens', 'cached_output_tokens')
+	_integer_columns = frozenset({'input_tokens', 'output_tokens', 'estimated_input_tokens', 'retries', 'throttled',
+								  'prefix_shared', 'prefix_length', 'hedged', 'hedge_won', 'coalesced', 'cache_hits',
+								  'cache_misses', 'cached_input_tokens', 'cached_output_tokens'})
+	_cached_fields = {'input_tokens': 'cached_input_tokens', 'output_tokens': 'cached_output_tokens'}
+	_latency_fields = frozenset({'start_time', 'end_time', 'output_tokens'})
+
+	def __init__(self, entries: Iterable[JSONOBJ] = (), *, max_entries: Optional[int] = None):
+		assert max_entries is None or max_entries > 0, f'max_entries must be positive, got {max_entries}'
+		self.max_entries = max_entries
+		self._entries = deque()
+		self._first = 0 # index of the first record kept in memory
+		self._spill = None
+		self._offsets = array('q')
+		self._slots = array('q') # sizes of the slots in the spill file
+		self._values = {c: array('d') for c in self.columns}
+		self._present = {c: array('b') for c in self.columns}
+		self._sums = {c: _PrefixSums('d') for c in self.columns}
+		self._counts = {c: _PrefixSums('q') for c in self.columns}
+		self._extremes = {c: _RangeExtremes() for c in self.columns if c not in self._integer_columns}
+		self._scopes = weakref.WeakKeyDictionary() # scope -> indices of its requests
+		self._lock = threading.RLock()
+		for entry in entries:
+			self.append(entry)
+
+	def __len__(self) -> int:
+		return self._first + len(self._entries)
+
+	def __getitem__(self, item: Union[int, slice]) -> Union[JSONOBJ, List[JSONOBJ]]:
+		if isinstance(item, slice):
+			return [self[i] for i in range(*item.indices(len(self)))]
+		with self._lock:
+			if item < 0:
+				item += len(self)
+			if not 0 <= item < len(self):
+				raise IndexError(f'history index out of range: {item}')
+			if item < self._first:
+				return self._load(item)
+			return self._entries[item - self._first]
+
+	def __iter__(self) -> Iterator[JSONOBJ]:
+		for i in range(self._first):
+			yield self._load(i)
+		yield from list(self._entries)
+
+	def __repr__(self):
+		return f'{self.__class__.__name__}({len(self)} requests)'
+
+	def append(self, entry: JSONOBJ) -> JSONOBJ:
+		"""Adds a record, returns the (tracked) record which should be updated from now on."""
+		with self._lock:
+			index = len(self)
+			record = _Entry()
+			record._history = self
+			record._index = index
+			for c in self.columns:
+				self._values[c].append(0.)
+				self._present[c].append(0)
+				self._sums[c].append()
+				self._counts[c].append()
+			for extremes in self._extremes.values():
+				extremes.append()
+			self._entries.append(record)
+			for scope in entry.get('scopes', ()):
+				self._scopes.setdefault(scope, array('q')).append(index)
+			record.update(entry)
+			if self.max_entries is not None:
+				while len(self._entries) > self.max_entries:
+					self._move_to_disk(self._entries.popleft())
+		return record
+
+	def _changed(self, index: int, entry: JSONOBJ, key: str) -> None:
+		if index < self._first: # the request was still running when the record was moved to disk
+			with self._lock:
+				self._write(index, entry)
+		if key == 'cache':
+			self._set(index, 'cache_hits' if entry[key] == 'hit' else 'cache_misses', 1)
+			return
+		if entry.get('cache') == 'hit':
+			if key in self._cached_fields:
+				self._set(index, self._cached_fields[key], entry[key])
+			return
+		if key in self._values:
+			self._set(index, key, entry[key])
+		if key in self._latency_fields and 'end_time' in entry:
+			duration = entry['end_time'] - entry.get('start_time', 0)
+			self._set(index, 'time', duration)
+			if duration > 0:
+				self._set(index, 'tok_per_sec', (entry.get('output_tokens') or 0) / duration)
+
+	def _set(self, index: int, column: str, value: Optional[float]) -> None:
+		with self._lock:
+			values, present = self._values[column], self._present[column]
+			delta = float(value or 0) - values[index]
+			added = 1 - present[index]
+			values[index] += delta
+			present[index] = 1
+			self._sums[column].add(index, delta)
+			if added:
+				self._counts[column].add(index, added)
+			if column in self._extremes:
+				self._extremes[column].set(index, values[index])
+
+	def _write(self, index: int, entry: JSONOBJ) -> None:
+		"""Stores the record in its slot of the spill file (or in a new slot at the end if it doesn't fit anymore)."""
+		if self._spill is None:
+			self._spill = tempfile.TemporaryFile()
+		record = {key: value for key, value in entry.items() if key != 'scopes'}
+		line = json.dumps(record, default=str).encode('utf-8')
+		if index < len(self._offsets) and len(line) < self._slots[index]:
+			self._spill.seek(self._offsets[index])
+		else:
+			offset, size = self._spill.seek(0, 2), 2 * len(line) + 1
+			if index < len(self._offsets):
+				self._offsets[index], self._slots[index] = offset, size
+			else:
+				self._offsets.append(offset)
+				self._slots.append(size)
+		self._spill.write(line.ljust(self._slots[index] - 1) + b'\n')
+
+	def _move_to_disk(self, entry: JSONOBJ) -> None:
+		self._write(self._first, entry)
+		self._first += 1
+
+	def _load(self, index: int) -> JSONOBJ:
+		with self._lock:
+			self._spill.seek(self._offsets[index])
+			return json.loads(self._spill.readline())
+
+	def _members(self, start: int, scope: Any) -> List[int]:
+		indices = self._scopes.get(scope)
+		if indices is None:
+			return []
+		return indices[bisect_left(indices, start):].tolist()
+
+	def entries(self, start: int = 0, *, scope: Any = None) -> List[JSONOBJ]:
+		"""Records from `start` on (only those sent in the `scope`, if given)."""
+		if scope is None:
+			return self[start:]
+		with self._lock:
+			return [self[i] for i in self._members(start, scope)]
+
+	def window(self, start: int = 0, *, scope: Any = None) -> 'HistoryWindow':
+		"""Aggregates of the columns of the records from `start` on (only those sent in the `scope`, if given)."""
+		with self._lock:
+			stop = len(self)
+			return HistoryWindow(self, max(0, min(start, stop)), stop,
+								 None if scope is None else self._members(start, scope))
+
+	def close(self) -> None:
+		if self._spill is not None:
+			self._spill.close()
+
+
+
+class HistoryWindow:
+	"""Aggregates of a range of a `RequestHistory` (or of the given records of that range)."""
+	def __init__(self, history: RequestHistory, start: int, stop: int, indices: Optional[List[int]] = None):
+		self.history = history
+		self.start = start
+		self.stop = stop
+		self.indices = indices
+
+	def __len__(self) -> int:
+		return self.stop - self.start if self.indices is None else len(self.indices)
+
+	def count(self, column: str) -> int:
+		"""Number of records which have a value for `column`."""
+		if self.indices is None:
+			counts = self.history._counts[column]
+			return counts.prefix(self.stop) - counts.prefix(self.start)
+		present = self.history._present[column]
+		return sum(present[i] for i in self.indices)
+
+	def total(self, column: str) -> Union[int, float]:
+		if self.indices is None:
+			sums = self.history._sums[column]
+			total = sums.prefix(self.stop) - sums.prefix(self.start)
+		else:
+			values = self.history._values[column]
+			total = sum(values[i] for i in self.indices)
+		return round(total) if column in self.history._integer_columns else total
+
+	def values(self, column: str) -> List[float]:
+		values, present = self.history._values[column], self.history._present[column]
+		if self.indices is None:
+			return list(compress(values[self.start:self.stop], present[self.start:self.stop]))
+		return [values[i] for i in self.indices if present[i]]
+
+	def metrics(self, column: str) -> Union[None, float, JSONFLAT]:
+		"""
+		The value if there is only one, otherwise the mean, min and max (None if there are no values). Without `indices`
+		this takes O(log n) for the measured (non-integer) columns, otherwise a pass over the values.
+		"""
+		count = self.count(column)
+		if not count:
+			return None
+		extremes = self.history._extremes.get(column)
+		if self.indices is None and extremes is not None:
+			lo, hi = extremes.query(self.start, self.stop)
+			return lo if count == 1 else {'mean': self.total(column) / count, 'min': lo, 'max': hi}
+		values = self.values(column)
+		if count == 1:
+			return values[0]
+		return {'mean': sum(values) / count, 'min': min(values), 'max': max(values)}
@@ -497,3 +497,40 @@ def find_first(pattern, text) -> Optional[re.Match]:
 
 
 
+
+
+
+class AnswerDetector:
+	"""
+	Incrementally matches a streamed response against `pattern` to detect as soon as it contains a complete answer.
+
+	A match only counts once some text follows it (so an answer cut off mid-word is not accepted), and anything inside
+	a leading `<think>...</think>` block is ignored.
+	"""
+	_think_start, _think_end = '<think>', '</think>'
+	def __init__(self, pattern: Union[str, re.Pattern], *, window: int = 512):
+		self.pattern = re.compile(pattern, re.IGNORECASE) if isinstance(pattern, str) else pattern
+		self.window = window
+		self._buffer = ''
+		self._thinking = None
+
+	def fresh(self) -> 'AnswerDetector':
+		"""A new detector with the same pattern (for the next response)."""
+		return self.__class__(self.pattern, window=self.window)
+
+	def feed(self, delta: str) -> bool:
+		self._buffer += delta
+		if self._thinking is None:
+			head = self._buffer.lstrip()
+			if len(head) < len(self._think_start) and self._think_start.startswith(head):
+				return False
+			self._thinking = head.startswith(self._think_start)
+		if self._thinking:
+			end = self._buffer.find(self._think_end)
+			if end < 0:
+				self._buffer = self._buffer[-len(self._think_end):]
+				return False
+			self._buffer = self._buffer[end + len(self._think_end):]
+			self._thinking = False
+		self._buffer = self._buffer[-self.window:]
+		return any(match.end() < len(self._buffer) for match in self.pattern.finditer(self._buffer))
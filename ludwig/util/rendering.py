@@ -0,0 +1,135 @@
+from .imports import *
+from collections import OrderedDict
+from .files import hash_str
+
+
+
+def message_chain(chat: List[JSONOBJ]) -> List[str]:
+	"""Hashes of all prefixes of the chat (the i-th hash identifies the first i+1 messages)."""
+	hashes = []
+	prev = ''
+	for msg in chat:
+		prev = hash_str(prev + json.dumps(msg, sort_keys=True, default=str))
+		hashes.append(prev)
+	return hashes
+
+
+
+class RenderCache:
+	"""
+	Memoizes chat template renderings, so multi-turn chats do not have to render the whole (growing) chat every turn.
+
+	Renderings are keyed by a `context` (which should identify the template, tools and settings) and the hashes of the
+	messages. With `incremental`, a chat that extends a previously rendered chat only renders the new messages (together
+	with the last message of the previous chat, whose rendering is then removed). That is only correct for templates
+	where the rendering of a chat is a prefix of the rendering of every extension of the chat, so the first `verify`
+	incremental renderings of each context (or all of them with `check`) are compared to the full rendering, and the
+	context falls back to full renderings after any mismatch.
+	"""
+	def __init__(self, *, incremental: bool = False, verify: int = 3, check: bool = False, max_entries: int = 1024):
+		self.incremental = incremental or check
+		self.verify = verify
+		self.check = check
+		self.max_entries = max_entries
+		self._entries = OrderedDict()
+		self._verified: Dict[str, int] = {} # number of verified incremental renderings (-1 if disabled)
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.incremental_renders = 0
+		self.full_renders = 0
+		self.mismatches = 0
+
+	def stats(self) -> JSONFLAT:
+		return {'hits': self.hits, 'incremental': self.incremental_renders, 'full': self.full_renders,
+				'mismatches': self.mismatches}
+
+	def _get(self, key: Tuple) -> Optional[str]:
+		with self._lock:
+			value = self._entries.get(key)
+			if value is not None:
+				self._entries.move_to_end(key)
+			return value
+
+	def _put(self, key: Tuple, value: str) -> None:
+		with self._lock:
+			self._entries[key] = value
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+	def render(self, context: str, chat: List[JSONOBJ], render_fn: Callable[[List[JSONOBJ], bool], str], *,
+			   add_generation_prompt: bool = True, incremental: bool = True) -> str:
+		"""
+		Returns `render_fn(chat, add_generation_prompt)` (using cached renderings where possible).
+
+		:param render_fn: renders the given messages, with or without the generation prompt
+		:param incremental: set to False for settings that never allow incremental rendering for this call
+		"""
+		hashes = message_chain(chat)
+		if not hashes:
+			return render_fn(chat, add_generation_prompt)
+		out = self._get(('out', context, hashes[-1], add_generation_prompt))
+		if out is not None:
+			self.hits += 1
+			return out
+
+		incremental = incremental and self.incremental and self._verified.get(context, 0) >= 0
+		rendered = None
+		if incremental:
+			rendered = self._render_incremental(context, chat, hashes, render_fn, add_generation_prompt)
+		if rendered is not None:
+			out, prefix = rendered
+			if self.check or self._verified.get(context, 0) < self.verify:
+				full = render_fn(chat, add_generation_prompt)
+				if full != out:
+					self.mismatches += 1
+					self._verified[context] = -1
+					if self.check:
+						print(f'WARNING: incremental chat template rendering differs from the full rendering, '
+							  f'falling back to full renderings')
+					out, prefix = full, None
+				elif self._verified.get(context, 0) >= 0:
+					self._verified[context] = self._verified.get(context, 0) + 1
+			self.incremental_renders += 1
+		else:
+			out = render_fn(chat, add_generation_prompt)
+			prefix = None
+			if incremental:
+				prefix = render_fn(chat, False) if add_generation_prompt else out
+			self.full_renders += 1
+
+		self._put(('out', context, hashes[-1], add_generation_prompt), out)
+		if prefix is not None:
+			self._put(('prefix', context, hashes[-1]), prefix)
+		return out
+
+	def _render_incremental(self, context: str, chat: List[JSONOBJ], hashes: List[str],
+							render_fn: Callable[[List[JSONOBJ], bool], str],
+							add_generation_prompt: bool) -> Optional[Tuple[str, str]]:
+		"""Renders the chat from the longest cached prefix, returns the rendering with and without generation prompt."""
+		for k in range(len(chat), 0, -1):
+			prefix = self._get(('prefix', context, hashes[k - 1]))
+			if prefix is not None:
+				break
+		else:
+			return None
+		try:
+			if k < len(chat):
+				anchor = render_fn(chat[k - 1:k], False)
+				extension = render_fn(chat[k - 1:], False)
+				if not extension.startswith(anchor):
+					return None
+				prefix = prefix + extension[len(anchor):]
+			if not add_generation_prompt:
+				return prefix, prefix
+			generation = self._get(('generation', context))
+			if generation is None:
+				last = chat[-1:]
+				bare, full = render_fn(last, False), render_fn(last, True)
+				if not full.startswith(bare):
+					return None
+				generation = full[len(bare):]
+				self._put(('generation', context), generation)
+			return prefix + generation, prefix
+		except Exception: # e.g. templates which require the chat to start with a user message
+			return None
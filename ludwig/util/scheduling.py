@@ -0,0 +1,271 @@
+from .imports import *
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+
+
+
+def common_prefix_length(a: str, b: str) -> int:
+	"""Length of the longest common prefix (by bisection, so the comparisons run on whole slices)."""
+	lo, hi = 0, min(len(a), len(b))
+	while lo < hi:
+		mid = (lo + hi + 1) // 2
+		if a[:mid] == b[:mid]:
+			lo = mid
+		else:
+			hi = mid - 1
+	return lo
+
+
+
+class _Waiter:
+	def __init__(self, key: str, shared: int, wake: Callable[[], None]):
+		self.key = key
+		self.shared = shared
+		self.skips = 0
+		self.wake = wake
+
+
+
+class PrefixScheduler:
+	"""
+	Limits the number of concurrent requests to `slots`, and whenever a slot frees up, dispatches the waiting request
+	whose key (e.g. the rendered prompt) shares the longest prefix with the recently dispatched requests. That way
+	requests with a common prefix (few-shot examples, long contexts, growing chats) run back-to-back and can reuse the
+	server's prefix cache instead of evicting each other.
+
+	A request that was passed over `max_skips` times is dispatched next regardless of its prefix.
+	"""
+	def __init__(self, slots: int, *, max_skips: int = 32, recent: int = 8):
+		assert slots > 0, f'slots must be a positive integer, got {slots}'
+		self.slots = slots
+		self.max_skips = max_skips
+		self._recent = deque(maxlen=max(recent, slots))
+		self._waiting: List[_Waiter] = []
+		self._running = 0
+		self._lock = threading.Lock()
+		self.dispatched = 0
+		self.reordered = 0
+
+	def _best_shared(self, key: str) -> int:
+		return max((common_prefix_length(key, other) for other in self._recent), default=0)
+
+	def _enqueue(self, key: str, wake: Callable[[], None]) -> Union[int, _Waiter]:
+		with self._lock:
+			if self._running < self.slots and not self._waiting:
+				return self._dispatch(key, self._best_shared(key))
+			waiter = _Waiter(key, self._best_shared(key), wake)
+			self._waiting.append(waiter)
+			return waiter
+
+	def acquire(self, key: str) -> int:
+		"""Waits for a free slot, returns the number of leading characters shared with a recent request."""
+		event = threading.Event()
+		waiter = self._enqueue(key, event.set)
+		if isinstance(waiter, int):
+			return waiter
+		event.wait()
+		return waiter.shared
+
+	async def aacquire(self, key: str) -> int:
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		def wake():
+			loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+		waiter = self._enqueue(key, wake)
+		if isinstance(waiter, int):
+			return waiter
+		try:
+			await future
+		except asyncio.CancelledError:
+			with self._lock:
+				granted = waiter not in self._waiting
+				if not granted:
+					self._waiting.remove(waiter)
+			if granted:
+				self.release()
+			raise
+		return waiter.shared
+
+	def release(self) -> None:
+		with self._lock:
+			self._running -= 1
+			if self._waiting:
+				starved = [i for i, w in enumerate(self._waiting) if w.skips >= self.max_skips]
+				pick = starved[0] if starved else max(range(len(self._waiting)),
+													  key=lambda i: (self._waiting[i].shared, -i))
+				if pick:
+					self.reordered += 1
+				waiter = self._waiting.pop(pick)
+				for other in self._waiting[:pick]:
+					other.skips += 1
+				self._dispatch(waiter.key, waiter.shared)
+				for other in self._waiting: # the new key may extend the shared prefix of the other waiters
+					other.shared = max(other.shared, common_prefix_length(other.key, waiter.key))
+				waiter.wake()
+
+	def _dispatch(self, key: str, shared: int) -> int:
+		self._running += 1
+		self.dispatched += 1
+		self._recent.append(key)
+		return shared
+
+	@contextmanager
+	def slot(self, key: str) -> Iterator[int]:
+		shared = self.acquire(key)
+		try:
+			yield shared
+		finally:
+			self.release()
+
+	def stats(self) -> JSONFLAT:
+		return {'dispatched': self.dispatched, 'reordered': self.reordered, 'waiting': len(self._waiting)}
+
+
+
+class RateLimiter:
+	"""
+	Token buckets for the requests and tokens per minute (e.g. the limits of one account of a hosted API).
+
+	Each bucket refills continuously and holds up to `burst` seconds worth (providers tend to enforce their limits over
+	shorter windows than a minute). Requests wait until both buckets can cover their (estimated) cost, which may be
+	corrected later with `reconcile` once the actual usage is known.
+	"""
+	def __init__(self, *, rpm: Optional[float] = None, tpm: Optional[float] = None, burst: float = 10.):
+		assert rpm is None or rpm > 0, f'rpm must be positive, got {rpm}'
+		assert tpm is None or tpm > 0, f'tpm must be positive, got {tpm}'
+		self.rpm = rpm
+		self.tpm = tpm
+		self.burst = burst
+		self._max_requests = None if rpm is None else max(1., rpm * burst / 60)
+		self._max_tokens = None if tpm is None else tpm * burst / 60
+		self._requests = self._max_requests
+		self._tokens = self._max_tokens
+		self._updated = time.monotonic()
+		self._paused_until = 0.
+		self._lock = threading.Lock()
+		self.throttled = 0
+		self.waited = 0.
+
+	def _refill(self, now: float) -> None:
+		elapsed = now - self._updated
+		self._updated = now
+		if self.rpm is not None:
+			self._requests = min(self._max_requests, self._requests + elapsed * self.rpm / 60)
+		if self.tpm is not None:
+			self._tokens = min(self._max_tokens, self._tokens + elapsed * self.tpm / 60)
+
+	def _reserve(self, tokens: int) -> float:
+		"""Takes the cost from the buckets if possible (returns 0), otherwise returns how long to wait."""
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			delay = self._paused_until - now
+			if self.rpm is not None and self._requests < 1:
+				delay = max(delay, (1 - self._requests) * 60 / self.rpm)
+			if self.tpm is not None:
+				need = min(tokens, self._max_tokens) # larger requests only have to wait for a full bucket
+				if self._tokens < need:
+					delay = max(delay, (need - self._tokens) * 60 / self.tpm)
+			if delay > 0:
+				return delay
+			if self.rpm is not None:
+				self._requests -= 1
+			if self.tpm is not None:
+				self._tokens -= tokens
+			return 0.
+
+	def _waited(self, seconds: float) -> float:
+		if seconds > 0:
+			with self._lock:
+				self.throttled += 1
+				self.waited += seconds
+		return seconds
+
+	def acquire(self, tokens: int = 0) -> float:
+		"""Waits until the request can be sent, returns the time spent waiting (in seconds)."""
+		start = time.monotonic()
+		delay = self._reserve(tokens)
+		if not delay:
+			return 0.
+		while delay > 0:
+			time.sleep(delay)
+			delay = self._reserve(tokens)
+		return self._waited(time.monotonic() - start)
+
+	async def aacquire(self, tokens: int = 0) -> float:
+		start = time.monotonic()
+		delay = self._reserve(tokens)
+		if not delay:
+			return 0.
+		while delay > 0:
+			await asyncio.sleep(delay)
+			delay = self._reserve(tokens)
+		return self._waited(time.monotonic() - start)
+
+	def reconcile(self, estimate: int, actual: int) -> None:
+		"""Corrects the token bucket once the actual cost of a request is known."""
+		if self.tpm is not None:
+			with self._lock:
+				self._tokens = min(self._max_tokens, self._tokens + estimate - actual)
+
+	def pause(self, seconds: float) -> None:
+		"""Holds back all requests for a while (e.g. after the provider responded with 429)."""
+		with self._lock:
+			self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+	def stats(self) -> JSONFLAT:
+		return {'throttled': self.throttled, 'waited': self.waited}
+
+
+
+class HedgePolicy:
+	"""
+	Decides when to send a duplicate of a slow request (a "hedge"): once it has been running for longer than the
+	`quantile` of the recent latencies, as long as at most `fraction` of all requests were hedged.
+
+	There is no hedging until at least `min_samples` latencies were recorded.
+	"""
+	def __init__(self, fraction: float, *, quantile: float = 0.95, min_samples: int = 20, window: int = 256):
+		assert 0 < fraction <= 1, f'fraction must be in (0, 1], got {fraction}'
+		assert 0 < quantile < 1, f'quantile must be in (0, 1), got {quantile}'
+		self.fraction = fraction
+		self.quantile = quantile
+		self.min_samples = min_samples
+		self._latencies = deque(maxlen=window)
+		self._threshold = None # cached quantile of the latencies
+		self._lock = threading.Lock()
+		self.requests = 0
+		self.hedged = 0
+		self.won = 0
+
+	def delay(self) -> Optional[float]:
+		"""Registers a new request, returns how long to wait for it before hedging (None if it won't be hedged)."""
+		with self._lock:
+			self.requests += 1
+			if len(self._latencies) < self.min_samples or self.hedged + 1 > self.fraction * self.requests:
+				return None
+			if self._threshold is None:
+				ordered = sorted(self._latencies)
+				self._threshold = ordered[min(int(self.quantile * len(ordered)), len(ordered) - 1)]
+			return self._threshold
+
+	def record(self, latency: float) -> None:
+		with self._lock:
+			self._latencies.append(latency)
+			self._threshold = None
+
+	def allow(self) -> bool:
+		"""Reserves a hedge if the budget allows it."""
+		with self._lock:
+			if self.hedged + 1 > self.fraction * self.requests:
+				return False
+			self.hedged += 1
+			return True
+
+	def hedge_won(self) -> None:
+		with self._lock:
+			self.won += 1
+
+	def stats(self) -> JSONFLAT:
+		return {'requests': self.requests, 'hedged': self.hedged, 'won': self.won}
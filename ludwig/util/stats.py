@@ -1,5 +1,7 @@
 from .imports import *
-from .clients import AbstractClient
+import math
+from contextlib import contextmanager
+from .clients import AbstractClient, RequestScope
 
 
 
@@ -43,19 +45,208 @@ class ClientStats(TimeStats):
 		super().__init__(**kwargs)
 		self.client = client
 		self.starting_idx = None
+		self.scope = RequestScope()
 
 	def __enter__(self) -> JSONOBJ:
 		out = super().__enter__()
 		self.starting_idx = self.client.past_requests()
+		self.scope.__enter__()
 		return out
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.scope.__exit__(exc_type, exc_val, exc_tb)
 		out = super().__exit__(exc_type, exc_val, exc_tb)
 		if exc_type is None:
-			self.stats.update(self.client.stats(starting_from=self.starting_idx))
+			self.stats.update(self.client.stats(starting_from=self.starting_idx, scope=self.scope))
 		return out
 
 
+class RunningStat:
+	"""
+	Streaming summary (count, sum, sum of squares, min and max) of a sequence of numbers.
+
+	Adding a value takes constant time, and the state is json serializable (see `json` and `from_json`).
+	"""
+	def __init__(self, count: int = 0, total: float = 0, total_sq: float = 0,
+				 min: Optional[float] = None, max: Optional[float] = None):
+		self.count = count
+		self.total = total
+		self.total_sq = total_sq
+		self.min = min
+		self.max = max
+
+	@classmethod
+	def from_values(cls, values: Iterable[float]) -> 'RunningStat':
+		stat = cls()
+		for value in values:
+			stat.add(value)
+		return stat
+
+	@classmethod
+	def from_json(cls, data: JSONOBJ) -> 'RunningStat':
+		return cls(**data)
+
+	def json(self) -> JSONOBJ:
+		return {'count': self.count, 'total': self.total, 'total_sq': self.total_sq, 'min': self.min, 'max': self.max}
+
+	def add(self, value: float) -> 'RunningStat':
+		self.count += 1
+		self.total += value
+		self.total_sq += value * value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		return self
+
+	@property
+	def mean(self) -> Optional[float]:
+		if self.count:
+			return self.total / self.count
+
+	@property
+	def variance(self) -> Optional[float]:
+		"""Sample variance (0 for a single value)."""
+		if self.count:
+			if self.count == 1:
+				return 0.
+			return max(self.total_sq - self.total * self.total / self.count, 0.) / (self.count - 1)
+
+	@property
+	def std(self) -> Optional[float]:
+		if self.count:
+			return math.sqrt(self.variance)
+
+	def interval(self, z: float = 1.96, *, method: Optional[str] = None) -> Optional[Tuple[float, float]]:
+		"""
+		Confidence interval of the mean (`z` = 1.96 is 95%).
+
+		By default, the Wilson score interval is used if all values are in [0, 1] (e.g. accuracy), otherwise the normal
+		approximation.
+		"""
+		if not self.count:
+			return None
+		n, mean = self.count, self.mean
+		if method is None:
+			method = 'wilson' if 0 <= self.min and self.max <= 1 else 'normal'
+		if method == 'wilson':
+			denom = 1 + z * z / n
+			center = (mean + z * z / (2 * n)) / denom
+			half = z * math.sqrt(max(mean * (1 - mean), 0.) / n + z * z / (4 * n * n)) / denom
+			return center - half, center + half
+		if method == 'normal':
+			half = z * self.std / math.sqrt(n)
+			return mean - half, mean + half
+		raise ValueError(f'Unknown interval method: {method}')
+
+	def __repr__(self):
+		return f'{self.__class__.__name__}(count={self.count}, mean={self.mean})'
+
+
+
+class LatencyHistogram:
+	"""
+	Streaming histogram of durations (in seconds) with logarithmically spaced buckets, so quantiles are accurate up to
+	a relative error of `growth - 1` while adding a value takes constant time and memory stays bounded.
+	"""
+	def __init__(self, *, growth: float = 1.05, smallest: float = 1e-6):
+		self.growth = growth
+		self.smallest = smallest
+		self._log_growth = math.log(growth)
+		self.buckets = Counter()
+		self.count = 0
+		self.total = 0.
+		self.max = 0.
+
+	def add(self, duration: float) -> None:
+		bucket = 0 if duration <= self.smallest else math.ceil(math.log(duration / self.smallest) / self._log_growth)
+		self.buckets[bucket] += 1
+		self.count += 1
+		self.total += duration
+		if duration > self.max:
+			self.max = duration
+
+	def quantile(self, q: float) -> Optional[float]:
+		"""Upper bound of the bucket containing the `q`-quantile."""
+		if not self.count:
+			return None
+		rank = q * self.count
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= rank:
+				return min(self.smallest * self.growth ** bucket, self.max)
+		return self.max
+
+	_quantiles = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+	def summary(self) -> JSONFLAT:
+		return {'count': self.count, 'mean': self.total / self.count if self.count else None,
+				**{name: self.quantile(q) for name, q in self._quantiles.items()}, 'max': self.max}
+
+
+
+class PhaseTimer:
+	"""
+	Collects the wall-clock durations of the phases of each sample (e.g. `ask`, `solve`, `judge`) in a
+	`LatencyHistogram` per phase.
+	"""
+	def __init__(self, **histogram_kwargs):
+		self._histogram_kwargs = histogram_kwargs
+		self.phases: Dict[str, LatencyHistogram] = {}
+		self._lock = threading.Lock()
+
+	def record(self, phase: str, duration: float) -> None:
+		with self._lock:
+			hist = self.phases.get(phase)
+			if hist is None:
+				hist = self.phases[phase] = LatencyHistogram(**self._histogram_kwargs)
+			hist.add(duration)
+
+	def record_all(self, durations: Dict[str, float]) -> None:
+		for phase, duration in durations.items():
+			self.record(phase, duration)
+
+	@contextmanager
+	def measure(self, phase: str, durations: Optional[Dict[str, float]] = None):
+		"""
+		Times the body and records the duration in the histogram of `phase` (or adds it to `durations`,
+		to be recorded later with `record_all`).
+		"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			duration = time.perf_counter() - start
+			if durations is None:
+				self.record(phase, duration)
+			else:
+				durations[phase] = durations.get(phase, 0.) + duration
+
+	def summary(self) -> JSONOBJ:
+		with self._lock:
+			return {phase: hist.summary() for phase, hist in self.phases.items()}
+
+	def prometheus(self, name: str = 'ludwig_phase_seconds') -> str:
+		"""Current state in the Prometheus text exposition format (as a summary metric)."""
+		lines = [f'# TYPE {name} summary']
+		with self._lock:
+			for phase, hist in self.phases.items():
+				for q in hist._quantiles.values():
+					lines.append(f'{name}{{phase="{phase}",quantile="{q}"}} {hist.quantile(q)}')
+				lines.append(f'{name}_sum{{phase="{phase}"}} {hist.total}')
+				lines.append(f'{name}_count{{phase="{phase}"}} {hist.count}')
+		return '\n'.join(lines) + '\n'
+
+	def dump(self, root: Path) -> None:
+		"""Writes the current state to `timing.json` and `timing.prom` in `root`."""
+		for fname, content in [('timing.json', json.dumps(self.summary(), indent=2)),
+							   ('timing.prom', self.prometheus())]:
+			tmp = root.joinpath(fname + '.tmp')
+			tmp.write_text(content)
+			tmp.replace(root.joinpath(fname))
+
+
+
 import subprocess
 
 def get_git_commit_hash() -> str:
@@ -0,0 +1,217 @@
+from .imports import *
+import sqlite3
+import gzip
+import zlib
+import queue
+import atexit
+
+
+
+class ResponseCache:
+	"""
+	Single-file (sqlite) store of responses keyed by the hash of the request.
+
+	When the stored responses exceed `max_size` bytes, the least recently used ones are evicted.
+	"""
+	def __init__(self, path: Union[str, Path], *, max_size: Optional[int] = None):
+		path = Path(path)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		self.path = path
+		self.max_size = max_size
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS responses '
+						   '(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, '
+						   'created REAL NOT NULL, accessed REAL NOT NULL)')
+		self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+		self._total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+	@property
+	def total_size(self) -> int:
+		return self._total_size
+
+	def __len__(self) -> int:
+		with self._lock:
+			return self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+	def __contains__(self, key: str) -> bool:
+		with self._lock:
+			return self._conn.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone() is not None
+
+	def get(self, key: str) -> Optional[JSONOBJ]:
+		"""Returns a fresh copy of the stored response (or None if there is none)."""
+		with self._lock:
+			row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				return None
+			self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+		return json.loads(row[0])
+
+	def put(self, key: str, response: JSONOBJ) -> None:
+		raw = json.dumps(response, ensure_ascii=False)
+		size = len(raw.encode('utf-8'))
+		now = time.time()
+		with self._lock:
+			old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+			self._conn.execute('INSERT OR REPLACE INTO responses (key, response, size, created, accessed) '
+							   'VALUES (?, ?, ?, ?, ?)', (key, raw, size, now, now))
+			self._total_size += size - (0 if old is None else old[0])
+			if self.max_size is not None and self._total_size > self.max_size:
+				self._evict(int(self.max_size * self._evict_to))
+
+	_evict_to = 0.9 # fraction of max_size to free up to, so not every insert has to evict
+	def _evict(self, target: int) -> None:
+		evicted = []
+		for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY accessed ASC'):
+			if self._total_size <= target:
+				break
+			evicted.append((key,))
+			self._total_size -= size
+		self._conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+	def close(self) -> None:
+		with self._lock:
+			self._conn.close()
+
+
+
+class RequestLog:
+	"""
+	Append-only log of requests and responses in a few gzip compressed JSONL segments (instead of one file per request).
+
+	Records are serialized right away (so the data may change afterwards), but compressed by a background thread, which
+	writes everything queued up at once as a single gzip member (so each segment is still a valid `.jsonl.gz` file). The
+	offsets of these blocks are kept in a small index (`index.tsv`), so single records can be read without decompressing
+	a whole segment (see `RequestLogReader`).
+	"""
+	index_name = 'index.tsv'
+	segment_name = 'requests-{:04d}.jsonl.gz'
+	def __init__(self, root: Union[str, Path], *, segment_size: int = 2**26, level: int = 6, max_block: int = 256):
+		root = Path(root)
+		root.mkdir(parents=True, exist_ok=True)
+		self.root = root
+		self.segment_size = segment_size
+		self.level = level
+		self.max_block = max_block
+		self._segment = -1
+		self._file = None
+		self._index = root.joinpath(self.index_name).open('a', encoding='utf-8')
+		self._queue = queue.Queue()
+		self._error = None
+		self._closed = False
+		self._writer = threading.Thread(target=self._write_loop, name=f'request-log-{root.name}', daemon=True)
+		self._writer.start()
+		atexit.register(self.close)
+
+	def append(self, n: int, kind: str, data: JSONOBJ) -> None:
+		"""Queues a record (`kind` is 'request' or 'response') of request `n`."""
+		if self._error is not None:
+			raise self._error
+		assert not self._closed, f'Request log {self.root} is closed'
+		line = json.dumps({'n': n, 'kind': kind, 'time': time.time(), 'data': data}, ensure_ascii=False, default=str)
+		self._queue.put((n, kind, line))
+
+	def _next_segment(self):
+		if self._file is not None:
+			self._file.close()
+		self._segment += 1
+		self._file = self.root.joinpath(self.segment_name.format(self._segment)).open('ab')
+
+	def _write_block(self, records: List[Tuple[int, str, str]]) -> None:
+		if self._file is None or self._file.tell() >= self.segment_size:
+			self._next_segment()
+		offset = self._file.tell()
+		block = ''.join(f'{line}\n' for _, _, line in records)
+		self._file.write(gzip.compress(block.encode('utf-8'), compresslevel=self.level))
+		self._file.flush()
+		self._index.write(''.join(f'{n}\t{kind}\t{self._segment}\t{offset}\t{i}\n'
+								  for i, (n, kind, _) in enumerate(records)))
+		self._index.flush()
+
+	def _write_loop(self) -> None:
+		done = False
+		while not done:
+			records = [self._queue.get()]
+			while len(records) < self.max_block:
+				try:
+					records.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			if records[-1] is None:
+				done = True
+				records.pop()
+			if records and self._error is None:
+				try:
+					self._write_block(records)
+				except Exception as e: # raised by the next `append`
+					self._error = e
+
+	def close(self) -> None:
+		"""Writes all queued records and closes the files."""
+		if self._closed:
+			return
+		self._closed = True
+		self._queue.put(None)
+		self._writer.join()
+		if self._file is not None:
+			self._file.close()
+		self._index.close()
+
+
+
+class RequestLogReader:
+	"""Reads a `RequestLog`, either sequentially (streaming one segment at a time) or by request number."""
+	def __init__(self, root: Union[str, Path]):
+		self.root = Path(root)
+		self._index = None
+
+	@property
+	def index(self) -> Dict[Tuple[int, str], Tuple[int, int, int]]:
+		"""(n, kind) -> (segment, block offset, line in the block)"""
+		if self._index is None:
+			index = {}
+			with self.root.joinpath(RequestLog.index_name).open('r', encoding='utf-8') as f:
+				for line in f:
+					n, kind, segment, offset, pos = line.rstrip('\n').split('\t')
+					index[int(n), kind] = int(segment), int(offset), int(pos)
+			self._index = index
+		return self._index
+
+	def __len__(self) -> int:
+		return sum(1 for _, kind in self.index if kind == 'request')
+
+	def records(self) -> Iterator[JSONOBJ]:
+		"""All records in the order they were written."""
+		for path in sorted(self.root.glob(RequestLog.segment_name.replace('{:04d}', '*'))):
+			with gzip.open(path, 'rt', encoding='utf-8') as f:
+				for line in f:
+					yield json.loads(line)
+
+	def __iter__(self) -> Iterator[Tuple[int, JSONOBJ, Optional[JSONOBJ]]]:
+		"""Yields (n, request, response) in the order of the responses (and unanswered requests at the end)."""
+		pending = {}
+		for record in self.records():
+			if record['kind'] == 'request':
+				pending[record['n']] = record
+			else:
+				request = pending.pop(record['n'], None)
+				yield record['n'], None if request is None else request['data'], record['data']
+		for n, request in sorted(pending.items()):
+			yield n, request['data'], None
+
+	def _read(self, segment: int, offset: int, pos: int) -> JSONOBJ:
+		with self.root.joinpath(RequestLog.segment_name.format(segment)).open('rb') as f:
+			f.seek(offset)
+			decompressor = zlib.decompressobj(wbits=31) # a single gzip member
+			block = bytearray()
+			while not decompressor.eof:
+				chunk = f.read(2**16)
+				if not chunk:
+					break
+				block += decompressor.decompress(chunk)
+		return json.loads(block.decode('utf-8').split('\n')[pos])
+
+	def get(self, n: int, kind: str = 'request') -> Optional[JSONOBJ]:
+		loc = self.index.get((n, kind))
+		return None if loc is None else self._read(*loc)['data']
@@ -1,10 +1,153 @@
 from .imports import *
 from .files import Checkpointable
 import ast, uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 
 class ToolBase(fig.Configurable, Checkpointable, AbstractTool):
+	max_concurrency: Optional[int] = None # calls of this tool that may run at the same time (None for no limit)
+
 	def json(self) -> JSONOBJ:
 		# return self.schema()
 		return {'class': self.__class__.__name__}
 
+
+
+class _ToolJob:
+	def __init__(self, tool: AbstractTool, fn: Callable[[], str]):
+		self.tool = tool
+		self.fn = fn
+		self.started = threading.Event()
+		self.start = None
+		self.abandoned = False
+		self._lock = threading.Lock()
+
+	def begin(self) -> bool:
+		"""Marks the call as started (unless it was abandoned already)."""
+		with self._lock:
+			if self.abandoned:
+				return False
+			self.start = time.monotonic()
+			self.started.set()
+			return True
+
+	def abandon(self) -> bool:
+		"""Gives up on the call (unless it has started already)."""
+		with self._lock:
+			if self.started.is_set():
+				return False
+			self.abandoned = True
+			return True
+
+
+
+class ToolExecutor:
+	"""
+	Runs the tool calls of one turn concurrently on up to `workers` threads (threads rather than processes, since tools
+	like stockfish keep state that can't be sent to another process), with at most `max_concurrency` calls of the same
+	tool at a time (see `limits` and `ToolBase.max_concurrency`).
+
+	With a `timeout`, a call that runs longer than that (in seconds) results in an error message instead. The call itself
+	can't be interrupted, so it still holds its worker until it finishes. A call that can't even start within the
+	`timeout` (e.g. because all workers are stuck on hung calls) is given up with an error message as well.
+
+	The worker threads are kept until `close` (or the end of a `with` block).
+	"""
+	def __init__(self, workers: int = 4, *, timeout: Optional[float] = None, limits: Optional[Dict[str, int]] = None):
+		assert workers > 0, f'workers must be a positive integer, got {workers}'
+		self.workers = workers
+		self.timeout = timeout
+		self.limits = {} if limits is None else limits
+		self._pool = None
+		self._semaphores: Dict[str, threading.Semaphore] = {}
+		self._lock = threading.Lock()
+		self._latency: Dict[str, JSONFLAT] = {}
+
+	def _semaphore(self, tool: AbstractTool) -> Optional[threading.Semaphore]:
+		limit = self.limits.get(tool.name, getattr(tool, 'max_concurrency', None))
+		if limit is None:
+			return None
+		with self._lock:
+			if tool.name not in self._semaphores:
+				self._semaphores[tool.name] = threading.Semaphore(limit)
+			return self._semaphores[tool.name]
+
+	def _record(self, name: str, duration: Optional[float], timed_out: bool = False) -> None:
+		"""Records a call which took `duration` seconds (None if it was abandoned before it started)."""
+		with self._lock:
+			stats = self._latency.setdefault(name, {'calls': 0, 'time': 0., 'max': 0., 'timeouts': 0, 'abandoned': 0})
+			if duration is None:
+				stats['abandoned'] += 1
+				return
+			stats['calls'] += 1
+			stats['time'] += duration
+			stats['max'] = max(stats['max'], duration)
+			stats['timeouts'] += timed_out
+
+	def _execute(self, job: _ToolJob) -> Optional[str]:
+		semaphore = self._semaphore(job.tool)
+		if semaphore is not None:
+			semaphore.acquire()
+		try:
+			if not job.begin():
+				return None
+			try:
+				return job.fn()
+			finally:
+				duration = time.monotonic() - job.start
+				self._record(job.tool.name, duration, self.timeout is not None and duration > self.timeout)
+		finally:
+			if semaphore is not None:
+				semaphore.release()
+
+	def run(self, calls: Sequence[Tuple[AbstractTool, Callable[[], str]]]) -> List[str]:
+		"""
+		Runs `fn()` for each (tool, fn) and returns the results in the same order. An exception raised by a call is
+		raised here (after the results of the calls before it are in).
+		"""
+		jobs = [_ToolJob(tool, fn) for tool, fn in calls]
+		if not jobs:
+			return []
+		if len(jobs) == 1 and self.timeout is None:
+			return [self._execute(jobs[0])]
+		with self._lock:
+			if self._pool is None:
+				self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='tool')
+			pool = self._pool
+		futures = [pool.submit(self._execute, job) for job in jobs]
+		results = []
+		for job, future in zip(jobs, futures):
+			if self.timeout is None:
+				results.append(future.result())
+				continue
+			# the timeout starts when the call does, the wait for a free worker or slot is bounded separately
+			if not job.started.wait(self.timeout) and job.abandon():
+				future.cancel()
+				self._record(job.tool.name, None)
+				results.append(f'Error: {job.tool.name!r} did not start within {self.timeout} seconds')
+				continue
+			try:
+				results.append(future.result(timeout=max(0., job.start + self.timeout - time.monotonic())))
+			except FutureTimeoutError:
+				results.append(f'Error: {job.tool.name!r} did not finish within {self.timeout} seconds')
+		return results
+
+	def stats(self) -> JSONOBJ:
+		"""Number of calls, mean and max latency (in seconds), timeouts and abandoned calls per tool."""
+		with self._lock:
+			return {name: {'calls': stats['calls'], 'mean': stats['time'] / stats['calls'] if stats['calls'] else None,
+						   'max': stats['max'], 'timeouts': stats['timeouts'], 'abandoned': stats['abandoned']}
+					for name, stats in self._latency.items()}
+
+	def close(self) -> None:
+		"""Stops the worker threads (once their current calls finish) and drops the calls that have not started yet."""
+		with self._lock:
+			pool, self._pool = self._pool, None
+		if pool is not None:
+			pool.shutdown(wait=False, cancel_futures=True)
+
+	def __enter__(self) -> 'ToolExecutor':
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -2,13 +2,39 @@ import random
 
 from .imports import *
 from .files import repo_root
-from .clients import vllm_Client, OpenaiAzure_Client, Openai_Client, Tool_Client, SAIA_Client
+from .clients import vllm_Client, OpenaiAzure_Client, Openai_Client, Tool_Client, SAIA_Client, OpenaiClientBase
 from .prompts import ChatTemplate
 from .search import GenericSearch
 from .coding import PythonParser
 from .tools import ToolBase, ToolError
 
 
+class _Response(dict):
+	"""Stands in for the response objects of the openai package."""
+	def model_dump(self):
+		return dict(self)
+
+
+def _completion(content: str, prompt_tokens: int = 1) -> JSONOBJ:
+	return {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+			'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 1}}
+
+
+class _FakeClient(OpenaiClientBase):
+	"""Client of a server which doesn't exist, so the tests override `_send` (or the endpoints)."""
+	def prepare(self):
+		self.history = []
+		self._tokenizer = None
+		return self
+
+
+def _offline(client: OpenaiClientBase) -> OpenaiClientBase:
+	"""Sets up the `client` without asking the server (for the model name)."""
+	client._model_name = 'fake'
+	client.history = []
+	return client
+
+
 def test_repo_root():
 	root = repo_root()
 
@@ -365,3 +391,716 @@ def test_chat_template():
 
 
 
+
+
+class _FakeAsyncCompletions:
+	"""Stands in for `AsyncOpenAI().chat.completions` and keeps track of the number of concurrent requests."""
+	def __init__(self):
+		self.in_flight = 0
+		self.peak = 0
+
+	async def create(self, **data):
+		import asyncio
+		self.in_flight += 1
+		self.peak = max(self.peak, self.in_flight)
+		await asyncio.sleep(0.01)
+		self.in_flight -= 1
+		content = data['messages'][-1]['content']
+		return _Response(_completion(content.upper(), prompt_tokens=len(content)))
+
+
+def test_async_client():
+	import asyncio
+	from types import SimpleNamespace
+	from .stats import ClientStats
+
+	completions = _FakeAsyncCompletions()
+
+	class Client(_FakeClient):
+		def _build_async_endpoint(self):
+			return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+	client = _offline(Client(endpoint='http://localhost:0/v1', max_tokens=8, max_in_flight=3))
+
+	async def ask(prompt):
+		with ClientStats(client) as stats:
+			chat = [{'role': 'user', 'content': prompt}]
+			await client.astep(chat)
+		return chat[-1]['content'], stats
+
+	async def main():
+		return await asyncio.gather(*[ask('x' * (i + 1)) for i in range(10)])
+
+	results = asyncio.run(main())
+
+	assert completions.peak == 3
+	for i, (answer, stats) in enumerate(results):
+		assert answer == 'X' * (i + 1)
+		assert stats['requests'] == 1
+		assert stats['input_tokens'] == i + 1
+	assert client.stats()['input_tokens'] == sum(range(1, 11))
+
+	import gc, weakref
+	loops = []
+	async def track():
+		loops.append(weakref.ref(asyncio.get_running_loop()))
+		return await main()
+	for _ in range(3): # each run gets its own cap, which doesn't keep the loop alive afterwards
+		asyncio.run(track())
+		assert completions.peak == 3
+	gc.collect()
+	assert all(loop() is None for loop in loops)
+
+
+def test_async_client_event_loops():
+	import asyncio, threading
+	from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1' # keep-alive, so connections from an earlier loop would be reused
+
+		def do_POST(self):
+			request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+			body = json.dumps({'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+							   **_completion(request['messages'][-1]['content'].upper())}).encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *args):
+			pass
+
+	server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	try:
+		client = _offline(OpenaiClientBase(endpoint=f'http://127.0.0.1:{server.server_port}/v1', max_tokens=8,
+										   timeout=5))
+		for prompt in ['a', 'b']: # each `asyncio.run` has its own loop (and so needs its own connections)
+			chat = [{'role': 'user', 'content': prompt}]
+			asyncio.run(client.astep(chat))
+			assert chat[-1]['content'] == prompt.upper()
+	finally:
+		server.shutdown()
+		server.server_close()
+
+
+def test_cached_client(tmp_path):
+	from .clients import Cached, MockEndpoint
+
+	class Client(Cached, MockEndpoint): pass
+
+	path = tmp_path / 'cache.db'
+	client = Client(responses=['first', 'second', 'third'], cache_path=path)
+	client.prepare()
+
+	assert client.get_response('hello') == 'first'
+	assert client.get_response('hello') == 'first'
+	assert client.get_response('bye') == 'second'
+	assert client.stats()['cache'] == {'hits': 1, 'misses': 2, 'saved_input_tokens': 1, 'saved_output_tokens': 1}
+
+	# a new client (e.g. when re-running the eval) reuses the stored responses
+	reader = Client(responses=['fresh'], cache_path=path, cache_mode='read-only')
+	reader.prepare()
+	assert reader.get_response('bye') == 'second'
+	assert reader.get_response('new') == 'fresh'
+	assert reader.get_response('new') != 'fresh'
+
+	refresher = Client(responses=['updated'], cache_path=path, cache_mode='refresh')
+	refresher.prepare()
+	assert refresher.get_response('hello') == 'updated'
+	assert client.get_response('hello') == 'updated'
+
+
+def test_response_cache_eviction(tmp_path):
+	from .storage import ResponseCache
+
+	cache = ResponseCache(tmp_path / 'cache.db', max_size=1000)
+	for i in range(20):
+		cache.put(f'key{i}', {'text': 'x' * 90})
+		cache.get('key0')
+	assert cache.total_size <= 1000
+	assert 'key0' in cache
+	assert 'key1' not in cache
+	assert 'key19' in cache
+
+
+def test_running_stat():
+	from .stats import RunningStat
+	import statistics
+
+	values = [random.random() for _ in range(50)]
+	stat = RunningStat.from_values(values)
+	assert stat.count == 50 and stat.min == min(values) and stat.max == max(values)
+	assert abs(stat.mean - statistics.mean(values)) < 1e-12
+	assert abs(stat.variance - statistics.variance(values)) < 1e-12
+
+	lo, hi = stat.interval()
+	assert 0 <= lo < stat.mean < hi <= 1
+	lo, hi = RunningStat.from_values([1] * 20).interval()
+	assert lo < 1 and abs(hi - 1) < 1e-12
+	wide = RunningStat.from_values([-3., 2., 5.]).interval()
+	assert wide[0] < 4/3 < wide[1]
+
+	restored = RunningStat.from_json(json.loads(json.dumps(stat.json())))
+	assert restored.add(0.5).count == 51 and restored.mean == (stat.total + 0.5) / 51
+
+
+def test_phase_timer(tmp_path):
+	from .stats import PhaseTimer
+
+	timer = PhaseTimer(growth=1.01)
+	for i in range(1, 1001):
+		timer.record('solve', i / 1000)
+	summary = timer.summary()['solve']
+	assert summary['count'] == 1000 and summary['max'] == 1.
+	for name, expected in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)]:
+		assert abs(summary[name] - expected) <= 0.01 * expected
+
+	durations = {}
+	with timer.measure('ask', durations):
+		pass
+	assert 'ask' in durations and 'ask' not in timer.phases
+
+	timer.dump(tmp_path)
+	assert json.loads(tmp_path.joinpath('timing.json').read_text())['solve']['count'] == 1000
+	assert 'ludwig_phase_seconds_count{phase="solve"} 1000' in tmp_path.joinpath('timing.prom').read_text()
+
+
+def test_client_retries():
+	from types import SimpleNamespace
+
+	def status_error(code):
+		response = SimpleNamespace(status_code=code, headers={}, request=None)
+		return openai.APIStatusError(f'status {code}', response=response, body=None)
+
+	errors = []
+	class Client(_FakeClient):
+		def _send(self, data):
+			def create(**data):
+				if errors:
+					raise errors.pop(0)
+				return _completion('ok')
+			return self._call(create, **data)
+
+	client = _offline(Client(endpoint='http://localhost:0/v1', max_tokens=8, retries=3, retry_backoff=0.001))
+	other = Client(endpoint='http://localhost:0/v1/other')
+	assert client.endpoint._client is other.endpoint._client # shared connection pool
+
+	errors.extend([status_error(503), openai.APITimeoutError(request=None), status_error(429)])
+	assert client.get_response('hi') == 'ok'
+	assert client.stats()['retries'] == 3
+
+	errors.extend([status_error(400)])
+	try:
+		client.get_response('hi')
+	except openai.APIStatusError as e:
+		assert e.status_code == 400
+	else:
+		assert False, 'non-retryable errors must be raised'
+	assert client.stats(starting_from=1)['retries'] == 0
+
+
+def test_micro_batching():
+	from types import SimpleNamespace
+	from concurrent.futures import ThreadPoolExecutor
+	from .clients import OSSClient
+
+	calls = []
+	def create(prompt, **params):
+		prompts = [prompt] if isinstance(prompt, str) else prompt
+		calls.append(len(prompts))
+		time.sleep(0.01)
+		return _Response(choices=[{'index': i, 'text': p.upper(), 'finish_reason': 'stop'}
+								  for i, p in reversed(list(enumerate(prompts)))],
+						 usage={'prompt_tokens': -1, 'completion_tokens': -1})
+
+	client = _offline(OSSClient(endpoint='http://localhost:0/v1', max_tokens=5, batch_window=0.05, batch_size=4))
+	client._tokenizer = SimpleNamespace(
+		apply_chat_template=lambda chat, **kwargs: ' '.join(m['content'] for m in chat),
+		encode=lambda text, add_special_tokens=True: text.split())
+	client.endpoint = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+	prompts = [' '.join(['word'] * (i + 1)) + f' q{i}' for i in range(10)]
+	with ThreadPoolExecutor(10) as pool:
+		responses = list(pool.map(lambda p: client.get_response(p), prompts))
+
+	assert responses == [p.upper() for p in prompts]
+	assert sum(calls) == 10 and len(calls) < 10 and max(calls) <= 4
+	assert sorted(h['input_tokens'] for h in client.history) == list(range(2, 12))
+	assert client.stats()['requests'] == 10
+
+	flaky = [openai.APITimeoutError(request=None)]
+	def flaky_create(**params):
+		if flaky:
+			raise flaky.pop()
+		return create(**params)
+	client.endpoint = SimpleNamespace(completions=SimpleNamespace(create=flaky_create))
+	client.retry_backoff = 0.001
+	client._batcher.window = 5. # the batch is sent as soon as it's full
+	calls.clear()
+	with ThreadPoolExecutor(4) as pool:
+		assert list(pool.map(lambda p: client.get_response(p), prompts[:4])) == [p.upper() for p in prompts[:4]]
+	assert calls == [4] and client.stats(starting_from=10)['retries'] == 4 # every request waited for the retry
+
+	def fail(**params):
+		raise ValueError('unreachable')
+	client.endpoint = SimpleNamespace(completions=SimpleNamespace(create=fail))
+	client._batcher = None
+	data = {'model': 'fake', 'messages': [{'role': 'user', 'content': 'hi'}], 'tools': [], 'tool_choice': 'none'}
+	try:
+		client._send(data)
+	except ValueError:
+		pass
+	assert data['messages'] == [{'role': 'user', 'content': 'hi'}] and data['tool_choice'] == 'none' # ready to retry
+
+
+def test_render_cache():
+	from .rendering import RenderCache
+
+	calls = []
+	def stable(msgs, gen):
+		calls.append(len(msgs))
+		return '<s>' + ''.join(f'<{m["role"]}>{m["content"]}</{m["role"]}>' for m in msgs) + ('<assistant>' if gen else '')
+
+	def unstable(msgs, gen): # like reasoning templates, which drop the content of all but the last assistant message
+		last = max([i for i, m in enumerate(msgs) if m['role'] == 'assistant'], default=None)
+		return stable([m if m['role'] != 'assistant' or i == last else {**m, 'content': ''}
+					   for i, m in enumerate(msgs)], gen)
+
+	chat = [{'role': 'system', 'content': 'be nice'}, {'role': 'user', 'content': 'hi'}]
+	for render_fn in [stable, unstable]:
+		cache = RenderCache(incremental=True, check=render_fn is unstable)
+		turns = [chat[:i] for i in range(1, 3)]
+		for i in range(6):
+			turns.append(turns[-1] + [{'role': 'assistant', 'content': f'a{i}'}, {'role': 'user', 'content': f'u{i}'}])
+		for turn in turns:
+			assert cache.render('ctx', turn, render_fn) == render_fn(turn, True)
+		assert cache.render('ctx', turns[-1], render_fn) == render_fn(turns[-1], True)
+		assert cache.hits == 1
+		if render_fn is stable:
+			assert cache.incremental_renders == len(turns) - 1 and cache.mismatches == 0
+		else:
+			assert cache.mismatches == 1 and cache.full_renders > 1
+
+	calls.clear()
+	cache = RenderCache(incremental=True, verify=0)
+	cache.render('ctx', turns[-2], stable)
+	calls.clear()
+	cache.render('ctx', turns[-1], stable)
+	assert max(calls) <= 3 # only the new messages (and the last cached one) are rendered
+
+
+def test_count_tokens():
+	from types import SimpleNamespace
+	from .clients import OSSClient
+
+	encoded = []
+	def encode(text, add_special_tokens=True):
+		encoded.append(text)
+		return text.split()
+
+	def apply_chat_template(chat, tools=None, add_generation_prompt=True, **kwargs):
+		header = '<tools> ' + ' '.join(t['name'] for t in tools) + ' </tools> ' if tools else ''
+		return header + ' '.join(f'<{m["role"]}> {m["content"]}' for m in chat) \
+			+ (' <assistant>' if add_generation_prompt else '')
+
+	client = _offline(OSSClient(endpoint='http://localhost:0/v1', max_tokens=5))
+	client._tokenizer = SimpleNamespace(apply_chat_template=apply_chat_template, encode=encode)
+
+	system = {'role': 'system', 'content': ' '.join(['rule'] * 50)}
+	tools = [{'name': 'search'}, {'name': 'calc'}]
+	for i in range(5):
+		chat = [system, {'role': 'user', 'content': f'question number {i}'}]
+		expected = len(apply_chat_template(chat, tools=tools).split())
+		assert client.count_tokens(chat, tools=tools) == expected
+	assert sum(text == system['content'] for text in encoded) == 1 # the system prompt is only tokenized once
+	assert client.count_tokens('a b c') == 3
+
+
+def test_prefix_scheduler():
+	from .scheduling import PrefixScheduler, common_prefix_length
+
+	assert common_prefix_length('abcdef', 'abcxyz') == 3 and common_prefix_length('', 'abc') == 0
+	assert common_prefix_length('abc', 'abcd') == 3
+
+	scheduler = PrefixScheduler(1, max_skips=2)
+	order = []
+	def request(key):
+		with scheduler.slot(key):
+			order.append(key)
+
+	scheduler.acquire('statutes A: q0')
+	keys = ['statutes B: q1', 'statutes A: q2', 'statutes B: q3', 'statutes A: q4', 'other: q5']
+	threads = []
+	for key in keys:
+		threads.append(threading.Thread(target=request, args=(key,)))
+		threads[-1].start()
+		while len(scheduler._waiting) < len(threads):
+			time.sleep(0.001)
+	scheduler.release()
+	for thread in threads:
+		thread.join()
+	# requests sharing a prefix are dispatched back-to-back
+	assert order == ['statutes A: q2', 'statutes A: q4', 'statutes B: q1', 'statutes B: q3', 'other: q5']
+	assert scheduler.stats()['dispatched'] == 6
+
+
+def test_multi_vllm_client():
+	from types import SimpleNamespace
+	from concurrent.futures import ThreadPoolExecutor
+	from .clients import MultiVllm_Client
+
+	def replica(name, down=False):
+		def create(messages, **params):
+			if down:
+				raise openai.APIConnectionError(request=None)
+			time.sleep(0.01)
+			return _Response(_completion(name))
+		return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+	client = _offline(MultiVllm_Client(addrs=[8001, 8002, 8003], max_tokens=5, retries=0))
+	for r, name in zip(client.replicas, ['a', 'b', 'c']):
+		r.endpoint = replica(name, down=name == 'b')
+
+	with ThreadPoolExecutor(6) as pool:
+		answers = list(pool.map(lambda i: client.get_response(f'q{i}'), range(12)))
+	assert set(answers) == {'a', 'c'} # the requests sent to b failed over
+	assert not client.replicas[1].healthy and client.replicas[1].failures >= 1
+
+	chat = client.begin_chat('hello')
+	first = client.step(chat)['choices'][0]['message']['content']
+	chat.append({'role': 'user', 'content': 'and then?'})
+	for _ in range(3):
+		assert client.step(list(chat))['choices'][0]['message']['content'] == first # session affinity
+
+	stats = client.stats()['replicas']
+	assert stats['http://localhost:8002/v1']['requests'] == 0
+	assert sum(r['requests'] for r in stats.values()) == client.stats()['requests'] == 16
+
+
+def test_rate_limiter():
+	from .scheduling import RateLimiter
+
+	limiter = RateLimiter(rpm=600, tpm=6000, burst=1) # 10 requests / 100 tokens per second
+	for _ in range(10):
+		assert limiter.acquire(10) == 0 # the buckets start full
+	start = time.monotonic()
+	limiter.acquire(10)
+	assert 0.05 < time.monotonic() - start < 0.5 and limiter.throttled == 1
+
+	limiter = RateLimiter(tpm=600, burst=60) # 10 tokens per second
+	limiter.acquire(600)
+	limiter.reconcile(600, 20) # the request was much cheaper than estimated
+	start = time.monotonic()
+	limiter.acquire(500)
+	assert time.monotonic() - start < 0.1
+
+	class Client(_FakeClient):
+		def _send(self, data):
+			return self._call(lambda **data: _completion('ok'), **data)
+
+	client = _offline(Client(endpoint='http://localhost:0/v1/limited', max_tokens=8, rpm=1200))
+	other = _offline(Client(endpoint='http://localhost:0/v1/limited', max_tokens=8, rpm=1200))
+	assert client._rate_limiter is other._rate_limiter
+	client._rate_limiter._requests = 0. # spent by earlier requests
+	for _ in range(12):
+		client.get_response('hi')
+		other.get_response('hi')
+	assert client.stats()['rate_limit']['throttled'] + other.stats()['rate_limit']['throttled'] == 24
+
+
+def test_stop_at_answer(tmp_path):
+	from .clients import StopAtAnswer, Cached
+	from .parsers import AnswerDetector
+
+	pattern = r'final\s+answer\s*:\s*\**(yes|no)\**'
+	detector = AnswerDetector(pattern)
+	assert not any(detector.feed(part) for part in ['<think>', 'FINAL ANSWER: no', ' wait', '</think>', 'FINAL'])
+	assert not detector.feed(' ANSWER: ye') and not detector.feed('s')
+	assert detector.feed('.') # the answer is only complete once something follows it
+
+	words = 'I think it is fine. FINAL ANSWER: yes. Let me double check that again in great detail'.split(' ')
+	sent = []
+	class Client(_FakeClient):
+		def _send_no_wait(self, data):
+			for i, word in enumerate(words):
+				sent.append(word)
+				yield {'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word},
+									'finish_reason': 'stop' if i == len(words) - 1 else None}], 'usage': None}
+			yield {'choices': [], 'usage': {'prompt_tokens': 3, 'completion_tokens': len(words)}}
+
+		def _send(self, data):
+			sent.extend(words)
+			return {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)},
+								 'finish_reason': 'stop'}], 'usage': {'prompt_tokens': 3, 'completion_tokens': len(words)}}
+
+	client = _offline(Client(endpoint='http://localhost:0/v1', max_tokens=32))
+	with StopAtAnswer(AnswerDetector(pattern)):
+		resp = client.step(client.begin_chat('is it fine?'))
+	assert resp['choices'][0]['finish_reason'] == 'answer_detected'
+	assert client.extract_response(resp) == 'I think it is fine. FINAL ANSWER: yes.'
+	assert len(sent) < len(words) and client.stats()['output_tokens'] == len(sent)
+	sent.clear()
+	with StopAtAnswer(AnswerDetector(r'final\s+answer\s*:\s*(maybe)\b')):
+		resp = client.step(client.begin_chat('is it fine?'))
+	assert resp['choices'][0]['finish_reason'] == 'stop' and len(sent) == len(words)
+	assert client.stats(starting_from=1)['input_tokens'] == 3 # reported by the server at the end of the stream
+
+	class CachedClient(Cached, Client): pass
+	cached = _offline(CachedClient(endpoint='http://localhost:0/v1', max_tokens=32, cache_path=tmp_path / 'cache.db'))
+	cached.prepare()
+	answers = []
+	for _ in range(2):
+		sent.clear()
+		with StopAtAnswer(AnswerDetector(pattern)):
+			answers.append(cached.get_response('is it fine?'))
+	assert answers == ['I think it is fine. FINAL ANSWER: yes.'] * 2 and not sent # the second one is cached
+	first, stats = cached.history[0], cached.stats()
+	assert stats['cache']['hits'] == 1 and stats['cache']['saved_output_tokens'] == first['output_tokens']
+	assert stats['requests'] == 1 and stats['output_tokens'] == first['output_tokens'] # the hit was not sent
+	assert stats['time'] == first['end_time'] - first['start_time']
+	assert cached.get_response('is it fine?') == ' '.join(words) # the truncated response is only used when stopping
+
+
+def test_request_log(tmp_path):
+	from concurrent.futures import ThreadPoolExecutor
+	from .clients import Logged, MockEndpoint
+	from .storage import RequestLogReader
+
+	class Client(Logged, MockEndpoint): pass
+
+	client = Client(log_root=tmp_path, log_dir='run', log_format='compact')
+	client.prepare()
+	client._request_log.segment_size, client._request_log.max_block = 200, 4 # to get several segments
+	with ThreadPoolExecutor(4) as pool:
+		responses = list(pool.map(lambda i: client.get_response(f'question {i} ' + 'x' * 100), range(50)))
+	client._request_log.close()
+
+	root = tmp_path / 'run'
+	assert not list(root.glob('*_request.json')) and len(list(root.glob('requests-*.jsonl.gz'))) > 1
+	reader = RequestLogReader(root)
+	assert len(reader) == 50
+	pairs = list(reader)
+	assert len(pairs) == 50 and all(response is not None for _, _, response in pairs)
+	for n, request, response in pairs[::7]:
+		assert reader.get(n) == request and reader.get(n, 'response') == response
+	assert sorted(response['choices'][0]['message']['content'] for _, _, response in pairs) == sorted(responses)
+
+
+def test_request_history():
+	from .clients import RequestScope
+	from .history import RequestHistory
+
+	history = RequestHistory(max_entries=4)
+	scope = RequestScope()
+	records = []
+	for i in range(12):
+		entry = {'start_time': float(i), 'input_tokens': i}
+		if i % 3 == 0:
+			entry['scopes'] = (scope,)
+		records.append(history.append(entry))
+	for i, entry in enumerate(records[::-1]): # out of order, like concurrent requests
+		entry.update({'end_time': entry['start_time'] + 1 + i % 2, 'output_tokens': 2})
+		entry['retries'] = entry.get('retries', 0) + 1
+
+	assert len(history) == 12 and history[-1]['input_tokens'] == 11
+	assert history[1]['end_time'] == 2. and len(list(history)) == 12 # moved to disk, but not forgotten
+
+	def expected(rows):
+		times = [h['end_time'] - h['start_time'] for h in rows]
+		return len(rows), sum(h['input_tokens'] for h in rows), sum(h['retries'] for h in rows), \
+			{'mean': sum(times) / len(times), 'min': min(times), 'max': max(times)}
+
+	for start in [0, 3, 7]:
+		window = history.window(start)
+		rows = [dict(h) for h in history[start:]]
+		assert (len(window), window.total('input_tokens'), window.total('retries'), window.metrics('time')) \
+			   == expected(rows)
+	window = history.window(2, scope=scope)
+	assert (len(window), window.total('input_tokens'), window.total('retries'), window.metrics('time')) \
+		   == expected([history[i] for i in [3, 6, 9]])
+	assert [h['input_tokens'] for h in history.entries(2, scope=scope)] == [3, 6, 9]
+	assert history.window(0).metrics('tok_per_sec')['max'] == 2.
+	size = history._spill.seek(0, 2)
+	for _ in range(50): # a record on disk is rewritten in place
+		records[0]['retries'] += 1
+	assert history._spill.seek(0, 2) == size and history[0]['retries'] == 51
+
+	history = RequestHistory()
+	records = [history.append({'input_tokens': 1}) for _ in range(37)]
+	rng = random.Random(3)
+	for i in rng.sample(range(37), 20): # late updates anywhere in the history
+		records[i]['retries'] = i
+		records[i]['rate_wait'] = rng.random()
+	for start in range(37):
+		window = history.window(start)
+		assert window.total('input_tokens') == 37 - start
+		assert window.total('retries') == sum(r.get('retries', 0) for r in records[start:])
+		assert window.count('retries') == sum('retries' in r for r in records[start:])
+		waits = [r['rate_wait'] for r in records[start:] if 'rate_wait' in r]
+		metrics = window.metrics('rate_wait')
+		if len(waits) > 1:
+			assert (metrics['min'], metrics['max']) == (min(waits), max(waits))
+		else:
+			assert metrics == (waits[0] if waits else None)
+
+
+def test_hedged_requests():
+	import asyncio
+
+	class Client(_FakeClient):
+		"""Every request for a 'slow' prompt stalls the first time it is sent."""
+		def _delay(self, data):
+			prompt = data['messages'][-1]['content']
+			with lock:
+				calls[prompt] += 1
+				return 1. if prompt.startswith('slow') and calls[prompt] == 1 else 0.005
+
+		def _reply(self, data):
+			return _completion(data['messages'][-1]['content'].upper())
+
+		def _send(self, data):
+			delay = self._delay(data)
+			time.sleep(delay)
+			if delay > 0.1: # the loser finishes after the winner was recorded
+				self._count_retry()
+				loser_done.set()
+			return self._reply(data)
+
+		async def _asend(self, data):
+			try:
+				await asyncio.sleep(self._delay(data))
+			except asyncio.CancelledError:
+				cancelled.append(data['messages'][-1]['content'])
+				raise
+			return self._reply(data)
+
+	calls, lock, cancelled, loser_done = Counter(), threading.Lock(), [], threading.Event()
+	client = _offline(Client(endpoint='http://localhost:0/v1', max_tokens=8, hedge=0.1))
+
+	def ask(prompt, asynchronous=False):
+		chat = [{'role': 'user', 'content': prompt}]
+		asyncio.run(client.astep(chat)) if asynchronous else client.step(chat)
+		return chat[-1]['content']
+
+	for i in range(20):
+		assert ask(f'fast {i}') == f'FAST {i}'
+	assert client.stats()['hedging'] == {'hedged': 0, 'won': 0}
+
+	start = time.time()
+	assert ask('slow 1') == 'SLOW 1' and time.time() - start < 0.5
+	assert ask('slow 2', asynchronous=True) == 'SLOW 2' and time.time() - start < 0.9
+	assert calls['slow 1'] == calls['slow 2'] == 2 and cancelled == ['slow 2']
+
+	stats = client.stats()
+	assert stats['hedging'] == {'hedged': 2, 'won': 2}
+	assert stats['requests'] == 22 and stats['input_tokens'] == 22 # the losers are not counted
+	assert client._hedge_policy.delay() is None # at most 10% of the requests are hedged
+	assert loser_done.wait(2.) and 'retries' not in client.history[20] and client.history[20]['hedge_won'] == 1
+
+
+def test_coalesce_requests():
+	import asyncio
+	from concurrent.futures import ThreadPoolExecutor
+
+	class Client(_FakeClient):
+		def _build_async_endpoint(self):
+			return None
+
+		def _send(self, data):
+			prompt = data['messages'][-1]['content']
+			with lock:
+				calls[prompt] += 1
+			time.sleep(0.1)
+			return _completion(prompt.upper())
+
+	calls, lock = Counter(), threading.Lock()
+	client = _offline(Client(endpoint='http://localhost:0/v1', max_tokens=8, temperature=0., coalesce='deterministic'))
+
+	def ask(prompt):
+		chat = [{'role': 'user', 'content': prompt}]
+		client.step(chat)
+		chat[-1]['content'] += '!' # callers get their own copy
+		return chat[-1]['content']
+
+	with ThreadPoolExecutor(8) as pool:
+		answers = list(pool.map(ask, ['same'] * 6 + ['other'] * 2))
+	assert answers == ['SAME!'] * 6 + ['OTHER!'] * 2
+	assert calls == {'same': 1, 'other': 1}
+	assert client._current_entry() == {} # no request in this thread, so no other request's record is touched
+
+	async def main():
+		return await asyncio.gather(*[client.astep([{'role': 'user', 'content': 'async'}]) for _ in range(5)])
+	asyncio.run(main())
+	assert calls['async'] == 1
+
+	stats = client.stats()
+	assert stats['coalesced'] == 10 and stats['requests'] == 13 and stats['input_tokens'] == 13
+	ask('same')
+	assert calls['same'] == 2 # only requests in flight are coalesced
+
+	client.temperature = 1.
+	with ThreadPoolExecutor(2) as pool:
+		list(pool.map(ask, ['sampled'] * 2))
+	assert calls['sampled'] == 2
+
+
+def test_tool_executor():
+	from functools import partial
+	from .tools import ToolExecutor
+
+	class Sleep(ToolBase):
+		def __init__(self, name, max_concurrency=None, **kwargs):
+			super().__init__(**kwargs)
+			self._name = name
+			self.max_concurrency = max_concurrency
+			self.running = self.peak = 0
+			self._lock = threading.Lock()
+
+		@property
+		def name(self) -> str:
+			return self._name
+
+		def call(self, arguments: JSONOBJ) -> str:
+			with self._lock:
+				self.running += 1
+				self.peak = max(self.peak, self.running)
+			time.sleep(arguments['seconds'])
+			with self._lock:
+				self.running -= 1
+			return f'{self.name} slept {arguments["seconds"]}'
+
+	fast, single = Sleep('fast'), Sleep('single', max_concurrency=1)
+	executor = ToolExecutor(4, timeout=0.5)
+	start = time.monotonic()
+	results = executor.run([(fast, partial(fast.call, {'seconds': s})) for s in [0.2, 0.1, 0.2]]
+						   + [(single, partial(single.call, {'seconds': 0.1})) for _ in range(2)]
+						   + [(fast, partial(fast.call, {'seconds': 1.}))])
+	assert time.monotonic() - start < 0.9
+	assert results[:5] == ['fast slept 0.2', 'fast slept 0.1', 'fast slept 0.2'] + ['single slept 0.1'] * 2
+	assert results[5] == "Error: 'fast' did not finish within 0.5 seconds"
+	assert single.peak == 1 and fast.peak > 1
+	time.sleep(0.6)
+	stats = executor.stats()
+	assert stats['single']['calls'] == 2 and stats['fast']['calls'] == 4 and stats['fast']['timeouts'] == 1
+	executor.close()
+
+	hung = Sleep('hung', max_concurrency=1)
+	with ToolExecutor(2, timeout=0.15) as executor: # the second call waits for the (hung) first one
+		start = time.monotonic()
+		results = executor.run([(hung, partial(hung.call, {'seconds': 0.8})), (hung, partial(hung.call, {'seconds': 0}))])
+		assert time.monotonic() - start < 0.6
+	assert results == ["Error: 'hung' did not finish within 0.15 seconds", "Error: 'hung' did not start within 0.15 seconds"]
+	assert executor._pool is None
+	time.sleep(0.8)
+	assert executor.stats()['hung']['calls'] == 1 and executor.stats()['hung']['abandoned'] == 1
+
+	client = Tool_Client(tools=[fast])
+	chat = [{'role': 'assistant', 'content': None, 'tool_calls': [
+		{'id': str(i), 'function': {'name': 'fast', 'arguments': json.dumps({'seconds': s})}}
+		for i, s in enumerate([0.2, 0.05])]}]
+	results = client.resolve_tool_calls(chat)
+	assert [r['tool_call_id'] for r in results] == ['0', '1'] and chat[1:] == results
+	assert results[1]['content'] == 'fast slept 0.05'